@@ -170,7 +170,10 @@ class ChainRequest:
 
         def fn(resp: Response):
             count = 0
-            for url in resp.sel.css(css).getall():
+            urls = resp.sel.css(css).getall()
+            dont_filter = kwargs.get("dont_filter", req.kws.get("dont_filter", False))
+            method = kwargs.get("method", req.kws.get("method", "GET"))
+            for url in resp.unseen_links(urls, dont_filter=dont_filter, method=method):
                 m = req.kws.pop("meta", {})
                 if resp.meta:
                     m.update(resp.meta)
@@ -0,0 +1,231 @@
+"""
+This module provides codecs that turn tasks into bytes for queues and persistence.
+
+Every encoded message starts with one byte telling its format, so messages written
+by any codec can be decoded by :func:`decode`.
+"""
+
+import marshal
+import zlib
+from importlib import import_module
+
+import dill as pickle
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from acrawler.middleware import middleware
+from acrawler.task import Task
+from acrawler.utils import check_import
+
+# Typing
+from typing import Callable
+
+_Function = Callable
+
+_COMPACT = ord("C")
+_ZLIB = ord("Z")
+_LZ4 = ord("L")
+
+# tags of values that marshal can't store
+_TAG_PICKLE = 0
+_TAG_FUNC = 1
+_TAG_FUNCS = 2
+_TAG_URL = 3
+_TAG_TASK = 4
+_TAG_MULTIDICT = 5
+_TAG_PARENT = 6
+
+_callbacks = {}
+_callback_names = {}
+
+
+def register_callback(func: _Function = None, name: str = None):
+    """Register a callback function by name so that :class:`CompactCodec` stores
+    the name instead of pickling the function. Can be used as a decorator::
+
+        @register_callback
+        def parse_detail(response):
+            ...
+
+    Module-level functions and methods of the running crawler are resolved
+    automatically, registering is only needed for other callables.
+    """
+
+    def decorator(func):
+        key = name or f"{func.__module__}:{func.__qualname__}"
+        _callbacks[key] = func
+        _callback_names[func] = key
+        return func
+
+    if func is None:
+        return decorator
+    return decorator(func)
+
+
+def _callback_name(func):
+    try:
+        if func in _callback_names:
+            return _callback_names[func]
+    except TypeError:
+        return None
+    owner = getattr(func, "__self__", None)
+    if owner is not None and owner is middleware.crawler:
+        return "crawler:" + func.__name__
+    module = getattr(func, "__module__", None)
+    qualname = getattr(func, "__qualname__", "")
+    if owner is None and module and qualname and "<locals>" not in qualname:
+        key = f"{module}:{qualname}"
+        try:
+            if _resolve_name(key) is func:
+                return key
+        except Exception:
+            pass
+    return None
+
+
+def _resolve_name(key: str):
+    if key in _callbacks:
+        return _callbacks[key]
+    module, qualname = key.split(":", 1)
+    if module == "crawler":
+        return getattr(middleware.crawler, qualname)
+    obj = import_module(module)
+    for attr in qualname.split("."):
+        obj = getattr(obj, attr)
+    return obj
+
+
+class PickleCodec:
+    """Pickles the whole task with `dill`.
+
+    :param compress: None, ``"zlib"`` or ``"lz4"``.
+    """
+
+    def __init__(self, compress: str = None):
+        if compress not in (None, "zlib", "lz4"):
+            raise ValueError(f"Unknown compression: {compress}")
+        self.compress = compress
+        if compress == "lz4":
+            self._lz4 = check_import("lz4.frame")
+
+    def encode(self, task: Task) -> bytes:
+        return self._compress(self._dumps(task))
+
+    def decode(self, message: bytes) -> Task:
+        return decode(message)
+
+    def _dumps(self, task: Task) -> bytes:
+        return pickle.dumps(task)
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compress == "zlib":
+            return bytes([_ZLIB]) + zlib.compress(data)
+        elif self.compress == "lz4":
+            return bytes([_LZ4]) + self._lz4.compress(data)
+        return data
+
+
+class CompactCodec(PickleCodec):
+    """Stores a task's state with :mod:`marshal`.
+
+    The class of the task and its callbacks are stored as names, urls and headers
+    as plain strings. Values that marshal can't store (and callables that can't
+    be named, see :func:`register_callback`) are pickled one by one.
+    """
+
+    def _dumps(self, task: Task) -> bytes:
+        return bytes([_COMPACT]) + marshal.dumps(_task_to_tuple(task))
+
+
+def _task_to_tuple(task, parents=()):
+    cls = task.__class__
+    state = dict(task.__getstate__())
+    parents = parents + (task,)
+    plain = {}
+    special = {}
+    for key, value in state.items():
+        tagged = _tag(value, parents)
+        if tagged is None:
+            plain[key] = value
+        else:
+            special[key] = tagged
+    return (f"{cls.__module__}:{cls.__qualname__}", plain, special)
+
+
+def _tag(value, parents):
+    # returns None if marshal can store the value as it is
+    if isinstance(value, URL):
+        return (_TAG_URL, str(value))
+    if isinstance(value, (CIMultiDict, CIMultiDictProxy)):
+        # keys of aiohttp headers are `istr`, which marshal can't store
+        return (_TAG_MULTIDICT, [(str(k), v) for k, v in value.items()])
+    if isinstance(value, Task):
+        for depth, parent in enumerate(reversed(parents)):
+            if value is parent:
+                # e.g. response.request.response
+                return (_TAG_PARENT, depth)
+        return (_TAG_TASK, _task_to_tuple(value, parents))
+    if callable(value) and not isinstance(value, type):
+        name = _callback_name(value)
+        if name:
+            return (_TAG_FUNC, name)
+    if isinstance(value, list) and value and all(callable(v) for v in value):
+        names = [_callback_name(v) for v in value]
+        if all(names):
+            return (_TAG_FUNCS, names)
+    try:
+        marshal.dumps(value)
+        return None
+    except ValueError:
+        return (_TAG_PICKLE, pickle.dumps(value))
+
+
+def _untag(tagged, parents):
+    tag, value = tagged
+    if tag == _TAG_URL:
+        return URL(value, encoded=True)
+    if tag == _TAG_MULTIDICT:
+        return CIMultiDict(value)
+    if tag == _TAG_TASK:
+        return _task_from_tuple(value, parents)
+    if tag == _TAG_PARENT:
+        return parents[-1 - value]
+    if tag == _TAG_FUNC:
+        return _resolve_name(value)
+    if tag == _TAG_FUNCS:
+        return [_resolve_name(v) for v in value]
+    return pickle.loads(value)
+
+
+def _task_from_tuple(data, parents=()):
+    cls_name, plain, special = data
+    cls = _resolve_name(cls_name)
+    task = cls.__new__(cls)
+    parents = parents + (task,)
+    state = plain
+    for key, tagged in special.items():
+        state[key] = _untag(tagged, parents)
+    task.__setstate__(state)
+    return task
+
+
+def decode(message: bytes) -> Task:
+    """Decode a message produced by any codec of this module."""
+    head = message[0]
+    if head == _ZLIB:
+        return decode(zlib.decompress(message[1:]))
+    elif head == _LZ4:
+        return decode(check_import("lz4.frame").decompress(message[1:]))
+    elif head == _COMPACT:
+        return _task_from_tuple(marshal.loads(message[1:]))
+    # plain pickle of PickleCodec and former versions
+    return pickle.loads(message)
+
+
+def get_codec(name: str = "pickle", compress: str = None) -> PickleCodec:
+    """Returns a codec by its name: ``"pickle"`` or ``"compact"``."""
+    if name == "pickle":
+        return PickleCodec(compress)
+    elif name == "compact":
+        return CompactCodec(compress)
+    raise ValueError(f"Unknown codec: {name}")
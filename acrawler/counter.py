@@ -1,8 +1,59 @@
 import asyncio
 from collections import defaultdict
-import random
+import logging
+import time
 
 from acrawler.exceptions import ReScheduleError
+from acrawler.scheduler import TokenBucket, _eval_script, _rate_burst
+
+# Decrements an ancestor and the unfinished count, publishing the ancestor on the
+# channel once it has no unfinished task left.
+# KEYS: ancestor zset, unfinished key; ARGV: ancestor, channel
+_ANCESTOR_DEC_SCRIPT = """
+local left = tonumber(redis.call("ZINCRBY", KEYS[1], -1, ARGV[1]))
+if left <= 0 then
+    redis.call("ZREM", KEYS[1], ARGV[1])
+    redis.call("PUBLISH", ARGV[2], ARGV[1])
+end
+return redis.call("DECR", KEYS[2])
+"""
+
+# Applies the deltas buffered by BufferedRedisCounter at once, publishing ancestors
+# that have no unfinished task left. Returns the unfinished count.
+# KEYS: unfinished key, required key, ancestor zset, counts_suc zset,
+#       counts_fail zset
+# ARGV: channel, unfinished delta, required delta, number of ancestors,
+#       then (ancestor, delta) pairs, number of successes, (family, count) pairs,
+#       then (family, count) pairs of failures
+_FLUSH_SCRIPT = """
+local i = 4
+local n = tonumber(ARGV[4])
+for j = 1, n do
+    local ancestor = ARGV[i + 1]
+    local left = tonumber(redis.call("ZINCRBY", KEYS[3], ARGV[i + 2], ancestor))
+    if left <= 0 then
+        redis.call("ZREM", KEYS[3], ancestor)
+        redis.call("PUBLISH", ARGV[1], ancestor)
+    end
+    i = i + 2
+end
+i = i + 1
+n = tonumber(ARGV[i])
+for j = 1, n do
+    redis.call("ZINCRBY", KEYS[4], ARGV[i + 2], ARGV[i + 1])
+    i = i + 2
+end
+while i < #ARGV do
+    redis.call("ZINCRBY", KEYS[5], ARGV[i + 2], ARGV[i + 1])
+    i = i + 2
+end
+if tonumber(ARGV[3]) ~= 0 then
+    redis.call("INCRBY", KEYS[2], ARGV[3])
+end
+return redis.call("INCRBY", KEYS[1], ARGV[2])
+"""
+
+logger = logging.getLogger(__name__)
 
 
 class BaseCounter:
@@ -12,22 +63,37 @@ class BaseCounter:
 
     def init_config(self):
 
+        # Per-host settings, see `HOST_RULES`
+        self.rules = self.crawler.host_rules
+
         # Checking log by special host
-        self.conf = (self.crawler.config.get("MAX_REQUESTS_SPECIAL_HOST") or {}).copy()
-        self.hosts = list(self.conf.keys())
-        self.check = len(self.hosts) > 0
+        self.conf = {}
+        self.check = any("max_requests" in rule for rule in self.rules.rules.values())
 
         # Checking log by per host
         self.uni = self.crawler.config.get("MAX_REQUESTS_PER_HOST", 0)
         self.uniconf = {}
         self.unicheck = self.uni > 0
 
-        # Delay config
+        # Rate config, a delay is enforced as a rate of `1 / delay`
         self.delay = self.crawler.config.get("DOWNLOAD_DELAY", 0)
-        self.conf_delay = self.crawler.config.get(
-            "DOWNLOAD_DELAY_SPECIAL_HOST", {}
-        ).copy()
-        self.hosts_delay = list(self.conf_delay.keys())
+        self.rate = self.crawler.config.get("DOWNLOAD_RATE", 0)
+        self.burst = self.crawler.config.get("DOWNLOAD_BURST", 1)
+        self.ratecheck = bool(
+            self.rate
+            or self.delay
+            or any(
+                "rate" in rule or "delay" in rule for rule in self.rules.rules.values()
+            )
+        )
+        self.buckets = {}
+
+        # Limits, delays and rates are enforced by the host-partitioned queue
+        partitioned = self.crawler.config.get("HOST_PARTITION", False)
+        if partitioned and not self.crawler.redis_enable:
+            self.check = False
+            self.unicheck = False
+            self.ratecheck = False
 
     async def unfinished_inc(self, task):
         raise NotImplementedError()
@@ -35,6 +101,10 @@ class BaseCounter:
     async def unfinished_dec(self, task):
         raise NotImplementedError()
 
+    async def unfinished_inc_many(self, tasks):
+        for task in tasks:
+            await self.unfinished_inc(task)
+
     async def required_inc(self):
         """Called in delay handler to record current requests"""
         raise NotImplementedError()
@@ -49,13 +119,21 @@ class BaseCounter:
     def join(self):
         raise NotImplementedError()
 
-    def join_by_ancestor_unfinished(self):
+    def join_by_ancestor_unfinished(self, ancestor):
+        """Waits until all tasks of `ancestor` are done."""
         raise NotImplementedError()
 
+    async def close(self):
+        """Called when the crawler closes."""
+
     async def task_add(self, task, flag: int = 1):
         if flag != -2:
             await self.unfinished_inc(task)
 
+    async def task_add_many(self, tasks, flag: int = 1):
+        if flag != -2 and tasks:
+            await self.unfinished_inc_many(tasks)
+
     async def task_done(self, task, flag: int = 1):
         if flag != -2:
             await self.unfinished_dec(task)
@@ -69,21 +147,20 @@ class BaseCounter:
 
     async def require_req(self, req):
 
-        # Check limit
         req.chosts = []  # this contains hosts for special check
         req.cuni = False  # this flags its state for unicheck
 
+        # Check limit
         to_unicheck = True  # special-host-check has higher priority than unicheck
         if self.check:
-            for host in self.hosts:
-                if host in req.url.host:
-                    to_unicheck = False
-                    if self.conf[host] > 0:
-                        req.chosts.append(host)
-                        self.conf[host] -= 1
-                        continue
-                    else:
-                        raise ReScheduleError()
+            host, limit = self.rules.find(req.url.host, "max_requests")
+            if host is not None:
+                to_unicheck = False
+                if self.conf.setdefault(host, limit) > 0:
+                    req.chosts.append(host)
+                    self.conf[host] -= 1
+                else:
+                    raise ReScheduleError()
 
         if self.unicheck and to_unicheck:
             count = self.uniconf.setdefault(req.url.host, self.uni)
@@ -93,21 +170,33 @@ class BaseCounter:
             else:
                 raise ReScheduleError()
 
-        # Start delay
-        origin = True
-        target = 0
-        for host in self.hosts_delay:
-            if host in req.url.host:
-                target += self.conf_delay[host]
-                origin = False
-
-        if origin:
-            target = self.delay
-        delay = round(random.uniform(target*0.8, target*1.2),2)
-        await asyncio.sleep(delay)
+        # Check rate: an early request reserves a token and is deferred to its
+        # own start time instead of holding the worker. Its host limits are
+        # released by the worker meanwhile.
+        if self.ratecheck:
+            bucket = self._bucket(req.url.host)
+            if bucket and req.__dict__.pop("_rate_reserved", None) is None:
+                start = bucket.ready_time()
+                bucket.consume()
+                wait = start - time.time()
+                if wait > 0:
+                    req._rate_reserved = start
+                    raise ReScheduleError(defer=wait)
+
         await self.required_inc()
         req.inprogress = True
 
+    def _bucket(self, host):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            rate = self.rules.get(host, "rate", self.rate)
+            rate, burst = _rate_burst(rate, self.burst)
+            delay = self.rules.get(host, "delay", self.delay)
+            if delay and (not rate or 1 / delay < rate):
+                rate, burst = 1 / delay, 1
+            bucket = self.buckets[host] = TokenBucket(rate, burst) if rate else False
+        return bucket
+
     async def release_req(self, req):
 
         # Release limit
@@ -133,6 +222,8 @@ class Counter(BaseCounter):
         self.unfinished = 0
         self._finished = asyncio.Event(loop=crawler.loop)
         self._finished.set()
+        # set when an ancestor has no unfinished task left
+        self._ancestor_events = {}
 
         # Counts of concurrent requests
         self.required = 0
@@ -142,8 +233,11 @@ class Counter(BaseCounter):
             await self._finished.wait()
 
     async def join_by_ancestor_unfinished(self, ancestor):
-        while self.ancestor_unfinished[ancestor] != 0:
-            await asyncio.sleep(0.5)
+        if self.ancestor_unfinished.get(ancestor, 0) != 0:
+            event = self._ancestor_events.get(ancestor)
+            if event is None:
+                event = self._ancestor_events[ancestor] = asyncio.Event()
+            await event.wait()
 
     async def counts_inc(self, task, flag):
         if flag >= 0:
@@ -165,6 +259,11 @@ class Counter(BaseCounter):
     async def unfinished_dec(self, task):
         if task.ancestor:
             self.ancestor_unfinished[task.ancestor] -= 1
+            if self.ancestor_unfinished[task.ancestor] == 0:
+                del self.ancestor_unfinished[task.ancestor]
+                event = self._ancestor_events.pop(task.ancestor, None)
+                if event is not None:
+                    event.set()
         if self.unfinished <= 0:
             raise ValueError("task_done() called too many times")
         self.unfinished -= 1
@@ -180,12 +279,14 @@ class Counter(BaseCounter):
     def __getstate__(self):
         state = self.__dict__
         state.pop("_finished", None)
+        state.pop("_ancestor_events", None)
         return state
 
     def __setstate__(self, state):
         self.__dict__.update(state)
         self.init_config()
         self.__dict__["_finished"] = asyncio.Event()
+        self.__dict__["_ancestor_events"] = {}
         if self.unfinished == 0:
             self._finished.set()
         else:
@@ -194,8 +295,15 @@ class Counter(BaseCounter):
 
 class RedisCounter(BaseCounter):
     """A counter use redis to store information.
+
+    An ancestor whose last task is done is published on a channel, so that
+    :meth:`join_by_ancestor_unfinished` returns at once on every crawler.
     """
 
+    ancestor_recheck = 5
+    """Seconds between checks of an ancestor's count while waiting for its
+    notification, in case the subscription lost it."""
+
     def __init__(self, crawler):
         super().__init__(crawler)
         self.redis = None
@@ -210,6 +318,12 @@ class RedisCounter(BaseCounter):
         self.counts_key_suc = "acrawler:" + cname + ":c:counts_suc"
         self.counts_key_fail = "acrawler:" + cname + ":c:counts_fail"
 
+        # Redis Pub/Sub channel of finished ancestors
+        self.ancestor_channel = "acrawler:" + cname + ":c:ancestor_done"
+        self._ancestor_events = {}
+        self._listener = None
+        self._subscribe_lock = asyncio.Lock()
+
         self._finished = asyncio.Event(loop=crawler.loop)
         self._finished.set()
 
@@ -218,8 +332,40 @@ class RedisCounter(BaseCounter):
             await self._finished.wait()
 
     async def join_by_ancestor_unfinished(self, ancestor):
-        while (await self.redis.zscore(self.ancestor_unfinished_key, ancestor)) != 0:
-            await asyncio.sleep(0.5)
+        # subscribe before reading the count so that no notification is missed
+        await self._subscribe()
+        event = self._ancestor_events.get(ancestor)
+        if event is None:
+            event = self._ancestor_events[ancestor] = asyncio.Event()
+        while not event.is_set():
+            left = await self.redis.zscore(self.ancestor_unfinished_key, ancestor)
+            if not left or left <= 0:
+                event.set()
+                break
+            try:
+                await asyncio.wait_for(event.wait(), self.ancestor_recheck)
+            except asyncio.TimeoutError:
+                pass
+        if self._ancestor_events.get(ancestor) is event:
+            del self._ancestor_events[ancestor]
+
+    async def _subscribe(self):
+        async with self._subscribe_lock:
+            if self._listener is None:
+                (channel,) = await self.redis.subscribe(self.ancestor_channel)
+                self._listener = asyncio.ensure_future(self._listen(channel))
+
+    async def _listen(self, channel):
+        async for ancestor in channel.iter(encoding="utf-8"):
+            event = self._ancestor_events.pop(ancestor, None)
+            if event is not None:
+                event.set()
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+            await self.redis.unsubscribe(self.ancestor_channel)
 
     async def counts_inc(self, task, flag):
         if flag == 1:
@@ -254,12 +400,26 @@ class RedisCounter(BaseCounter):
             await self.redis.incr(self.unfinished_key)
         self._finished.clear()
 
+    async def unfinished_inc_many(self, tasks):
+        ancestors = defaultdict(int)
+        for task in tasks:
+            if task.ancestor:
+                ancestors[task.ancestor] += 1
+        tr = self.redis.multi_exec()
+        for ancestor, count in ancestors.items():
+            tr.zincrby(self.ancestor_unfinished_key, count, ancestor)
+        tr.incrby(self.unfinished_key, len(tasks))
+        await tr.execute()
+        self._finished.clear()
+
     async def unfinished_dec(self, task):
         if task.ancestor:
-            tr = self.redis.multi_exec()
-            tr.zincrby(self.ancestor_unfinished_key, -1, task.ancestor)
-            tr.decr(self.unfinished_key)
-            _, res = await tr.execute()
+            res = await _eval_script(
+                self.redis,
+                _ANCESTOR_DEC_SCRIPT,
+                [self.ancestor_unfinished_key, self.unfinished_key],
+                [task.ancestor, self.ancestor_channel],
+            )
         else:
             res = await self.redis.decr(self.unfinished_key)
         if int(res) == 0:
@@ -270,3 +430,163 @@ class RedisCounter(BaseCounter):
 
     async def required_dec(self):
         await self.redis.decr(self.required_key)
+
+
+class BufferedRedisCounter(RedisCounter):
+    """A :class:`RedisCounter` that keeps changes locally and writes them with one
+    script every `flush_interval` seconds or `flush_size` changes.
+
+    Increments of unfinished tasks are written at once, together with the
+    changes buffered so far, so that the count in redis never drops to zero while
+    a task is unfinished: a delayed decrement only delays completion. A
+    decrement of an ancestor awaited by this crawler is written at once too.
+
+    :param flush_interval: max seconds a change stays buffered.
+    :param flush_size: number of buffered changes that triggers a flush.
+    """
+
+    def __init__(self, crawler, flush_interval: float = 0.5, flush_size: int = 1000):
+        super().__init__(crawler)
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+        self._reset()
+
+    def _reset(self):
+        self._unfinished = 0
+        self._required = 0
+        self._ancestors = defaultdict(int)
+        self._counts = (defaultdict(int), defaultdict(int))  # (fail, suc)
+        self._pending = 0
+
+    def _take(self):
+        # returns the buffered changes and starts a new buffer
+        changes = (
+            self._unfinished,
+            self._required,
+            self._ancestors,
+            self._counts,
+            self._pending,
+        )
+        self._reset()
+        return changes
+
+    def _restore(self, changes):
+        # puts back changes that could not be written
+        unfinished, required, ancestors, counts, pending = changes
+        self._unfinished += unfinished
+        self._required += required
+        for ancestor, delta in ancestors.items():
+            self._ancestors[ancestor] += delta
+        for flag in (0, 1):
+            for family, count in counts[flag].items():
+                self._counts[flag][family] += count
+        self._pending += pending
+
+    async def flush(self):
+        """Writes the buffered changes to redis."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            changes = self._take()
+            unfinished, required, ancestors, (fail, suc), _ = changes
+            ancestors = [(a, d) for a, d in ancestors.items() if d]
+            args = [self.ancestor_channel, unfinished, required, len(ancestors)]
+            for ancestor, delta in ancestors:
+                args += [ancestor, delta]
+            args.append(len(suc))
+            for family, count in suc.items():
+                args += [family, count]
+            for family, count in fail.items():
+                args += [family, count]
+            keys = [
+                self.unfinished_key,
+                self.required_key,
+                self.ancestor_unfinished_key,
+                self.counts_key_suc,
+                self.counts_key_fail,
+            ]
+            try:
+                res = await _eval_script(self.redis, _FLUSH_SCRIPT, keys, args)
+            except Exception:
+                self._restore(changes)
+                raise
+            # increments buffered meanwhile are not written yet
+            if int(res) == 0 and self._unfinished <= 0:
+                self._finished.set()
+
+    async def _buffered(self):
+        self._pending += 1
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_periodically())
+        if self._pending >= self.flush_size:
+            await self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning("Failed to flush counter: {}".format(e))
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        await super().close()
+
+    async def join(self):
+        await self.flush()
+        await super().join()
+
+    async def join_by_ancestor_unfinished(self, ancestor):
+        await self.flush()
+        await super().join_by_ancestor_unfinished(ancestor)
+
+    async def counts_inc(self, task, flag):
+        if flag in (0, 1):
+            self._counts[flag][task.primary_family] += 1
+            await self._buffered()
+
+    async def get_unfinished(self):
+        await self.flush()
+        return await super().get_unfinished()
+
+    async def get_counts_dict(self):
+        await self.flush()
+        return await super().get_counts_dict()
+
+    async def get_required(self):
+        await self.flush()
+        return await super().get_required()
+
+    async def unfinished_inc(self, task):
+        await self.unfinished_inc_many([task])
+
+    async def unfinished_inc_many(self, tasks):
+        for task in tasks:
+            if task.ancestor:
+                self._ancestors[task.ancestor] += 1
+        self._unfinished += len(tasks)
+        self._pending += 1
+        self._finished.clear()
+        await self.flush()
+
+    async def unfinished_dec(self, task):
+        if task.ancestor:
+            self._ancestors[task.ancestor] -= 1
+        self._unfinished -= 1
+        await self._buffered()
+        if task.ancestor in self._ancestor_events:
+            await self.flush()
+
+    async def required_inc(self):
+        self._required += 1
+        await self._buffered()
+
+    async def required_dec(self):
+        self._required -= 1
+        await self._buffered()
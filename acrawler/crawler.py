@@ -14,12 +14,33 @@ from typing import Any, Dict, List
 
 import acrawler
 import acrawler.setting as DEFAULT_SETTING
+from acrawler.codec import get_codec
 from acrawler.counter import Counter
 from acrawler.exceptions import ReScheduleError, SkipTaskError
+from acrawler.hostrules import HostRules
 from acrawler.http import Request
 from acrawler.item import DefaultItem
 from acrawler.middleware import middleware
-from acrawler.scheduler import RedisDupefilter, RedisPQ, Scheduler
+from acrawler.normalizer import url_normalizer
+from acrawler.scheduler import (
+    BloomDupefilter,
+    BucketPQ,
+    CachedDupefilter,
+    CompactDupefilter,
+    ExpiringDupefilter,
+    DiskPQ,
+    HeapPQ,
+    HostPQ,
+    LogDupefilter,
+    RedisBloomDupefilter,
+    RedisDupefilter,
+    RedisExpiringDupefilter,
+    RedisPQ,
+    RedisStreamQueue,
+    Scheduler,
+    SetDupefilter,
+    ShardedRedisPQ,
+)
 from acrawler.task import SpecialTask, Task
 from acrawler.utils import (
     config_from_setting,
@@ -56,8 +77,41 @@ class Worker:
         self.is_req = is_req
         self.sdl = sdl or Scheduler()
         self._max_tries = self.crawler.max_tries
+        self.batch_size = self.crawler.config.get("ADD_TASKS_BATCH_SIZE", 100)
         self.current_task = None
 
+    async def _execute(self, task):
+        """Execute the task and add the new tasks it yields in batches."""
+        new_tasks = []
+        cancelled = False
+        try:
+            async for new_task in task.execute():
+                if isinstance(new_task, dict):
+                    new_task = DefaultItem(extra=new_task)
+                if isinstance(new_task, Task):
+                    new_task.meta = {**task.meta, **new_task.meta}
+                    new_tasks.append(new_task)
+                    if len(new_tasks) >= self.batch_size:
+                        await self._add_new_tasks(new_tasks, task)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # tasks yielded before an error are still scheduled
+            await self._add_new_tasks(new_tasks, task, wait=not cancelled)
+
+    async def _add_new_tasks(self, new_tasks: list, task, wait=True):
+        if not new_tasks:
+            return
+        if wait and not self.is_req:
+            # request workers never wait so that requests drain
+            for new_task in new_tasks:
+                if isinstance(new_task, Request):
+                    await self.crawler.wait_for_room(new_task)
+                    break
+        await self.crawler.add_tasks(new_tasks, ancestor=task.ancestor)
+        new_tasks.clear()
+
     async def work(self):
         try:
             while True:
@@ -70,17 +124,11 @@ class Worker:
                 try:
                     if self.is_req:
                         await self.crawler.counter.require_req(task)
-                    async for new_task in task.execute():
-                        if isinstance(new_task, dict):
-                            new_task = DefaultItem(extra=new_task)
-                        if isinstance(new_task, Task):
-                            new_task.meta = {**task.meta, **new_task.meta}
-                            await self.crawler.add_task(new_task, ancestor=task.ancestor)
-                        else:
-                            continue
+                    await self._execute(task)
                 except asyncio.CancelledError as e:
                     if self.is_req:
                         await self.crawler.counter.release_req(task)
+                        self.sdl.release(task)
                     raise e
                 except SkipTaskError:
                     logger.debug("Skip task {}".format(task))
@@ -90,10 +138,14 @@ class Worker:
                         task.recrawl = e.recrawl
                     await self.crawler.counter.task_done(task, -2)
                     await self.crawler.add_task(task, dont_filter=True, flag=-2)
+                    await self.sdl.task_done(task)
                     if self.is_req:
                         await self.crawler.counter.release_req(task)
+                        self.sdl.release(task)
                     self.current_task = None
-                    await asyncio.sleep(0.5)
+                    if not e.defer:
+                        # the task may be ready again at once, don't spin on it
+                        await asyncio.sleep(0.5)
                     continue
                 except Exception as e:
                     exception = True
@@ -115,9 +167,11 @@ class Worker:
 
                 if not exception:
                     await self.crawler.counter.task_done(task, 1)
+                await self.sdl.task_done(task)
 
                 if self.is_req:
                     await self.crawler.counter.release_req(task)
+                    self.sdl.release(task)
 
                 if task.recrawl > 0 and not retry:
                     task.tries = 0
@@ -131,6 +185,7 @@ class Worker:
                 task.dont_filter = True
                 logger.info("Shutdown: put back {}".format(task))
                 await self.sdl.produce(task)
+                await self.sdl.task_done(task)
             raise e
         except Exception as e:
             logger.error(traceback.format_exc())
@@ -210,6 +265,9 @@ class Crawler(object):
         self.request_config = request_config or self.request_config
         self._form_config()
 
+        self.host_rules = HostRules.from_config(self.config)
+        """Per-host settings, see `HOST_RULES`."""
+
         self.counter: Counter = None
         self.redis: "aioredis.Redis" = None
         self.workers: List["Worker"] = []
@@ -247,8 +305,9 @@ class Crawler(object):
             logger.info(self.middleware)
             logger.info("Start crawling...")
             await self._on_start()
-            await CrawlerStart(self).execute()
+            # workers must exist before start_requests may wait for room in the queues
             await self.manager()
+            await CrawlerStart(self).execute()
 
             await CrawlerFinish(self).execute()
             await self.ashutdown()
@@ -354,6 +413,8 @@ class Crawler(object):
             new_task.ancestor = ancestor
         if isinstance(new_task, Request):
             added = await self.sdl_req.produce(new_task, dont_filter=dont_filter)
+            if not added and new_task.url_normalized:
+                url_normalizer.saved += 1
         elif isinstance(new_task, Task):
             added = await self.sdl.produce(new_task, dont_filter=dont_filter)
 
@@ -363,6 +424,48 @@ class Crawler(object):
         else:
             return False
 
+    async def add_tasks(
+        self, new_tasks: list, dont_filter=False, ancestor=None, flag=1
+    ) -> list:
+        """ Interface to add many Tasks at once. Dupefilter checks, queue pushes
+        and counter updates are batched per scheduler.
+
+        Returns:
+            a list of the tasks that were successfully added.
+        """
+        requests = []
+        others = []
+        for new_task in new_tasks:
+            if ancestor:
+                new_task.ancestor = ancestor
+            if isinstance(new_task, Request):
+                requests.append(new_task)
+            elif isinstance(new_task, Task):
+                others.append(new_task)
+
+        added = []
+        if requests:
+            added += await self.sdl_req.produce_many(requests, dont_filter=dont_filter)
+            if len(added) < len(requests):
+                ids = {id(t) for t in added}
+                url_normalizer.saved += sum(
+                    1 for t in requests if id(t) not in ids and t.url_normalized
+                )
+        if others:
+            added += await self.sdl.produce_many(others, dont_filter=dont_filter)
+        await self.counter.task_add_many(added, flag=flag)
+        return added
+
+    async def wait_for_room(self, new_task: "acrawler.task.Task"):
+        """ Blocks while the scheduler that receives the task is above its high
+        watermark (see `REQUEST_QUEUE_WATERMARK` and `TASK_QUEUE_WATERMARK`).
+        Producers that may yield many tasks should call it before :meth:`add_task`.
+        """
+        if isinstance(new_task, Request):
+            await self.sdl_req.wait_for_room()
+        elif isinstance(new_task, Task):
+            await self.sdl.wait_for_room()
+
     def add_task_sync(
         self, new_task: "acrawler.task.Task", dont_filter=False, ancestor=None
     ):
@@ -439,25 +542,162 @@ class Crawler(object):
         request_df = None
         request_q1 = None
         request_q2 = None
+        self.codec = get_codec(
+            self.config.get("QUEUE_CODEC", "pickle"), self.config.get("QUEUE_COMPRESS")
+        )
+        url_normalizer.configure(
+            self.config.get("URL_NORMALIZATION"),
+            self.config.get("URL_NORMALIZATION_SPECIAL_HOST"),
+            self.config.get("URL_NORMALIZATION_FAMILY"),
+        )
         if self.redis_enable:
-            request_df = RedisDupefilter(
-                address=self.config.get("REDIS_ADDRESS"),
-                df_key=self.config.get("REDIS_DF_KEY")
-                or "acrawler:" + self.name + ":df",
+            request_df = self._redis_dupefilter()
+            cache_size = self.config.get("DUPEFILTER_CACHE_SIZE", 0)
+            if cache_size and isinstance(request_df, RedisExpiringDupefilter):
+                # the cache never forgets, it would defeat `DUPEFILTER_TTL`
+                logger.warning(
+                    "DUPEFILTER_CACHE_SIZE is ignored by the expiring dupefilter"
+                )
+            elif cache_size:
+                request_df = CachedDupefilter(request_df, size=cache_size)
+            request_q1 = self._redis_queue("q1")
+            request_q2 = self._redis_queue("q2")
+
+        else:
+            if self.config.get("HOST_PARTITION", False):
+                request_q1 = HostPQ(
+                    max_per_host=self.config.get("MAX_REQUESTS_PER_HOST", 0),
+                    delay=self.config.get("DOWNLOAD_DELAY", 0),
+                    rate=self.config.get("DOWNLOAD_RATE", 0),
+                    burst=self.config.get("DOWNLOAD_BURST", 1),
+                    rules=self.host_rules,
+                )
+            else:
+                request_q1 = self._local_queue("q1")
+            request_q2 = self._local_queue("q2")
+
+        high, low = self.config.get("REQUEST_QUEUE_WATERMARK") or (0, None)
+        self.sdl_req = Scheduler(
+            df=request_df or self._local_dupefilter(),
+            q=request_q1,
+            high_watermark=high,
+            low_watermark=low,
+        )
+        high, low = self.config.get("TASK_QUEUE_WATERMARK") or (0, None)
+        self.sdl = Scheduler(
+            df=request_df, q=request_q2, high_watermark=high, low_watermark=low
+        )
+
+    def _redis_queue(self, suffix: str):
+        # create a distributed queue according to `REDIS_QUEUE_ENGINE`
+        engine = self.config.get("REDIS_QUEUE_ENGINE", "zset")
+        address = self.config.get("REDIS_ADDRESS")
+        q_key = (
+            self.config.get("REDIS_QUEUE_KEY") or ("acrawler:" + self.name)
+        ) + (":" + suffix)
+        prefetch = self.config.get("REDIS_QUEUE_PREFETCH", 8)
+        shards = self.config.get("REDIS_QUEUE_SHARDS", 1)
+        if shards > 1:
+            if engine != "zset":
+                raise ValueError("REDIS_QUEUE_SHARDS requires REDIS_QUEUE_ENGINE zset")
+            return ShardedRedisPQ(
+                address=address,
+                q_key=q_key,
+                shards=shards,
+                owned=self.config.get("REDIS_QUEUE_OWNED_SHARDS"),
+                prefetch=prefetch,
+                codec=self.codec,
             )
-            request_q1 = RedisPQ(
-                address=self.config.get("REDIS_ADDRESS"),
-                q_key=(self.config.get("REDIS_QUEUE_KEY") or ("acrawler:" + self.name))
-                + ":q1",
+        elif engine == "zset":
+            return RedisPQ(
+                address=address, q_key=q_key, prefetch=prefetch, codec=self.codec
             )
-            request_q2 = RedisPQ(
-                address=self.config.get("REDIS_ADDRESS"),
-                q_key=(self.config.get("REDIS_QUEUE_KEY") or ("acrawler:" + self.name))
-                + ":q2",
+        elif engine == "stream":
+            return RedisStreamQueue(
+                address=address,
+                q_key=q_key,
+                group=self.config.get("REDIS_STREAM_GROUP") or "acrawler:" + self.name,
+                consumer=self.config.get("REDIS_STREAM_CONSUMER"),
+                prefetch=prefetch,
+                claim_idle=self.config.get("REDIS_STREAM_CLAIM_IDLE", 300),
+                codec=self.codec,
             )
-
-        self.sdl_req = Scheduler(df=request_df, q=request_q1)
-        self.sdl = Scheduler(df=request_df, q=request_q2)
+        else:
+            raise ValueError(f"Unknown REDIS_QUEUE_ENGINE: {engine}")
+
+    def _redis_dupefilter(self):
+        # create a distributed dupefilter according to `DUPEFILTER_ENGINE`
+        engine = self.config.get("DUPEFILTER_ENGINE", "set")
+        address = self.config.get("REDIS_ADDRESS")
+        df_key = self.config.get("REDIS_DF_KEY") or "acrawler:" + self.name + ":df"
+        if engine == "set":
+            return RedisDupefilter(address=address, df_key=df_key)
+        elif engine == "bloom":
+            return RedisBloomDupefilter(
+                address=address,
+                df_key=df_key,
+                capacity=self.config.get("REDIS_DUPEFILTER_CAPACITY", 100000000),
+                error_rate=self.config.get("DUPEFILTER_ERROR_RATE", 0.001),
+            )
+        elif engine == "expiring":
+            return RedisExpiringDupefilter(
+                address=address,
+                df_key=df_key,
+                ttl=self.config.get("DUPEFILTER_TTL", 86400),
+            )
+        else:
+            raise ValueError(f"Unknown DUPEFILTER_ENGINE: {engine}")
+
+    def _local_dupefilter(self):
+        # create a non-distributed dupefilter according to `DUPEFILTER_ENGINE`
+        engine = self.config.get("DUPEFILTER_ENGINE", "set")
+        if engine == "set":
+            return SetDupefilter()
+        elif engine == "compact":
+            return CompactDupefilter()
+        elif engine == "log":
+            tag = self.config.get("PERSISTENT_NAME", None) or ".acrawler." + self.name
+            return LogDupefilter(
+                Path.cwd() / (tag + ".dflog"),
+                resume=self.persistent,
+                persistent=self.persistent,
+            )
+        elif engine == "bloom":
+            path = None
+            if self.persistent:
+                tag = self.config.get("PERSISTENT_NAME", None) or ".acrawler." + self.name
+                path = str(Path.cwd() / (tag + ".bloom"))
+            return BloomDupefilter(
+                capacity=self.config.get("DUPEFILTER_CAPACITY", 1000000),
+                error_rate=self.config.get("DUPEFILTER_ERROR_RATE", 0.001),
+                path=path,
+                resume=self.persistent,
+            )
+        elif engine == "expiring":
+            return ExpiringDupefilter(ttl=self.config.get("DUPEFILTER_TTL", 86400))
+        else:
+            raise ValueError(f"Unknown DUPEFILTER_ENGINE: {engine}")
+
+    def _local_queue(self, suffix: str):
+        # create a non-distributed queue according to `QUEUE_ENGINE`
+        engine = self.config.get("QUEUE_ENGINE", "heap")
+        if engine == "heap":
+            return HeapPQ()
+        elif engine == "bucket":
+            return BucketPQ()
+        elif engine == "disk":
+            tag = self.config.get("PERSISTENT_NAME", None) or ".acrawler." + self.name
+            qdir = Path(self.config.get("QUEUE_DISK_DIR") or Path.cwd())
+            qdir.mkdir(parents=True, exist_ok=True)
+            return DiskPQ(
+                qdir / (tag + "." + suffix + ".sqlite"),
+                max_in_memory=self.config.get("QUEUE_MEMORY_LIMIT", 10000),
+                resume=self.persistent,
+                codec=self.codec,
+                persistent=self.persistent,
+            )
+        else:
+            raise ValueError(f"Unknown QUEUE_ENGINE: {engine}")
 
     def _add_default_middleware_handler_cls(self):
         # append handlers from middleware_config.
@@ -475,7 +715,8 @@ class Crawler(object):
                 self.middleware.append_handler_cls(mcls)
 
     async def next_requests(self):
-        """This method will be binded to the event loop as a task. You can add task manually in this method."""
+        """This method will be binded to the event loop as a task. You can add task manually in this method.
+        Call :meth:`wait_for_room` before :meth:`add_task` to respect queue watermarks."""
         pass
 
     def create_task(self, coro):
@@ -502,12 +743,13 @@ class Crawler(object):
 
     async def _on_close(self):
         # call handlers's on_close()
-        await self.sdl.close()
-        await self.sdl_req.start()
         logger.debug("Call on_close()...")
         for handler in self.middleware.handlers:
             async for task in handler.handle(3):
                 await self.add_task(task)
+        # on_close() may still add tasks
+        await self.sdl.close()
+        await self.sdl_req.close()
 
     async def ashutdown(self, sig=None):
         # shutdown method.
@@ -525,7 +767,7 @@ class Crawler(object):
             for tasker in self.taskers["Others"]:
                 try:
                     await tasker
-                except Exception:
+                except (asyncio.CancelledError, Exception):
                     pass
 
             for tasker in self.taskers["Default"]:
@@ -534,7 +776,7 @@ class Crawler(object):
             for tasker in self.taskers["Default"]:
                 try:
                     await tasker
-                except Exception:
+                except (asyncio.CancelledError, Exception):
                     pass
 
             await self._log_status()
@@ -573,19 +815,19 @@ class Crawler(object):
                 with open(self.fi_tasks, "rb") as f:
                     tasks = pickle.load(f)
                 for t in tasks:
-                    self.sdl.q.push_nowait(t)
+                    self.sdl.q.push_nowait(self._load_task(t))
 
             reqs = []
             if self.fi_reqs.exists():
                 with open(self.fi_reqs, "rb") as f:
                     reqs = pickle.load(f)
                 for t in reqs:
-                    self.sdl_req.q.push_nowait(t)
+                    self.sdl_req.q.push_nowait(self._load_task(t))
 
             logger.info(f"Load {len(reqs)} requests from local file.")
             logger.info(f"Load {len(tasks)} normal tasks from local file.")
 
-            if self.fi_df.exists():
+            if self.fi_df.exists() and not self.sdl_req.df.persists_itself:
                 with open(self.fi_df, "rb") as f:
                     self.sdl_req.df = pickle.load(f)
 
@@ -593,46 +835,30 @@ class Crawler(object):
                 with open(self.fi_store, "rb") as f:
                     self.storage = pickle.load(f)
 
+    def _load_task(self, t):
+        # tasks are stored encoded by `QUEUE_CODEC`, or pickled by former versions
+        return self.codec.decode(t) if isinstance(t, bytes) else t
+
     async def _persist_save(self):
         if self.persistent and not self.redis_enable:
             with open(self.fi_counter, "wb") as f:
                 pickle.dump(self.counter, f)
-            tasks = []
+            # queues that persist themselves are already saved by close()
+            tasks = [] if self.sdl.q.persists_itself else self.sdl.q.drain_nowait()
             with open(self.fi_tasks, "wb") as f:
-                while 1:
-                    try:
-                        t = self.sdl.q.pq.get_nowait()[1]
-                        tasks.append(t)
-                    except asyncio.QueueEmpty:
-                        break
-                while 1:
-                    try:
-                        t = self.sdl.q.waiting.get_nowait()[1]
-                        tasks.append(t)
-                    except asyncio.QueueEmpty:
-                        break
-                pickle.dump(tasks, f)
+                pickle.dump([self.codec.encode(t) for t in tasks], f)
 
-            reqs = []
+            reqs = (
+                [] if self.sdl_req.q.persists_itself else self.sdl_req.q.drain_nowait()
+            )
             with open(self.fi_reqs, "wb") as f:
-                while 1:
-                    try:
-                        t = self.sdl_req.q.pq.get_nowait()[1]
-                        reqs.append(t)
-                    except asyncio.QueueEmpty:
-                        break
-                while 1:
-                    try:
-                        t = self.sdl_req.q.waiting.get_nowait()[1]
-                        reqs.append(t)
-                    except asyncio.QueueEmpty:
-                        break
-                pickle.dump(reqs, f)
+                pickle.dump([self.codec.encode(t) for t in reqs], f)
             logger.info(f"Dump {len(reqs)} requests into local file.")
             logger.info(f"Dump {len(tasks)} normal tasks from local file.")
 
-            with open(self.fi_df, "wb") as f:
-                pickle.dump(self.sdl_req.df, f)
+            if not self.sdl_req.df.persists_itself:
+                with open(self.fi_df, "wb") as f:
+                    pickle.dump(self.sdl_req.df, f)
 
             with open(self.fi_store, "wb") as f:
                 pickle.dump(self.storage, f)
@@ -670,6 +896,26 @@ class Crawler(object):
                 await self.sdl_req.q.get_length_of_waiting(),
             )
         )
+        if isinstance(self.sdl_req.df, CachedDupefilter):
+            stats = self.sdl_req.df.get_stats()
+            logger.info(
+                "Dupefilter cache--- hits:{} misses:{} hit rate:{:.1%}".format(
+                    stats["hits"], stats["misses"], stats["hit_rate"]
+                )
+            )
+        if self.config.get("AUTOTHROTTLE") and isinstance(self.sdl_req.q, HostPQ):
+            for host, stats in self.sdl_req.q.get_host_stats().items():
+                logger.info(
+                    "Host {}--- queue:{} inflight:{} limit:{} delay:{:.2f}s".format(
+                        host, *stats
+                    )
+                )
+        if url_normalizer.enabled:
+            logger.info(
+                "URL normalization--- rewritten:{rewritten} saved:{saved}".format(
+                    **url_normalizer.get_stats()
+                )
+            )
 
     def __getstate__(self):
         return {}
@@ -698,8 +944,10 @@ class CrawlerStart(SpecialTask):
             if isinstance(task, Request):
                 if not task.callbacks:
                     task.add_callback(self.crawler.parse)
+                await self.crawler.wait_for_room(task)
                 await self.crawler.add_task(task)
             elif isinstance(task, Task):
+                await self.crawler.wait_for_room(task)
                 await self.crawler.add_task(task)
 
 
@@ -4,15 +4,18 @@ import inspect
 import json
 import logging
 import time
+from pathlib import Path
 from typing import Callable
 
-from aiohttp import ClientSession, DummyCookieJar, TCPConnector
+from aiohttp import ClientError, ClientSession, DummyCookieJar, TCPConnector
+from yarl import URL
 
 
-from acrawler.counter import RedisCounter
-from acrawler.exceptions import ResponseStatusError
+from acrawler.counter import BufferedRedisCounter, RedisCounter
+from acrawler.exceptions import ResponseStatusError, SkipTaskImmediatelyError
 from acrawler.http import Request
 from acrawler.middleware import Handler
+from acrawler.scheduler import HostPQ
 from acrawler.utils import check_import
 
 # typing
@@ -101,26 +104,248 @@ class ResponseCheckStatus(Handler):
                 raise ResponseStatusError(status)
 
 
+class _HostThrottle:
+    __slots__ = ("window", "delay", "min_delay", "max_window", "latency", "baseline")
+
+    def __init__(self, window, delay, max_window):
+        self.window = window
+        self.delay = self.min_delay = delay
+        self.max_window = max_window
+        self.latency = None
+        self.baseline = None
+
+
+class RequestAutoThrottle(Handler):
+    """Adapts the concurrency limit and the delay of each host (AIMD):
+
+    - a 429 or 503 response, a timeout or a connection error halves the window of
+      concurrent requests to the host and doubles its delay, or waits for its
+      `Retry-After` header.
+    - while the host's smoothed latency stays within twice its recent fastest one,
+      each response grows its window by `1 / window` and shortens its delay. Past
+      that, the window shrinks slowly.
+
+    Configured limits stay in force: the window never exceeds the host's
+    `max_requests` rule or `MAX_REQUESTS_PER_HOST`, and the delay never gets
+    shorter than the host's `delay` rule or `DOWNLOAD_DELAY`. Subdomains sharing a
+    `max_requests` rule share one window and delay.
+
+    Limits are applied by :class:`~acrawler.scheduler.HostPQ`, so `HOST_PARTITION`
+    is needed. Enabled by `AUTOTHROTTLE`.
+    """
+
+    family = "Request"
+    backoff_status = (429, 503)
+    latency_ratio = 2
+
+    async def on_start(self):
+        self.enabled = self.crawler.config.get("AUTOTHROTTLE", False)
+        if not self.enabled:
+            return
+        self.q = self.crawler.sdl_req.q
+        if not isinstance(self.q, HostPQ):
+            logger.warning("AUTOTHROTTLE needs HOST_PARTITION, it is disabled.")
+            self.enabled = False
+            return
+        config = self.crawler.config
+        self.start_window = config.get("AUTOTHROTTLE_START_CONCURRENCY", 2)
+        self.max_window = config.get("AUTOTHROTTLE_MAX_CONCURRENCY", 8)
+        self.max_delay = config.get("AUTOTHROTTLE_MAX_DELAY", 60)
+        self.max_per_host = self.q.max_per_host
+        self.hosts = {}
+        # hosts without a response yet
+        self.q.max_per_host = self._cap(self.start_window, self.max_per_host)
+
+    async def handle_after(self, request: _Request):
+        if not self.enabled:
+            return
+        # one state per sub-queue, subdomains may share a limit
+        key = self.q.get_host_key(request.url.host)
+        state = self.hosts.get(key)
+        if state is None:
+            state = self.hosts[key] = self._new_state(key)
+        response = request.response
+        errors = (asyncio.TimeoutError, ClientError)
+        if any(isinstance(e, errors) for e in request.exceptions):
+            self._backoff(state)
+        elif response is not None and response.status in self.backoff_status:
+            self._backoff(state, response.headers.get("Retry-After"))
+        elif request.latency is not None:
+            self._grow(state, request.latency)
+        else:
+            return
+        self.q.set_host_limit(key, int(state.window), state.delay)
+
+    def _cap(self, window, limit):
+        return min(window, limit) if limit else window
+
+    def _new_state(self, key):
+        # configured limit and delay of the sub-queue are the bounds of its state
+        pattern, limit = self.q.rules.find(key, "max_requests")
+        if pattern is None:
+            limit = self.max_per_host
+        max_window = self._cap(self.max_window, limit)
+        delay = self.q.rules.get(key, "delay", self.q.delay)
+        window = self._cap(self.start_window, max_window)
+        return _HostThrottle(window, delay, max_window)
+
+    def _backoff(self, state, retry_after=None):
+        state.window = max(1.0, state.window / 2)
+        delay = max(state.delay * 2, 0.5)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        state.delay = max(state.min_delay, min(self.max_delay, delay))
+
+    def _grow(self, state, latency):
+        if state.latency is None:
+            state.latency = state.baseline = latency
+        state.latency = 0.8 * state.latency + 0.2 * latency
+        # the baseline drifts up slowly in case the host got slower for good
+        state.baseline = min(state.baseline * 1.01, latency)
+        if state.latency <= state.baseline * self.latency_ratio:
+            state.window = min(state.max_window, state.window + 1 / state.window)
+            delay = state.delay * 0.8 if state.delay > 0.01 else 0
+            state.delay = max(state.min_delay, delay)
+        else:
+            state.window = max(1.0, state.window * 0.9)
+
+    def get_stats(self) -> dict:
+        """Returns `{host: (window, delay, smoothed latency)}`, keyed like
+        :meth:`~acrawler.scheduler.HostPQ.get_host_stats`."""
+        return {
+            key: (int(state.window), state.delay, state.latency)
+            for key, state in self.hosts.items()
+        }
+
+
 class RequestMergeConfig(Handler):
     """(before execution) merge `config` to :attr:`Request.request_config`."""
 
     family = "Request"
 
     def handle_before(self, request: _Request):
+        rules = self.crawler.host_rules
         h0 = self.crawler.request_config.get("headers", {})
         h1 = request.request_config.get("headers", {})
-        h = {**h0, **h1}
+        hh = rules.get(request.url.host, "headers", {}) if rules else {}
+        h = {**h0, **hh, **h1}
         request.request_config = {
             **self.crawler.request_config,
             **request.request_config,
         }
         if h:
             request.request_config["headers"] = h
+        if rules and "proxy" not in request.request_config:
+            proxy = rules.get(request.url.host, "proxy")
+            if proxy:
+                request.request_config["proxy"] = proxy
+
+
+class RequestRedirectFilter(Handler):
+    """Remembers permanent redirects (301 and 308) so that later requests to a
+    redirecting url go to its target directly, or are skipped if the target was
+    already requested.
+
+    The map is kept in redis with distributed support (loaded on start and written
+    through), or in a file with `PERSISTENT`. Urls are only rewritten within the
+    same host so that host limits are released correctly.
+    """
+
+    family = "Request"
+    max_hops = 5
+
+    async def on_start(self):
+        self.enabled = self.crawler.config.get("REDIRECT_FILTER", True)
+        self.df = self.crawler.sdl_req.df
+        self.redirects = {}
+        self.redis = None
+        self.path = None
+        if self.crawler.redis_enable:
+            self.redis = self.crawler.redis
+            self.key = "acrawler:" + self.crawler.name + ":redirects"
+            self.redirects = {
+                fp.decode(): url.decode()
+                for fp, url in (await self.redis.hgetall(self.key)).items()
+            }
+        elif self.crawler.persistent:
+            tag = (
+                self.crawler.config.get("PERSISTENT_NAME", None)
+                or ".acrawler." + self.crawler.name
+            )
+            self.path = Path.cwd() / (tag + ".redirects")
+            if self.path.exists():
+                self.redirects = json.loads(self.path.read_text())
+
+    async def handle_before(self, request: _Request):
+        if not self.enabled or request.dont_filter or not self.redirects:
+            return
+        original = request.url
+        target = None
+        for _ in range(self.max_hops):
+            url = self.redirects.get(request.fingerprint)
+            if url is None:
+                break
+            target = URL(url, encoded=True)
+            if target.host != original.host:
+                break
+            request.url = target
+        if target is None:
+            return
+        final = Request(target, method=request.method)
+        if request.url == target:
+            seen = await self.df.seen(final)
+        else:
+            # the redirect is followed and recorded by ResponseRedirectFilter
+            seen = await self.df.has_fp(final.fingerprint)
+        if seen:
+            request.url = original
+            logger.debug(f"Skip {request}: redirects to {target}, already requested")
+            raise SkipTaskImmediatelyError()
+
+    async def handle_after(self, request: _Request):
+        response = request.response
+        if not self.enabled or not response or not response.history:
+            return
+        targets = [url for _, url in response.history[1:]] + [response.url]
+        new = {}
+        for (status, url), target in zip(response.history, targets):
+            if status in (301, 308):
+                new[Request(url, method=request.method).fingerprint] = str(target)
+        if new:
+            self.redirects.update(new)
+            if self.redis:
+                await self.redis.hmset_dict(self.key, new)
+
+    async def on_close(self):
+        if self.path and self.redirects:
+            self.path.write_text(json.dumps(self.redirects))
 
 
 # Response Part
 
 
+class ResponseRedirectFilter(Handler):
+    """Skips a response reached through redirects if its final url was already
+    requested, so that pages many urls redirect to are parsed once. The final url
+    is recorded by the request dupefilter.
+    """
+
+    family = "Response"
+
+    async def on_start(self):
+        self.enabled = self.crawler.config.get("REDIRECT_FILTER", True)
+        self.df = self.crawler.sdl_req.df
+
+    async def handle_before(self, response: _Response):
+        request = response.request
+        if not self.enabled or not response.history or request.dont_filter:
+            return
+        final = Request(response.url, method=request.method)
+        if final.fingerprint != request.fingerprint and await self.df.seen(final):
+            logger.debug(f"Skip {response}: {response.url} already requested")
+            raise SkipTaskImmediatelyError()
+
+
 class ResponseAddCallback(Handler):
     """(before execution) add :meth:`Parser.parse` to :attr:`Response.callbacks`."""
 
@@ -267,7 +492,16 @@ class CrawlerStartAddon(Handler):
                 address=self.crawler.config.get("REDIS_ADDRESS")
             )
             self.crawler.redis = self.redis
-            self.crawler.counter = RedisCounter(self.crawler)
+            config = self.crawler.config
+            interval = config.get("REDIS_COUNTER_FLUSH_INTERVAL", 0)
+            if interval:
+                self.crawler.counter = BufferedRedisCounter(
+                    self.crawler,
+                    flush_interval=interval,
+                    flush_size=config.get("REDIS_COUNTER_FLUSH_SIZE", 1000),
+                )
+            else:
+                self.crawler.counter = RedisCounter(self.crawler)
             self.crawler.counter.redis = self.redis
 
         if self.do_web:
@@ -287,12 +521,14 @@ class CrawlerStartAddon(Handler):
                 if url:
                     url = url.decode()
                     task = Request(url, callback=self.crawler.parse)
+                    await self.crawler.wait_for_room(task)
                     await self.crawler.add_task(task)
                     await asyncio.sleep(0)
                 else:
                     await asyncio.sleep(0.5)
 
     async def on_close(self):
+        await self.crawler.counter.close()
         if self.do_web:
             await self.web_runner.cleanup()
 
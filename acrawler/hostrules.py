@@ -0,0 +1,112 @@
+"""
+This module provides an index of per-host settings.
+
+A rule of pattern ``example.com`` applies to ``example.com`` and its subdomains
+like ``www.example.com``. When several rules apply, the most specific one wins for
+each setting. Patterns are stored in a trie of reversed domain labels, so finding
+the rules of a host takes one step per label whatever the number of rules, and
+results are cached per host.
+"""
+
+# Typing
+from typing import Any, List, Tuple
+
+_RULE = ""  # domain labels are never empty
+
+
+class HostRules:
+    """An index of `{pattern: rule}`, a rule being a dictionary of settings such as
+    ``{"max_requests": 2, "delay": 1, "rate": (5, 10), "headers": {...},
+    "proxy": "http://..."}``.
+
+    :param rules: `{pattern: rule}` to index.
+    :param cache_size: max number of hosts whose rules are cached.
+    """
+
+    def __init__(self, rules: dict = None, cache_size: int = 100000):
+        self.rules = {}
+        self.cache_size = cache_size
+        self._trie = {}
+        self._cache = {}
+        for pattern, rule in (rules or {}).items():
+            self.add(pattern, rule)
+
+    @classmethod
+    def from_config(cls, config: dict) -> "HostRules":
+        """Builds the index from `HOST_RULES` and the older per-host settings
+        `MAX_REQUESTS_SPECIAL_HOST`, `DOWNLOAD_DELAY_SPECIAL_HOST` and
+        `DOWNLOAD_RATE_SPECIAL_HOST`.
+        """
+        return cls.from_settings(
+            config.get("MAX_REQUESTS_SPECIAL_HOST"),
+            config.get("DOWNLOAD_DELAY_SPECIAL_HOST"),
+            config.get("DOWNLOAD_RATE_SPECIAL_HOST"),
+            config.get("HOST_RULES"),
+        )
+
+    @classmethod
+    def from_settings(
+        cls,
+        max_requests: dict = None,
+        delay: dict = None,
+        rate: dict = None,
+        rules: dict = None,
+    ) -> "HostRules":
+        merged = {}
+        for name, values in (
+            ("max_requests", max_requests),
+            ("delay", delay),
+            ("rate", rate),
+        ):
+            for pattern, value in (values or {}).items():
+                merged.setdefault(pattern, {})[name] = value
+        for pattern, rule in (rules or {}).items():
+            merged.setdefault(pattern, {}).update(rule)
+        return cls(merged)
+
+    def add(self, pattern: str, rule: Any):
+        """Adds a rule, or replaces the rule of the same pattern."""
+        pattern = pattern.strip(".").lower()
+        node = self._trie
+        for label in reversed(pattern.split(".")):
+            node = node.setdefault(label, {})
+        node[_RULE] = (pattern, rule)
+        self.rules[pattern] = rule
+        self._cache = {}
+
+    def match(self, host: str) -> List[Tuple[str, Any]]:
+        """Returns `[(pattern, rule)]` of the rules applying to `host`, the most
+        specific first."""
+        matched = self._cache.get(host)
+        if matched is None:
+            matched = []
+            node = self._trie
+            for label in reversed((host or "").lower().split(".")):
+                node = node.get(label)
+                if node is None:
+                    break
+                if _RULE in node:
+                    matched.append(node[_RULE])
+            matched.reverse()
+            if len(self._cache) >= self.cache_size:
+                self._cache = {}
+            self._cache[host] = matched
+        return matched
+
+    def find(self, host: str, name: str, default=None) -> Tuple[str, Any]:
+        """Returns `(pattern, value)` of the most specific rule of `host` that sets
+        `name`, or `(None, default)`."""
+        for pattern, rule in self.match(host):
+            if name in rule:
+                return pattern, rule[name]
+        return None, default
+
+    def get(self, host: str, name: str, default=None):
+        """Returns the value of setting `name` for `host`."""
+        return self.find(host, name, default)[1]
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
@@ -1,19 +1,23 @@
 import hashlib
 import json
 import logging
+import time
 from pathlib import Path
 from typing import AsyncGenerator, Callable, Iterable, List, Union
 from urllib.parse import urljoin
 import traceback
+from collections import OrderedDict
 
 import aiohttp
 from multidict import CIMultiDict
 from parselx import SelectorX
 from yarl import URL
 
+from acrawler.normalizer import canonicalize_url, url_normalizer
 from acrawler.task import Task
 from acrawler.utils import (
     check_import,
+    compact_fingerprint,
     make_text_links_absolute,
     open_html,
     to_asyncgen,
@@ -31,6 +35,34 @@ _LooseURL = Union[URL, str]
 
 logger = logging.getLogger(__name__)
 
+_LINK_CACHE_SIZE = 10000
+_link_fps = OrderedDict()
+
+
+def request_fingerprint(canonical: str, method: str) -> str:
+    """Fingerprint of a request from its canonical url string and method."""
+    fp = hashlib.sha1()
+    fp.update(canonical.encode())
+    fp.update(method.encode())
+    return fp.hexdigest()
+
+
+def link_fingerprint(url: str, method: str = "GET") -> str:
+    """Returns the fingerprint a :class:`Request` for `url` would have (unless its
+    family has a key function), without building the request. Recent results are
+    cached since pages of a site link to the same urls again and again.
+    """
+    key = (url, method, url_normalizer.version)
+    fp = _link_fps.get(key)
+    if fp is None:
+        fp = request_fingerprint(url_normalizer.canonicalize_link(URL(url))[0], method)
+        _link_fps[key] = fp
+        if len(_link_fps) > _LINK_CACHE_SIZE:
+            _link_fps.popitem(last=False)
+    else:
+        _link_fps.move_to_end(key)
+    return fp
+
 
 class Request(Task):
     """Request is a Task that execute :meth:`fetch` method.
@@ -111,6 +143,7 @@ class Request(Task):
         self.links_to_abs = links_to_abs
 
         self.inprogress = False  # is this request start execution; for counter
+        self.latency = None  # seconds to fetch the response, set by fetch
 
     @property
     def url_str(self):
@@ -118,12 +151,19 @@ class Request(Task):
 
     @property
     def url_str_canonicalized(self):
-        query_str = "&".join(sorted(self.url.raw_query_string.split("&")))
-        return (
-            str(self.url)
-            .replace(self.url.raw_query_string, query_str)
-            .replace("#" + self.url.raw_fragment, "")
-        )
+        return canonicalize_url(self.url)
+
+    @property
+    def url_str_normalized(self):
+        """The url string this request is deduplicated by, see
+        :mod:`acrawler.normalizer`."""
+        return url_normalizer.canonicalize(self)[0]
+
+    @property
+    def url_normalized(self) -> bool:
+        """True if URL normalization changed the url this request is
+        deduplicated by."""
+        return self._fingerprints()[2]
 
     def add_callback(self, func: _Function):
         if isinstance(func, Iterable):
@@ -139,10 +179,23 @@ class Request(Task):
         """fingerprint for a request task.
         .. todo::write a better hashing function for request.
         """
-        fp = hashlib.sha1()
-        fp.update(self.url_str_canonicalized.encode())
-        fp.update(self.method.encode())
-        return fp.hexdigest()
+        return self._fingerprints()[0]
+
+    @property
+    def compact_fingerprint(self) -> int:
+        return self._fingerprints()[1]
+
+    def _fingerprints(self):
+        # computed once and cached until url, method or normalization rules change
+        key = (self.url, self.method, url_normalizer.version)
+        cached = self.__dict__.get("_fp_cache")
+        if cached is None or cached[0] != key:
+            canonical, changed = url_normalizer.canonicalize(self)
+            if changed:
+                url_normalizer.rewritten += 1
+            fp = request_fingerprint(canonical, self.method)
+            cached = self._fp_cache = (key, (fp, compact_fingerprint(fp), changed))
+        return cached[1]
 
     async def _execute(self, **kwargs):
         """Wraps :meth:`fetch`"""
@@ -164,12 +217,15 @@ class Request(Task):
         if self.session is None:
             self.session = aiohttp.ClientSession()
             to_close = True
+        self.latency = None
+        start = time.monotonic()
         try:
             async with self.session.request(
                 self.method, self.url, **self.request_config
             ) as cresp:
 
                 body = await cresp.read()
+                self.latency = time.monotonic() - start
                 encoding = self.encoding or cresp.get_encoding()
 
                 self.response = Response(
@@ -182,6 +238,7 @@ class Request(Task):
                     links_to_abs=self.links_to_abs,
                     callbacks=self.callbacks.copy(),
                     request=self,
+                    history=[(h.status, h.url) for h in cresp.history],
                     family=self.family_for_response,
                 )
                 rt = self.response
@@ -200,6 +257,7 @@ class Request(Task):
         state = super().__getstate__()
         state.pop("session", None)
         state.pop("client", None)
+        state.pop("_fp_cache", None)
         if 'exceptions' in state:
             state['exceptions'] = []
         return state
@@ -223,7 +281,8 @@ class Response(Task):
         ok: True if `status==200` or status is allowed from :attr:`Request.status_allowed`
         cookies: HTTP cookies of response (Set-Cookie HTTP header).
         headers: A case-insensitive multidict proxy with HTTP headers of response.
-        history: Preceding requests (earliest request first) if there were redirects.
+        history: (status, url) of preceding responses (earliest first) if there were
+            redirects.
         body: The whole response’s body as `bytes`.
         text: Read response’s body and return decoded `str`
         request: Point to the corresponding request object that generates this response.
@@ -241,6 +300,7 @@ class Response(Task):
         encoding: str,
         links_to_abs: bool = False,
         callbacks: _Functions = None,
+        history: list = None,
         **kwargs,
     ):
         dont_filter = kwargs.pop("dont_filter", True)
@@ -259,6 +319,7 @@ class Response(Task):
         self.links_to_abs = links_to_abs
         self.request = request
         self.callbacks = callbacks
+        self.history = history or []
         self.bind_cbs = False
 
         self._text_raw = None
@@ -384,6 +445,26 @@ class Response(Task):
             raise ValueError("urljoin receive bad argument{}".format(a))
         return urljoin(self.url_str, url)
 
+    def unseen_links(self, urls: list, dont_filter=False, method="GET"):
+        """ Yields the urls (skipping empty ones) that the crawler's request dupefilter
+        doesn't already know, without building requests for the others. Duplicates
+        within `urls` are yielded once. Dupefilters that need a round-trip can't
+        tell in advance, their requests are checked when added as usual.
+        """
+        df = getattr(self.crawler, "sdl_req", None) and self.crawler.sdl_req.df
+        if not df or dont_filter or url_normalizer.family_keys:
+            yield from (url for url in urls if url)
+            return
+        fps = set()
+        for url in urls:
+            if not url:
+                continue
+            fp = link_fingerprint(url, method)
+            if fp in fps or df.has_fp_nowait(fp):
+                continue
+            fps.add(fp)
+            yield url
+
     def paginate(self, css: str, limit: int = 0, pass_meta=False, **kwargs):
         """ Follow links and yield requests with same callback functions.
         Additional keyword arguments will be used for constructing requests.
@@ -399,15 +480,14 @@ class Response(Task):
         urls = self.sel.g(css)
         if not isinstance(urls, list):
             urls = [urls]
-        for url in urls:
-            if url:
-                request = Request(url, meta=meta, **kwargs)
-                for cb in self.request.callbacks:
-                    request.add_callback(cb)
-                yield request
-                count += 1
-                if limit and count >= limit:
-                    break
+        for url in self._unseen_links(urls, kwargs):
+            request = Request(url, meta=meta, **kwargs)
+            for cb in self.request.callbacks:
+                request.add_callback(cb)
+            yield request
+            count += 1
+            if limit and count >= limit:
+                break
 
     def follow(self, css, callback=None, limit=0, pass_meta=False, **kwargs):
         """ Yield requests in current page using css selector.
@@ -426,13 +506,19 @@ class Response(Task):
         urls = self.sel.g(css)
         if not isinstance(urls, list):
             urls = [urls]
-        for url in urls:
-            if url:
-                request = Request(url, callback=callback, meta=meta, **kwargs)
-                yield request
-                count += 1
-                if limit and count >= limit:
-                    break
+        for url in self._unseen_links(urls, kwargs):
+            request = Request(url, callback=callback, meta=meta, **kwargs)
+            yield request
+            count += 1
+            if limit and count >= limit:
+                break
+
+    def _unseen_links(self, urls, request_kwargs):
+        return self.unseen_links(
+            urls,
+            dont_filter=request_kwargs.get("dont_filter", False),
+            method=request_kwargs.get("method", "GET"),
+        )
 
     def spawn(self, item, divider=None, pass_meta=True, **kwargs):
         """ Yield items in current page
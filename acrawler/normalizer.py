@@ -0,0 +1,221 @@
+"""
+This module normalizes urls before requests are fingerprinted, so that urls that
+only differ in form (letter case, default port, duplicate slashes, tracking
+parameters...) are taken as the same request by dupefilters.
+
+Rules are off by default: fingerprints stay the same as a sorted query without
+fragment. Changing rules changes fingerprints, so already recorded requests are
+not recognized anymore.
+"""
+
+import re
+from fnmatch import fnmatchcase
+from urllib.parse import quote, unquote, unquote_plus
+
+from yarl import URL
+
+from acrawler.hostrules import HostRules
+
+# Typing
+from typing import Callable, Dict, Tuple
+
+_Request = "acrawler.http.Request"
+
+_PATH_SAFE = "!$&'()*+,;=:@~"
+_QUERY_SAFE = "!$'()*,;:@/?~"
+
+
+class URLNormalizer:
+    """Turns a request into the url string it is deduplicated by.
+
+    Available rules, all disabled unless set to True:
+
+    - ``"lowercase_host"``: lower-case the scheme and the host.
+    - ``"strip_www"``: drop a leading ``www.`` from the host.
+    - ``"default_port"``: drop the port if it is the default one of the scheme.
+    - ``"path"``: resolve ``.`` and ``..`` segments and merge duplicate slashes.
+    - ``"trailing_slash"``: drop the trailing slash of the path.
+    - ``"lowercase_path"``: lower-case the path, for case-insensitive servers.
+    - ``"percent_encoding"``: decode then re-encode the path and the query, so
+      that ``%7E``, ``%7e`` and ``~`` or ``+`` and ``%20`` are the same.
+    - ``"strip_params"``: a list of query parameter names to drop, which may be
+      glob patterns (e.g. ``["utm_*", "sessionid"]``).
+
+    :param rules: rules applied to every url.
+    :param special_hosts: a dictionary of `domain: rules`, merged over `rules` for
+        urls of the domain and its subdomains.
+    :param family_keys: a dictionary of `family: function`. Requests of the family
+        are deduplicated by `str(function(request))` instead of their url, which
+        must not be None.
+    """
+
+    def __init__(
+        self,
+        rules: dict = None,
+        special_hosts: Dict[str, dict] = None,
+        family_keys: Dict[str, Callable] = None,
+    ):
+        self.version = 0
+        self.rewritten = 0
+        """Requests whose url was changed by normalization."""
+        self.saved = 0
+        """Requests dropped as duplicates whose url was changed by normalization,
+        i.e. fetches that normalization may have saved."""
+        self.configure(rules, special_hosts, family_keys)
+
+    def configure(
+        self,
+        rules: dict = None,
+        special_hosts: Dict[str, dict] = None,
+        family_keys: Dict[str, Callable] = None,
+    ):
+        """Replaces all rules. Fingerprints computed before are invalidated."""
+        self._base_rules = rules or {}
+        self.rules = self._compile(self._base_rules)
+        self.special_hosts = HostRules(special_hosts)
+        self._host_rules = {}
+        self.family_keys = family_keys or {}
+        self.version += 1
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.rules or self.special_hosts or self.family_keys)
+
+    def canonicalize(self, request: _Request) -> Tuple[str, bool]:
+        """Returns the url string a request is deduplicated by, and whether
+        normalization changed it.
+        """
+        for family, func in self.family_keys.items():
+            if family in request.families:
+                key = func(request)
+                if key is None:
+                    # would make all such requests duplicates of each other
+                    raise TypeError(
+                        f"URL_NORMALIZATION_FAMILY[{family!r}] returned None "
+                        f"for {request}"
+                    )
+                key = str(key)
+                return key, key != canonicalize_url(request.url)
+        return self.canonicalize_link(request.url)
+
+    def canonicalize_link(self, url: URL) -> Tuple[str, bool]:
+        """Like :meth:`canonicalize` for a url alone, i.e. ignoring family keys."""
+        base = canonicalize_url(url)
+        if not (self.rules or self.special_hosts):
+            return base, False
+        rules = self.rules
+        if self.special_hosts:
+            matched = self.special_hosts.match(url.host)
+            if matched:
+                rules = self._merged_rules(matched)
+        if not rules:
+            return base, False
+        key = self.normalize(url, rules)
+        return key, key != base
+
+    def normalize(self, url: URL, rules: dict = None) -> str:
+        """Returns the canonical form of `url` under `rules` (defaults to the
+        rules given to all hosts).
+        """
+        rules = self.rules if rules is None else rules
+        if rules.get("lowercase_host"):
+            url = url.with_scheme(url.scheme.lower())
+        host = url.raw_host or ""
+        if rules.get("lowercase_host"):
+            host = host.lower()
+        if rules.get("strip_www") and host.startswith("www."):
+            host = host[4:]
+        if host != url.raw_host:
+            url = url.with_host(host)
+        if rules.get("default_port") and url.is_default_port():
+            url = url.with_port(None)
+        query = self._query(url.raw_query_string, rules)
+        # with_path drops the query and the fragment
+        base = str(url.with_path(self._path(url.raw_path, rules), encoded=True))
+        return base + "?" + query if query else base
+
+    def get_stats(self) -> dict:
+        return {"rewritten": self.rewritten, "saved": self.saved}
+
+    def _merged_rules(self, matched):
+        # each rule of the most specific domain wins, e.g. `a.example.com` over
+        # `example.com` over the rules given to all hosts
+        patterns = tuple(pattern for pattern, _ in matched)
+        rules = self._host_rules.get(patterns)
+        if rules is None:
+            merged = dict(self._base_rules)
+            for _, host_rules in reversed(matched):
+                merged.update(host_rules)
+            rules = self._host_rules[patterns] = self._compile(merged)
+        return rules
+
+    def _compile(self, rules):
+        rules = {key: value for key, value in rules.items() if value}
+        if "strip_params" in rules:
+            patterns = [p for p in rules["strip_params"] if _is_glob(p)]
+            names = {p for p in rules["strip_params"] if not _is_glob(p)}
+            rules["_strip_names"] = names
+            rules["_strip_patterns"] = patterns
+        return rules
+
+    def _path(self, path, rules):
+        if rules.get("path"):
+            segments = []
+            for segment in re.sub("/{2,}", "/", path).split("/"):
+                if segment == "..":
+                    if len(segments) > 1:
+                        segments.pop()
+                elif segment != ".":
+                    segments.append(segment)
+            if path.endswith(("/.", "/..")):
+                segments.append("")
+            path = "/".join(segments) or "/"
+        if rules.get("percent_encoding"):
+            path = "/".join(
+                quote(unquote(segment), safe=_PATH_SAFE) for segment in path.split("/")
+            )
+        if rules.get("lowercase_path"):
+            path = path.lower()
+        if rules.get("trailing_slash") and len(path) > 1:
+            path = path.rstrip("/") or "/"
+        return path
+
+    def _query(self, query, rules):
+        pairs = [pair for pair in query.split("&") if pair]
+        if "strip_params" in rules:
+            pairs = [pair for pair in pairs if not self._stripped(pair, rules)]
+        if rules.get("percent_encoding"):
+            pairs = [
+                "=".join(
+                    quote(unquote_plus(part), safe=_QUERY_SAFE)
+                    for part in pair.split("=", 1)
+                )
+                for pair in pairs
+            ]
+        return "&".join(sorted(pairs))
+
+    def _stripped(self, pair, rules):
+        name = unquote_plus(pair.split("=", 1)[0])
+        if name in rules["_strip_names"]:
+            return True
+        return any(fnmatchcase(name, pattern) for pattern in rules["_strip_patterns"])
+
+
+def _is_glob(pattern):
+    return any(c in pattern for c in "*?[")
+
+
+def canonicalize_url(url: URL) -> str:
+    """Returns `url` with its query sorted and without its fragment."""
+    query_str = "&".join(sorted(url.raw_query_string.split("&")))
+    return (
+        str(url)
+        .replace(url.raw_query_string, query_str)
+        .replace("#" + url.raw_fragment, "")
+    )
+
+
+url_normalizer = URLNormalizer()
+"""The normalizer used by :attr:`acrawler.http.Request.fingerprint`. The crawler
+configures it with `URL_NORMALIZATION`, `URL_NORMALIZATION_SPECIAL_HOST` and
+`URL_NORMALIZATION_FAMILY`."""
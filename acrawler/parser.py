@@ -84,18 +84,16 @@ class Parser:
     def parse_links(self, response):
         """Follow new links and yield Request in the response."""
         if self.follow_patterns:
-            for p in self.follow_patterns:
-                pattern = re.compile(p)
-                html = response.text
-                sel = Selector(html)
-                links = [
-                    urllib.parse.urljoin(str(response.url), href)
-                    for href in sel.css("a::attr(href)").getall()
-                ]
-                for link in links:
-                    if pattern.search(link):
-                        rq = Request(link)
-                        yield rq
+            patterns = [re.compile(p) for p in self.follow_patterns]
+            base = str(response.url)
+            links = [
+                urllib.parse.urljoin(base, href)
+                for href in Selector(response.text).css("a::attr(href)").getall()
+            ]
+            links = [link for link in links if any(p.search(link) for p in patterns)]
+            # known links are skipped before requests are built for them
+            for link in response.unseen_links(links):
+                yield Request(link)
 
     def parse_items(self, response):
         """Get items from all selectors in the loader."""
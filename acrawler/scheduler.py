@@ -1,10 +1,24 @@
 import asyncio
+import bisect
+import heapq
+import itertools
 import logging
+import math
+import mmap
+import os
+import random
+import re
+import socket
+import sqlite3
+import struct
 import time
+from array import array
+from collections import OrderedDict, deque
+from hashlib import blake2b
 
-import dill as pickle
-
-from acrawler.utils import check_import
+from acrawler.codec import PickleCodec
+from acrawler.hostrules import HostRules
+from acrawler.utils import check_import, compact_fingerprint
 
 # Typing
 
@@ -13,16 +27,68 @@ _Task = "acrawler.task.Task"
 logger = logging.getLogger(__name__)
 
 
+_SCRIPT_SHAS = {}
+
+
+async def _eval_script(redis, script: str, keys: list, args: list):
+    """Run a Lua script by its cached SHA1, loading it on first use."""
+    sha = _SCRIPT_SHAS.get(script)
+    if sha is not None:
+        try:
+            return await redis.evalsha(sha, keys=keys, args=args)
+        except Exception as e:
+            if "NOSCRIPT" not in str(e):
+                raise e
+    _SCRIPT_SHAS[script] = await redis.script_load(script)
+    return await redis.evalsha(_SCRIPT_SHAS[script], keys=keys, args=args)
+
+
+async def _eval_script_many(redis, script: str, calls: list) -> list:
+    """Run a Lua script once per `(keys, args)` of `calls` in one pipeline."""
+    if script not in _SCRIPT_SHAS:
+        _SCRIPT_SHAS[script] = await redis.script_load(script)
+    for retry in (False, True):
+        pipe = redis.pipeline()
+        for keys, args in calls:
+            pipe.evalsha(_SCRIPT_SHAS[script], keys=keys, args=args)
+        try:
+            return await pipe.execute()
+        except Exception as e:
+            if retry or "NOSCRIPT" not in str(e):
+                raise e
+            _SCRIPT_SHAS[script] = await redis.script_load(script)
+
+
 class BaseDupefilter:
+    persists_itself = False
+    """True if the dupefilter keeps its fingerprints across runs without crawler's
+    help."""
+
     async def start(self):
         pass
 
     async def seen(self, task: _Task) -> bool:
         return False
 
+    async def seen_many(self, tasks: list) -> list:
+        """Checks and records tasks at once. A task is seen if any task before it,
+        in the batch or not, has the same fingerprint.
+
+        Returns:
+            a list of booleans like :meth:`seen` for each task.
+        """
+        return [await self.seen(task) for task in tasks]
+
     async def has_fp(self, fp):
         pass
 
+    def has_fp_nowait(self, fp) -> bool:
+        """Checks a fingerprint from memory only, e.g. to skip known links before
+        building requests for them. False means unknown: the fingerprint may still
+        be recorded, which :meth:`seen` tells.
+        """
+        return False
+
     async def add_fp(self, fp):
         pass
 
@@ -52,6 +118,9 @@ class SetDupefilter(BaseDupefilter):
     async def has_fp(self, fp):
         return fp in self.fingerprints
 
+    def has_fp_nowait(self, fp) -> bool:
+        return fp in self.fingerprints
+
     async def add_fp(self, fp):
         self.fingerprints.add(fp)
 
@@ -62,6 +131,581 @@ class SetDupefilter(BaseDupefilter):
         return len(self.fingerprints)
 
 
+class ExpiringDupefilter(BaseDupefilter):
+    """A Dupefilter that forgets fingerprints after `ttl` seconds, for periodic
+    recrawls.
+
+    Fingerprints are kept in one set per time bucket of `ttl / buckets` seconds
+    and whole buckets are dropped as they get old, so memory is proportional to
+    the active window. A fingerprint is forgotten between `ttl` and
+    `ttl * (1 + 1 / buckets)` seconds after it was recorded. Seeing it again
+    doesn't extend its life.
+
+    :param ttl: seconds a fingerprint is remembered for.
+    :param buckets: number of buckets the window is split into.
+    """
+
+    def __init__(self, ttl: float, buckets: int = 8):
+        self.ttl = ttl
+        self.buckets = buckets
+        self.width = ttl / buckets
+        self._sets = deque()
+
+    def _rotate(self):
+        # keeps the current bucket and the `buckets` ones before it
+        index = int(time.time() // self.width)
+        while self._sets and self._sets[0][0] < index - self.buckets:
+            self._sets.popleft()
+        if not self._sets or self._sets[-1][0] != index:
+            self._sets.append((index, set()))
+
+    async def seen(self, task: _Task) -> bool:
+        fp = task.fingerprint
+        if await self.has_fp(fp):
+            return True
+        self._sets[-1][1].add(fp)
+        return False
+
+    async def has_fp(self, fp):
+        return self.has_fp_nowait(fp)
+
+    def has_fp_nowait(self, fp) -> bool:
+        self._rotate()
+        return any(fp in fps for _, fps in self._sets)
+
+    async def add_fp(self, fp):
+        if not await self.has_fp(fp):
+            self._sets[-1][1].add(fp)
+
+    async def clear(self):
+        self._sets = deque()
+
+    async def get_length(self):
+        self._rotate()
+        return sum(len(fps) for _, fps in self._sets)
+
+
+class CompactDupefilter(BaseDupefilter):
+    """A Dupefilter that stores 64-bit :attr:`~acrawler.task.Task.compact_fingerprint`
+    in an open-addressing hash table backed by :class:`array.array`.
+
+    It takes 8 bytes per slot with the table kept at most half full, instead of a
+    str object per fingerprint in a `set`. Distinct fingerprints colliding on 64
+    bits are taken as duplicates, which is negligible below billions of tasks.
+
+    :param capacity: number of fingerprints to reserve room for.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        size = 8
+        while size < capacity * 2:
+            size *= 2
+        self._table = array("Q", bytes(8 * size))
+        self._mask = size - 1
+        self._count = 0
+
+    async def seen(self, task: _Task) -> bool:
+        return not self._add(task.compact_fingerprint)
+
+    async def has_fp(self, fp):
+        return self._lookup(compact_fingerprint(fp))
+
+    def has_fp_nowait(self, fp) -> bool:
+        return self._lookup(compact_fingerprint(fp))
+
+    async def add_fp(self, fp):
+        return self._add(compact_fingerprint(fp))
+
+    def _lookup(self, key: int) -> bool:
+        table, mask = self._table, self._mask
+        i = key & mask
+        while table[i]:
+            if table[i] == key:
+                return True
+            i = (i + 1) & mask
+        return False
+
+    def _add(self, key: int) -> bool:
+        # returns False if the key is already present
+        table, mask = self._table, self._mask
+        i = key & mask
+        while table[i]:
+            if table[i] == key:
+                return False
+            i = (i + 1) & mask
+        table[i] = key
+        self._count += 1
+        if self._count * 2 > mask:
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self._table
+        self._table = array("Q", bytes(16 * len(old)))
+        self._mask = len(self._table) - 1
+        table, mask = self._table, self._mask
+        for key in old:
+            if key:
+                i = key & mask
+                while table[i]:
+                    i = (i + 1) & mask
+                table[i] = key
+
+    async def clear(self):
+        self.__init__()
+
+    async def get_length(self):
+        return self._count
+
+
+class LogDupefilter(CompactDupefilter):
+    """A :class:`CompactDupefilter` that persists itself in an append-only log.
+
+    New fingerprints are appended to `path` as 8-byte records in batches of
+    `flush_size`, and a timer writes a smaller batch `flush_interval` seconds
+    after its first fingerprint, so a crash loses at most the last batch. Once
+    the log holds `compact_size` records (or a quarter of all fingerprints,
+    whichever is larger), the hash table is written to `path.snap` and the log
+    is truncated. Startup reads the snapshot as is and replays the short log, so
+    neither startup nor shutdown dumps the whole set.
+
+    :param path: path of the log file.
+    :param resume: if True, load the fingerprints left by a former run.
+    :param persistent: if False, the log and its snapshot are deleted on close.
+    """
+
+    persists_itself = True
+
+    _SNAP_HEADER = struct.Struct("<4sQQ")
+    _SNAP_MAGIC = b"ACDF"
+
+    def __init__(
+        self,
+        path,
+        resume: bool = False,
+        flush_size: int = 1000,
+        flush_interval: float = 1,
+        compact_size: int = 100000,
+        persistent: bool = True,
+    ):
+        super().__init__()
+        self.path = str(path)
+        self.snap_path = self.path + ".snap"
+        self.persistent = self.persists_itself = persistent
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.compact_size = compact_size
+        self._pending = array("Q")
+        self._last_flush = time.time()
+        self._timer = None
+        self._logged = 0
+        if resume:
+            self._load()
+        else:
+            self._remove_files()
+        self._log = open(self.path, "ab")
+
+    def _remove_files(self):
+        for path in (self.path, self.snap_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _load(self):
+        if os.path.exists(self.snap_path):
+            with open(self.snap_path, "rb") as f:
+                magic, size, count = self._SNAP_HEADER.unpack(
+                    f.read(self._SNAP_HEADER.size)
+                )
+                if magic != self._SNAP_MAGIC:
+                    raise ValueError(f"{self.snap_path} is not a dupefilter snapshot")
+                table = array("Q")
+                table.fromfile(f, size)
+            self._table, self._mask, self._count = table, size - 1, count
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+            # a crash may leave a partial record at the end
+            data = data[: len(data) - len(data) % 8]
+            records = array("Q")
+            records.frombytes(data)
+            for key in records:
+                super()._add(key)
+            self._logged = len(records)
+
+    def _add(self, key: int) -> bool:
+        if not super()._add(key):
+            return False
+        self._pending.append(key)
+        if (
+            len(self._pending) >= self.flush_size
+            or time.time() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.flush_interval, self.flush
+            )
+        return True
+
+    def flush(self):
+        """Append pending fingerprints to the log, compact it if it is long."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            self._log.write(self._pending.tobytes())
+            self._log.flush()
+            self._logged += len(self._pending)
+            self._pending = array("Q")
+        self._last_flush = time.time()
+        if self._logged >= max(self.compact_size, self._count // 4):
+            self.compact()
+
+    def compact(self):
+        """Write the whole table to the snapshot and truncate the log."""
+        tmp = self.snap_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(
+                self._SNAP_HEADER.pack(self._SNAP_MAGIC, len(self._table), self._count)
+            )
+            self._table.tofile(f)
+        os.replace(tmp, self.snap_path)
+        # records still in the log after a crash here are merely replayed twice
+        self._log.seek(0)
+        self._log.truncate()
+        self._logged = 0
+
+    async def clear(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._log.close()
+        self._remove_files()
+        super().__init__()
+        self._pending = array("Q")
+        self._logged = 0
+        self._log = open(self.path, "ab")
+
+    async def close(self):
+        if self._log.closed:
+            return
+        if self.persistent:
+            self.flush()
+            self._log.close()
+        else:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._log.close()
+            self._remove_files()
+
+
+class CachedDupefilter(BaseDupefilter):
+    """Wraps a (usually remote) dupefilter with a bounded LRU of fingerprints
+    known to be recorded, so repeated links are answered without a round-trip.
+
+    Only positive answers are cached: a fingerprint absent from the cache is
+    always checked by the wrapped dupefilter, which other crawlers may update.
+
+    :param df: the wrapped dupefilter.
+    :param size: max number of cached fingerprints.
+    """
+
+    def __init__(self, df: BaseDupefilter, size: int = 100000):
+        self.df = df
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    @property
+    def persists_itself(self):
+        return self.df.persists_itself
+
+    async def start(self):
+        await self.df.start()
+
+    def _hit(self, key) -> bool:
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def _remember(self, key):
+        self._cache[key] = None
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    async def seen(self, task: _Task) -> bool:
+        key = task.compact_fingerprint
+        if self._hit(key):
+            return True
+        res = await self.df.seen(task)
+        self._remember(key)
+        return res
+
+    async def seen_many(self, tasks: list) -> list:
+        results = [None] * len(tasks)
+        missed = []
+        for i, task in enumerate(tasks):
+            if self._hit(task.compact_fingerprint):
+                results[i] = True
+            else:
+                missed.append(i)
+        if missed:
+            seens = await self.df.seen_many([tasks[i] for i in missed])
+            for i, res in zip(missed, seens):
+                results[i] = res
+                self._remember(tasks[i].compact_fingerprint)
+        return results
+
+    async def has_fp(self, fp):
+        key = compact_fingerprint(fp)
+        if self._hit(key):
+            return True
+        res = await self.df.has_fp(fp)
+        if res:
+            self._remember(key)
+        return res
+
+    def has_fp_nowait(self, fp) -> bool:
+        return compact_fingerprint(fp) in self._cache or self.df.has_fp_nowait(fp)
+
+    async def add_fp(self, fp):
+        res = await self.df.add_fp(fp)
+        self._remember(compact_fingerprint(fp))
+        return res
+
+    def get_stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "cached": len(self._cache),
+        }
+
+    async def clear(self):
+        self._cache.clear()
+        return await self.df.clear()
+
+    async def get_length(self):
+        return await self.df.get_length()
+
+    async def close(self):
+        return await self.df.close()
+
+
+def _fp_hashes(fp):
+    # two independent 64-bit hashes of a fingerprint for double hashing
+    if isinstance(fp, str):
+        data = fp.encode()
+    elif isinstance(fp, bytes):
+        data = fp
+    else:
+        data = str(fp).encode()
+    digest = blake2b(data, digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+class _BloomLayer:
+    """A fixed-size bloom filter stored in a mmap, after a small header."""
+
+    __slots__ = ("mm", "capacity", "count", "bits", "k", "file")
+
+    HEADER = struct.Struct("<4sQQQI")
+    OFFSET = 64
+    MAGIC = b"ACBF"
+
+    def __init__(self, mm, file=None):
+        self.mm = mm
+        self.file = file
+        magic, self.capacity, self.count, self.bits, self.k = self.HEADER.unpack_from(
+            mm
+        )
+        if magic != self.MAGIC:
+            raise ValueError("Not a bloom filter file")
+
+    @classmethod
+    def create(cls, capacity: int, error_rate: float, path=None):
+        bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        k = max(1, round(bits / capacity * math.log(2)))
+        size = cls.OFFSET + (bits + 7) // 8
+        if path:
+            file = open(path, "w+b")
+            file.truncate(size)
+            mm = mmap.mmap(file.fileno(), size)
+        else:
+            file = None
+            mm = mmap.mmap(-1, size)
+        cls.HEADER.pack_into(mm, 0, cls.MAGIC, capacity, 0, bits, k)
+        return cls(mm, file)
+
+    @classmethod
+    def load(cls, path):
+        file = open(path, "r+b")
+        return cls(mmap.mmap(file.fileno(), 0), file)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        mm = mmap.mmap(-1, len(data))
+        mm[:] = data
+        return cls(mm)
+
+    def _probes(self, hashes):
+        # enhanced double hashing
+        bits = self.bits
+        a = hashes[0] % bits
+        b = hashes[1] % bits
+        for i in range(self.k):
+            yield a
+            a = (a + b) % bits
+            b = (b + i + 1) % bits
+
+    def __contains__(self, hashes):
+        mm, offset = self.mm, self.OFFSET
+        for p in self._probes(hashes):
+            if not mm[offset + (p >> 3)] & (1 << (p & 7)):
+                return False
+        return True
+
+    def add(self, hashes):
+        mm, offset = self.mm, self.OFFSET
+        for p in self._probes(hashes):
+            mm[offset + (p >> 3)] |= 1 << (p & 7)
+        self.count += 1
+        struct.pack_into("<Q", mm, 12, self.count)
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def close(self):
+        if self.file:
+            self.mm.flush()
+        self.mm.close()
+        if self.file:
+            self.file.close()
+
+
+class BloomDupefilter(BaseDupefilter):
+    """A Dupefilter that stores fingerprints in a scalable bloom filter.
+
+    Each filter layer is a bit array in a mmap. When a layer holds `capacity`
+    fingerprints a new one twice as large and with a tighter error rate is added,
+    so the overall false positive rate stays below `error_rate`. A task reported
+    as seen by mistake is never crawled.
+
+    With a `path`, layers are memory-mapped files `path.0`, `path.1`, ... that the
+    OS writes back lazily; :meth:`close` only flushes dirty pages. Otherwise they
+    live in anonymous memory and are pickled with the dupefilter.
+
+    :param capacity: fingerprints held by the first layer.
+    :param error_rate: max false positive rate.
+    :param path: prefix of the layer files.
+    :param resume: if True, reuse the layer files left by a former run.
+    """
+
+    _growth = 2
+    _tightening = 0.5
+
+    def __init__(
+        self,
+        capacity: int = 1000000,
+        error_rate: float = 0.001,
+        path=None,
+        resume: bool = False,
+    ):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.path = path
+        self.persists_itself = path is not None
+        self._layers = []
+        if path and resume:
+            while os.path.exists(self._layer_path(len(self._layers))):
+                self._layers.append(
+                    _BloomLayer.load(self._layer_path(len(self._layers)))
+                )
+        if not self._layers:
+            self._clear_files()
+            self._add_layer()
+
+    def _layer_path(self, index):
+        if self.path:
+            return f"{self.path}.{index}"
+        return None
+
+    def _add_layer(self):
+        i = len(self._layers)
+        capacity = self.capacity * self._growth ** i
+        error_rate = self.error_rate * (1 - self._tightening) * self._tightening ** i
+        layer = _BloomLayer.create(capacity, error_rate, self._layer_path(i))
+        self._layers.append(layer)
+
+    def _clear_files(self):
+        i = 0
+        while self.path and os.path.exists(self._layer_path(i)):
+            os.remove(self._layer_path(i))
+            i += 1
+
+    def _contains(self, hashes):
+        for layer in reversed(self._layers):
+            if hashes in layer:
+                return True
+        return False
+
+    def _add(self, hashes):
+        if self._layers[-1].full:
+            self._add_layer()
+        self._layers[-1].add(hashes)
+
+    async def seen(self, task: _Task) -> bool:
+        hashes = _fp_hashes(task.fingerprint)
+        if self._contains(hashes):
+            return True
+        self._add(hashes)
+        return False
+
+    async def has_fp(self, fp):
+        return self._contains(_fp_hashes(fp))
+
+    def has_fp_nowait(self, fp) -> bool:
+        return self._contains(_fp_hashes(fp))
+
+    async def add_fp(self, fp):
+        hashes = _fp_hashes(fp)
+        if not self._contains(hashes):
+            self._add(hashes)
+
+    async def clear(self):
+        for layer in self._layers:
+            layer.close()
+        self._layers = []
+        self._clear_files()
+        self._add_layer()
+
+    async def get_length(self):
+        return sum(layer.count for layer in self._layers)
+
+    async def close(self):
+        # memory-mapped files are kept for the next run
+        if self.path:
+            for layer in self._layers:
+                layer.mm.flush()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_layers"] = [bytes(layer.mm) for layer in self._layers]
+        return state
+
+    def __setstate__(self, state):
+        state["_layers"] = [_BloomLayer.from_bytes(data) for data in state["_layers"]]
+        self.__dict__.update(state)
+
+
 class RedisDupefilter(BaseDupefilter):
     def __init__(self, address="redis://localhost", df_key="acrawler:df"):
         self.address = address
@@ -76,6 +720,12 @@ class RedisDupefilter(BaseDupefilter):
         fp = task.fingerprint
         return await self.add_fp(fp) == 0
 
+    async def seen_many(self, tasks: list) -> list:
+        pipe = self.redis.pipeline()
+        for task in tasks:
+            pipe.sadd(self.df_key, task.fingerprint)
+        return [added == 0 for added in await pipe.execute()]
+
     async def add_fp(self, fp):
         return await self.redis.sadd(self.df_key, fp)
 
@@ -93,13 +743,175 @@ class RedisDupefilter(BaseDupefilter):
         return await self.redis.wait_closed()
 
 
+_BLOOM_SCRIPT = """
+for i = 2, #ARGV do
+    if redis.call('GETBIT', KEYS[1], ARGV[i]) == 0 then
+        if ARGV[1] == '0' then
+            return 0
+        end
+        for j = i, #ARGV do
+            redis.call('SETBIT', KEYS[1], ARGV[j], 1)
+        end
+        redis.call('INCR', KEYS[2])
+        return 0
+    end
+end
+return 1
+"""
+
+
+class RedisBloomDupefilter(RedisDupefilter):
+    """A distributed Dupefilter that stores fingerprints in a partitioned bloom
+    filter on a plain redis bitmap, without redis modules.
+
+    The bitmap is split in `k` slices and every fingerprint sets one bit in each
+    slice. Bits are checked and set atomically by a Lua script. The filter
+    doesn't grow: beyond `capacity` fingerprints its false positive rate rises
+    above `error_rate`.
+
+    :param capacity: expected number of fingerprints.
+    :param error_rate: false positive rate at `capacity`.
+    """
+
+    def __init__(
+        self,
+        address="redis://localhost",
+        df_key="acrawler:df",
+        capacity: int = 100000000,
+        error_rate: float = 0.001,
+    ):
+        super().__init__(address, df_key)
+        self.count_key = df_key + ":count"
+        self.k = max(1, math.ceil(-math.log2(error_rate)))
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.slice_bits = math.ceil(bits / self.k)
+        if self.slice_bits * self.k > 2 ** 32:
+            raise ValueError("Bloom filter exceeds the 512MB limit of redis strings")
+
+    def _offsets(self, fp) -> list:
+        h1, h2 = _fp_hashes(fp)
+        size = self.slice_bits
+        return [i * size + (h1 + i * h2) % size for i in range(self.k)]
+
+    async def seen(self, task: _Task):
+        return await self._run(task.fingerprint, add=True)
+
+    async def add_fp(self, fp):
+        return not await self._run(fp, add=True)
+
+    async def has_fp(self, fp):
+        return await self._run(fp, add=False)
+
+    async def seen_many(self, tasks: list) -> list:
+        calls = [
+            ([self.df_key, self.count_key], ["1"] + self._offsets(task.fingerprint))
+            for task in tasks
+        ]
+        results = await _eval_script_many(self.redis, _BLOOM_SCRIPT, calls)
+        return [res == 1 for res in results]
+
+    async def _run(self, fp, add: bool) -> bool:
+        res = await _eval_script(
+            self.redis,
+            _BLOOM_SCRIPT,
+            keys=[self.df_key, self.count_key],
+            args=["1" if add else "0"] + self._offsets(fp),
+        )
+        return res == 1
+
+    async def clear(self):
+        return await self.redis.delete(self.df_key, self.count_key)
+
+    async def get_length(self):
+        return int(await self.redis.get(self.count_key) or 0)
+
+
+_EXPIRING_SCRIPT = """
+for i = 1, #KEYS do
+    if redis.call('SISMEMBER', KEYS[i], ARGV[1]) == 1 then
+        return 1
+    end
+end
+if ARGV[2] == '1' then
+    redis.call('SADD', KEYS[1], ARGV[1])
+    redis.call('EXPIREAT', KEYS[1], ARGV[3])
+end
+return 0
+"""
+
+
+class RedisExpiringDupefilter(RedisDupefilter):
+    """A distributed :class:`ExpiringDupefilter`. Each time bucket is a redis set
+    `df_key:<bucket>` that redis deletes once it gets old.
+
+    :param ttl: seconds a fingerprint is remembered for.
+    :param buckets: number of buckets the window is split into.
+    """
+
+    def __init__(
+        self,
+        address="redis://localhost",
+        df_key="acrawler:df",
+        ttl: float = 86400,
+        buckets: int = 8,
+    ):
+        super().__init__(address, df_key)
+        self.ttl = ttl
+        self.buckets = buckets
+        self.width = ttl / buckets
+
+    def _call(self, fp, add: bool):
+        # keys from the current bucket to the oldest one alive
+        index = int(time.time() // self.width)
+        keys = [
+            f"{self.df_key}:{i}" for i in range(index, index - self.buckets - 1, -1)
+        ]
+        expire_at = math.ceil((index + self.buckets + 1) * self.width)
+        return keys, [fp, "1" if add else "0", expire_at]
+
+    async def seen(self, task: _Task):
+        keys, args = self._call(task.fingerprint, add=True)
+        return await _eval_script(self.redis, _EXPIRING_SCRIPT, keys, args) == 1
+
+    async def seen_many(self, tasks: list) -> list:
+        calls = [self._call(task.fingerprint, add=True) for task in tasks]
+        results = await _eval_script_many(self.redis, _EXPIRING_SCRIPT, calls)
+        return [res == 1 for res in results]
+
+    async def add_fp(self, fp):
+        keys, args = self._call(fp, add=True)
+        return await _eval_script(self.redis, _EXPIRING_SCRIPT, keys, args) == 0
+
+    async def has_fp(self, fp):
+        keys, args = self._call(fp, add=False)
+        return await _eval_script(self.redis, _EXPIRING_SCRIPT, keys, args) == 1
+
+    async def clear(self):
+        keys, _ = self._call(None, add=False)
+        return await self.redis.delete(*keys)
+
+    async def get_length(self):
+        keys, _ = self._call(None, add=False)
+        return sum([await self.redis.scard(key) for key in keys])
+
+
 class BaseQueue:
+    persists_itself = False
+    """True if the queue keeps its tasks across runs without crawler's help."""
+
+    def __init__(self, codec: PickleCodec = None):
+        self.codec = codec or PickleCodec()
+
     async def start(self):
         pass
 
     async def push(self, task):
         raise NotImplementedError
 
+    async def push_many(self, tasks: list):
+        for task in tasks:
+            await self.push(task)
+
     async def pop(self):
         raise NotImplementedError
 
@@ -109,16 +921,26 @@ class BaseQueue:
     async def clear(self):
         raise NotImplementedError
 
+    def drain_nowait(self) -> list:
+        """Remove and return all tasks stored locally, used for persistence."""
+        raise NotImplementedError
+
+    def release(self, task):
+        """Called when a popped task finishes its execution."""
+        pass
+
+    async def task_done(self, task):
+        """Called when the outcome of a popped task has been recorded."""
+        pass
+
     async def close(self):
         pass
 
-    @staticmethod
-    def serialize(task):
-        return pickle.dumps(task)
+    def serialize(self, task) -> bytes:
+        return self.codec.encode(task)
 
-    @staticmethod
-    def deserialize(message) -> _Task:
-        return pickle.loads(message)
+    def deserialize(self, message) -> _Task:
+        return self.codec.decode(message)
 
 
 class AsyncPQ(BaseQueue):
@@ -159,6 +981,16 @@ class AsyncPQ(BaseQueue):
             except asyncio.QueueEmpty:
                 break
 
+    def drain_nowait(self):
+        tasks = []
+        for q in (self.pq, self.waiting):
+            while 1:
+                try:
+                    tasks.append(q.get_nowait()[1])
+                except asyncio.QueueEmpty:
+                    break
+        return tasks
+
     async def get_length(self):
         return self.pq.qsize() + self.waiting.qsize()
 
@@ -175,64 +1007,822 @@ class AsyncPQ(BaseQueue):
         self.waiting = asyncio.PriorityQueue()
 
 
-class RedisPQ(BaseQueue):
-    def __init__(self, address="redis://localhost", q_key="acrawler:queue"):
+class HeapPQ(BaseQueue):
+    """An event-driven Priority Queue built directly on :mod:`heapq`.
+
+    Tasks whose :attr:`~acrawler.task.Task.exetime` has come are kept in a ready
+    heap ordered by score, others in a waiting heap ordered by exetime. Blocked
+    consumers are woken as soon as a task is pushed, and a single loop timer is
+    armed for the earliest exetime in the waiting heap instead of polling.
+    """
+
+    def __init__(self):
         super().__init__()
+        self._ready = []
+        self._waiting = []
+        self._seq = itertools.count()
+        self._getters = []
+        self._timer = None
+        self._timer_when = None
+
+    async def push(self, task: _Task):
+        return self.push_nowait(task)
+
+    async def push_many(self, tasks: list):
+        for task in tasks:
+            self.push_nowait(task)
+
+    def push_nowait(self, task: _Task):
+        if task.exetime <= time.time():
+            self._push_ready(task)
+            self._wakeup_next()
+        else:
+            heapq.heappush(self._waiting, (task.exetime, next(self._seq), task))
+            if self._getters:
+                self._arm_timer()
+
+    async def pop(self):
+        while True:
+            self.transfer_waiting()
+            task = self._pop_ready()
+            if task is not None:
+                if self._has_ready():
+                    self._wakeup_next()
+                return task
+
+            getter = asyncio.get_event_loop().create_future()
+            self._getters.append(getter)
+            self._arm_timer()
+            try:
+                await getter
+            except asyncio.CancelledError:
+                if getter in self._getters:
+                    self._getters.remove(getter)
+                elif getter.done() and not getter.cancelled() and self._has_ready():
+                    # we were woken but will not consume, pass it on
+                    self._wakeup_next()
+                raise
+
+    def transfer_waiting(self):
+        """Transfer all prepared task from waiting heap to ready heap."""
+        now = time.time()
+        while self._waiting and self._waiting[0][0] <= now:
+            task = heapq.heappop(self._waiting)[2]
+            self._push_ready(task)
+
+    def drain_nowait(self):
+        tasks = [item[-1] for item in self._ready]
+        tasks.extend(item[-1] for item in self._waiting)
+        self._ready = []
+        self._waiting = []
+        return tasks
+
+    async def get_length(self):
+        return self._len_ready() + len(self._waiting)
+
+    async def get_length_of_pq(self):
+        self.transfer_waiting()
+        return self._len_ready()
+
+    async def get_length_of_waiting(self):
+        self.transfer_waiting()
+        return len(self._waiting)
+
+    async def clear(self):
+        self._ready = []
+        self._waiting = []
+
+    async def close(self):
+        self._cancel_timer()
+
+    def _push_ready(self, task: _Task):
+        heapq.heappush(self._ready, (-task.score, next(self._seq), task))
+
+    def _pop_ready(self):
+        if self._ready:
+            return heapq.heappop(self._ready)[2]
+        return None
+
+    def _has_ready(self):
+        return bool(self._ready)
+
+    def _len_ready(self):
+        return len(self._ready)
+
+    def _next_time(self):
+        """Timestamp at which a waiting task becomes ready, None if nothing waits."""
+        if self._waiting:
+            return self._waiting[0][0]
+        return None
+
+    def _wakeup_next(self):
+        while self._getters:
+            getter = self._getters.pop(0)
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    def _arm_timer(self):
+        when = self._next_time()
+        if when is None:
+            return
+        if self._timer is not None:
+            if self._timer_when <= when:
+                return
+            self._timer.cancel()
+        self._timer_when = when
+        self._timer = asyncio.get_event_loop().call_later(
+            max(0, when - time.time()), self._on_timer
+        )
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_when = None
+
+    def _on_timer(self):
+        self._timer = None
+        self._timer_when = None
+        self.transfer_waiting()
+        if self._has_ready():
+            self._wakeup_next()
+        elif self._getters:
+            self._arm_timer()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_getters"] = []
+        state["_timer"] = None
+        state["_timer_when"] = None
+        return state
+
+
+class BucketPQ(HeapPQ):
+    """A Priority Queue that keeps one FIFO deque of ready tasks per priority.
+
+    Non-empty priority levels are kept in a sorted index, so pushing and popping
+    ready tasks don't compare scores. It suits crawls using a few small integer
+    priorities. Tasks of the same priority execute in the order they become
+    ready. Waiting tasks are handled as in :class:`HeapPQ`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._buckets = {}
+        self._levels = []
+        self._ready_count = 0
+
+    def drain_nowait(self):
+        tasks = [task for level in self._levels for task in self._buckets[level]]
+        tasks.extend(item[-1] for item in self._waiting)
+        self._buckets = {}
+        self._levels = []
+        self._ready_count = 0
+        self._waiting = []
+        return tasks
+
+    async def clear(self):
+        await super().clear()
+        self._buckets = {}
+        self._levels = []
+        self._ready_count = 0
+
+    def _push_ready(self, task: _Task):
+        bucket = self._buckets.get(task.priority)
+        if bucket is None:
+            bucket = self._buckets[task.priority] = deque()
+            bisect.insort(self._levels, task.priority)
+        bucket.append(task)
+        self._ready_count += 1
+
+    def _pop_ready(self):
+        if not self._levels:
+            return None
+        level = self._levels[-1]
+        bucket = self._buckets[level]
+        task = bucket.popleft()
+        if not bucket:
+            del self._buckets[level]
+            self._levels.pop()
+        self._ready_count -= 1
+        return task
+
+    def _has_ready(self):
+        return self._ready_count > 0
+
+    def _len_ready(self):
+        return self._ready_count
+
+
+class DiskPQ(HeapPQ):
+    """A Priority Queue that keeps a bounded hot heap in memory and spills
+    other tasks to a SQLite file on local disk.
+
+    Spilled tasks are ordered by score and exetime in the file and are refilled
+    in batches whenever the file holds a task that should run before the head
+    of the hot heap. They are written in batches of `spill_size`, or before the
+    file is read, so that pushes don't wait for the disk one by one.
+
+    :param path: path of the SQLite file.
+    :param max_in_memory: max number of tasks kept in memory.
+    :param refill_size: max number of tasks loaded from disk at once.
+    :param resume: if False, tasks left in the file by a former run are dropped.
+    :param codec: codec to serialize spilled tasks. Defaults to :class:`PickleCodec`.
+    :param spill_size: number of spilled tasks written at once.
+    :param persistent: if False, the file is deleted on close instead of keeping
+        the remaining tasks.
+    """
+
+    persists_itself = True
+
+    def __init__(
+        self,
+        path,
+        max_in_memory: int = 10000,
+        refill_size: int = 1000,
+        resume: bool = False,
+        codec: PickleCodec = None,
+        spill_size: int = 100,
+        persistent: bool = False,
+    ):
+        super().__init__()
+        if codec:
+            self.codec = codec
+        self.path = str(path)
+        self.max_in_memory = max_in_memory
+        self.refill_size = refill_size
+        self.spill_size = spill_size
+        self.persistent = self.persists_itself = persistent
+        self._spilled = []
+        self.db = sqlite3.connect(self.path)
+        # commits don't wait for fsync, the file is a spill area
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks "
+            "(id INTEGER PRIMARY KEY, key REAL, exetime REAL, data BLOB)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_key ON tasks (key)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_exetime ON tasks (exetime)")
+        if not resume:
+            self.db.execute("DELETE FROM tasks")
+        self.db.commit()
+        self._disk_count = self.db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+        self._disk_next_time = self._query_next_time()
+
+    def push_nowait(self, task: _Task):
+        if len(self._ready) + len(self._waiting) < self.max_in_memory:
+            return super().push_nowait(task)
+        self._spill([task])
+        if task.exetime <= time.time():
+            self._wakeup_next()
+        elif self._getters:
+            self._arm_timer()
+
+    def spill_all(self):
+        """Move every task in memory to disk."""
+        self._spill(super().drain_nowait())
+
+    def drain_nowait(self):
+        tasks = super().drain_nowait()
+        tasks.extend(self._spilled)
+        self._spilled = []
+        rows = self.db.execute("SELECT data FROM tasks").fetchall()
+        tasks.extend(self.deserialize(r[0]) for r in rows)
+        self.db.execute("DELETE FROM tasks")
+        self.db.commit()
+        self._disk_count = 0
+        self._disk_next_time = None
+        return tasks
+
+    def _spill(self, tasks):
+        # tasks count as on disk at once, they are written before the file is read
+        if not tasks:
+            return
+        self._spilled.extend(tasks)
+        self._disk_count += len(tasks)
+        earliest = min(t.exetime for t in tasks)
+        if self._disk_next_time is None or earliest < self._disk_next_time:
+            self._disk_next_time = earliest
+        if len(self._spilled) >= self.spill_size:
+            self._write_spilled()
+
+    def _write_spilled(self):
+        if not self._spilled:
+            return
+        self.db.executemany(
+            "INSERT INTO tasks (key, exetime, data) VALUES (?, ?, ?)",
+            [(-t.score, t.exetime, self.serialize(t)) for t in self._spilled],
+        )
+        self.db.commit()
+        self._spilled = []
+
+    def _query_next_time(self):
+        return self.db.execute("SELECT MIN(exetime) FROM tasks").fetchone()[0]
+
+    def _disk_head_key(self):
+        """Key of the best task on disk that is ready now, None if no such task."""
+        if not self._disk_count or (self._disk_next_time or 0) > time.time():
+            return None
+        self._write_spilled()
+        return self.db.execute(
+            "SELECT MIN(key) FROM tasks WHERE exetime <= ?", (time.time(),)
+        ).fetchone()[0]
+
+    def _refill(self):
+        room = max(self.max_in_memory - len(self._ready) - len(self._waiting), 1)
+        rows = self.db.execute(
+            "SELECT id, data FROM tasks WHERE exetime <= ? ORDER BY key LIMIT ?",
+            (time.time(), min(room, self.refill_size)),
+        ).fetchall()
+        self.db.executemany("DELETE FROM tasks WHERE id = ?", [(r[0],) for r in rows])
+        self.db.commit()
+        self._disk_count -= len(rows)
+        self._disk_next_time = self._query_next_time()
+        for _, data in rows:
+            super()._push_ready(self.deserialize(data))
+
+    def _pop_ready(self):
+        disk_key = self._disk_head_key()
+        if disk_key is not None and (not self._ready or disk_key < self._ready[0][0]):
+            self._refill()
+        return super()._pop_ready()
+
+    def _has_ready(self):
+        return super()._has_ready() or self._disk_head_key() is not None
+
+    def _len_ready(self):
+        self._write_spilled()
+        due = self.db.execute(
+            "SELECT COUNT(*) FROM tasks WHERE exetime <= ?", (time.time(),)
+        ).fetchone()[0]
+        return super()._len_ready() + due
+
+    def _next_time(self):
+        times = [
+            t for t in (super()._next_time(), self._disk_next_time) if t is not None
+        ]
+        return min(times) if times else None
+
+    async def get_length(self):
+        return len(self._ready) + len(self._waiting) + self._disk_count
+
+    async def get_length_of_waiting(self):
+        self.transfer_waiting()
+        return await self.get_length() - self._len_ready()
+
+    async def clear(self):
+        await super().clear()
+        self._spilled = []
+        self.db.execute("DELETE FROM tasks")
+        self.db.commit()
+        self._disk_count = 0
+        self._disk_next_time = None
+
+    async def close(self):
+        await super().close()
+        if self.persistent:
+            self.spill_all()
+            self._write_spilled()
+            self.db.close()
+        else:
+            self.db.close()
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(self.path + suffix)
+                except FileNotFoundError:
+                    pass
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, and bursts of up to `burst`
+    events after being idle.
+
+    :param rate: tokens added per second.
+    :param burst: max number of tokens.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """Takes a token if there is one.
+
+        Returns:
+            0 if a token was taken, or else the seconds until one is available.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        """Takes a token even if there is none, which delays the next one."""
+        self._refill()
+        self.tokens -= 1
+
+    def ready_time(self) -> float:
+        """Returns the timestamp when a token is available."""
+        self._refill()
+        if self.tokens >= 1:
+            return self.updated
+        return self.updated + (1 - self.tokens) / self.rate
+
+
+def _rate_burst(value, burst: int):
+    # a rate setting is `rate` or `(rate, burst)`
+    if isinstance(value, (tuple, list)):
+        return value[0], value[1]
+    return value, burst
+
+
+class _HostSlot:
+    """Sub-queue and admission state of one host in :class:`HostPQ`."""
+
+    __slots__ = (
+        "key",
+        "heap",
+        "limit",
+        "delay",
+        "bucket",
+        "inflight",
+        "next_time",
+        "token",
+    )
+
+    def __init__(self, key, limit=0, delay=0, bucket=None):
+        self.key = key
+        self.heap = []
+        self.limit = limit
+        self.delay = delay
+        self.bucket = bucket
+        self.inflight = 0
+        self.next_time = 0
+        # token of the valid entry in HostPQ's host heaps, None if not scheduled
+        self.token = None
+
+    @property
+    def admissible(self):
+        return not self.limit or self.inflight < self.limit
+
+
+class HostPQ(HeapPQ):
+    """A host-partitioned Priority Queue for requests.
+
+    Every host has its own sub-queue and only hosts that are under their
+    concurrency limit and past their politeness delay are kept in a heap of
+    ready hosts, so :meth:`pop` only returns a request that can start
+    immediately. A popped request holds a slot of its host until
+    :meth:`release` is called. Hosts waiting for their delay or rate limit don't
+    hold workers, which take requests of other hosts meanwhile.
+
+    :param max_per_host: concurrency limit for every host, 0 means no limit.
+    :param special_hosts: host-limit dictionary. A domain and its subdomains
+        share one sub-queue and one limit, and use the delay and rate of that
+        domain.
+    :param delay: seconds between two requests to the same host.
+    :param special_delay: host-delay dictionary like `DOWNLOAD_DELAY_SPECIAL_HOST`.
+    :param rate: max requests per second to every host, 0 means no limit. Each host
+        has a :class:`TokenBucket`.
+    :param burst: size of the token buckets.
+    :param special_rate: host-rate dictionary like `DOWNLOAD_RATE_SPECIAL_HOST`.
+    :param rules: a :class:`~acrawler.hostrules.HostRules` to use instead of the
+        three special dictionaries.
+    """
+
+    def __init__(
+        self,
+        max_per_host: int = 0,
+        special_hosts: dict = None,
+        delay: float = 0,
+        special_delay: dict = None,
+        rate: float = 0,
+        burst: int = 1,
+        special_rate: dict = None,
+        rules: HostRules = None,
+    ):
+        super().__init__()
+        self.max_per_host = max_per_host
+        self.delay = delay
+        self.rate = rate
+        self.burst = burst
+        if rules is None:
+            rules = HostRules.from_settings(special_hosts, special_delay, special_rate)
+        self.rules = rules
+        self._hosts = {}
+        self._host_keys = {}
+        self._ready_hosts = []
+        self._delayed_hosts = []
+        self._queued = 0
+
+    def release(self, task: _Task):
+        key = task.__dict__.pop("_host_key", None)
+        if key is None:
+            return
+        slot = self._hosts[key]
+        slot.inflight -= 1
+        if slot.token is None and slot.heap:
+            self._schedule(slot)
+            self._wakeup_next()
+
+    def drain_nowait(self):
+        tasks = [item[-1] for item in self._waiting]
+        for slot in self._hosts.values():
+            tasks.extend(item[-1] for item in slot.heap)
+            slot.heap = []
+            slot.token = None
+        self._waiting = []
+        self._ready_hosts = []
+        self._delayed_hosts = []
+        self._queued = 0
+        return tasks
+
+    async def clear(self):
+        self.drain_nowait()
+
+    def _host_key(self, task: _Task):
+        return self.get_host_key(task.url.host if hasattr(task, "url") else "")
+
+    def _new_slot(self, key):
+        # a shared slot takes the rules of its domain, not of its first host
+        pattern, limit = self.rules.find(key, "max_requests")
+        if pattern is None:
+            limit = self.max_per_host
+        delay = self.rules.get(key, "delay", self.delay)
+        rate, burst = _rate_burst(self.rules.get(key, "rate", self.rate), self.burst)
+        bucket = TokenBucket(rate, burst) if rate else None
+        return _HostSlot(key, limit, delay, bucket)
+
+    def push_nowait(self, task: _Task):
+        # a task pushed back (retry, reschedule) has finished its execution
+        self.release(task)
+        return super().push_nowait(task)
+
+    def _push_ready(self, task: _Task):
+        key = self._host_key(task)
+        slot = self._hosts.get(key)
+        if slot is None:
+            slot = self._hosts[key] = self._new_slot(key)
+        item = (-task.score, next(self._seq), task)
+        heapq.heappush(slot.heap, item)
+        self._queued += 1
+        if slot.token is None or slot.heap[0] is item:
+            # new head of an eligible host must be re-ranked
+            self._schedule(slot)
+
+    def _schedule(self, slot: _HostSlot):
+        if not slot.heap or not slot.admissible:
+            slot.token = None
+            return
+        slot.token = next(self._seq)
+        if slot.next_time > time.time():
+            heapq.heappush(self._delayed_hosts, (slot.next_time, slot.token, slot.key))
+        else:
+            heapq.heappush(
+                self._ready_hosts, (slot.heap[0][0], slot.token, slot.key)
+            )
+
+    def _promote_delayed(self):
+        now = time.time()
+        while self._delayed_hosts and self._delayed_hosts[0][0] <= now:
+            _, token, key = heapq.heappop(self._delayed_hosts)
+            slot = self._hosts[key]
+            if slot.token == token:
+                self._schedule(slot)
+
+    def _pop_ready(self):
+        self._promote_delayed()
+        while self._ready_hosts:
+            _, token, key = heapq.heappop(self._ready_hosts)
+            slot = self._hosts[key]
+            if slot.token != token:
+                continue
+            task = heapq.heappop(slot.heap)[2]
+            self._queued -= 1
+            slot.inflight += 1
+            if slot.delay:
+                slot.next_time = time.time() + random.uniform(
+                    slot.delay * 0.8, slot.delay * 1.2
+                )
+            if slot.bucket:
+                slot.bucket.consume()
+                slot.next_time = max(slot.next_time, slot.bucket.ready_time())
+            self._schedule(slot)
+            task._host_key = key
+            return task
+        return None
+
+    def _has_ready(self):
+        self._promote_delayed()
+        return bool(self._ready_hosts)
+
+    def _len_ready(self):
+        return self._queued
+
+    def _next_time(self):
+        times = []
+        if self._waiting:
+            times.append(self._waiting[0][0])
+        if self._delayed_hosts:
+            times.append(self._delayed_hosts[0][0])
+        return min(times) if times else None
+
+    def get_host_key(self, host: str) -> str:
+        """Returns the key of the sub-queue of `host`: the domain of its
+        `max_requests` rule, or the host itself."""
+        key = self._host_keys.get(host)
+        if key is None:
+            key = self.rules.find(host, "max_requests")[0] or host
+            self._host_keys[host] = key
+        return key
+
+    def set_host_limit(self, host: str, limit: int = None, delay: float = None):
+        """Changes the concurrency limit and/or the delay of a host at runtime, e.g.
+        from :class:`~acrawler.handlers.RequestAutoThrottle`. A longer delay applies
+        at once, counted from now.
+        """
+        key = self.get_host_key(host)
+        slot = self._hosts.get(key)
+        if slot is None:
+            slot = self._hosts[key] = self._new_slot(key)
+        if limit is not None:
+            slot.limit = limit
+        if delay is not None:
+            if delay > slot.delay:
+                slot.next_time = max(slot.next_time, time.time() + delay)
+            slot.delay = delay
+        if slot.heap:
+            # re-rank with the new admission state, old entries get stale
+            self._schedule(slot)
+            if slot.token is not None:
+                self._wakeup_next()
+            elif self._getters:
+                self._arm_timer()
+
+    def get_host_stats(self) -> dict:
+        """Returns `{host: (queued, inflight, limit, delay)}` for hosts with pending
+        work."""
+        return {
+            key: (len(slot.heap), slot.inflight, slot.limit, slot.delay)
+            for key, slot in self._hosts.items()
+            if slot.heap or slot.inflight
+        }
+
+
+_TRANSFER_SCRIPT = """
+local eles = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #eles, 2 do
+    local member = eles[i]
+    -- members pushed by former versions have no priority prefix
+    local priority = tonumber(string.match(member, '^(%-?[%d%.]+)|')) or 0
+    redis.call('ZADD', KEYS[2], tonumber(eles[i + 1]) - priority * 10000000000, member)
+    redis.call('ZREM', KEYS[1], member)
+end
+local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return {#eles / 2, head[2] or false}
+"""
+
+# members pushed by former versions are the serialized task alone, their waiting
+# tasks are moved to the priority set as if their priority was 0
+_PRIORITY_PREFIX = re.compile(rb"-?[\d.]+\|")
+
+
+class RedisPQ(BaseQueue):
+    """A Priority Queue that stores tasks in two redis sorted sets.
+
+    Due tasks are moved from the waiting set to the priority set by a Lua
+    script inside redis without being deserialized. Tasks are popped in batches
+    of `prefetch` into a local buffer.
+
+    :param prefetch: max number of tasks popped from redis at once.
+    :param transfer_limit: max number of tasks moved by one transfer.
+    :param codec: codec to serialize tasks. Defaults to :class:`PickleCodec`.
+    """
+
+    def __init__(
+        self,
+        address="redis://localhost",
+        q_key="acrawler:queue",
+        prefetch: int = 8,
+        transfer_limit: int = 1000,
+        codec: PickleCodec = None,
+    ):
+        super().__init__(codec)
         self.address = address
         self.pq_key = q_key + ":pq"
         self.waiting_key = q_key + ":waiting"
+        self.prefetch = prefetch
+        self.transfer_limit = transfer_limit
         self.redis: "aioredis.Redis" = None
+        self._buffer = deque()
+        self._fetch_lock = asyncio.Lock()
+        self.next_time = None
 
     async def start(self):
         aioredis = check_import("aioredis")
         self.redis = await aioredis.create_redis_pool(self.address)
 
+    def _pack(self, task: _Task) -> bytes:
+        # priority prefix lets the transfer script compute the score in redis
+        return f"{task.priority}|".encode() + self.serialize(task)
+
+    def _unpack(self, member: bytes) -> _Task:
+        prefix = _PRIORITY_PREFIX.match(member)
+        return self.deserialize(member[prefix.end() :] if prefix else member)
+
     async def push(self, task: _Task):
         """Push a task directly to the waiting queue.
         """
-        return await self.redis.zadd(
-            self.waiting_key, task.exetime, self.serialize(task)
-        )
+        return await self.redis.zadd(self.waiting_key, task.exetime, self._pack(task))
+
+    async def push_many(self, tasks: list):
+        """Push tasks to the waiting queue with a single ZADD.
+        """
+        if not tasks:
+            return 0
+        pairs = []
+        for task in tasks:
+            pairs.extend((task.exetime, self._pack(task)))
+        return await self.redis.zadd(self.waiting_key, *pairs)
 
     async def push_to_pq(self, task: _Task):
         """Push a task directly to the priority queue.
         """
-        return await self.redis.zadd(self.pq_key, -task.score, self.serialize(task))
+        return await self.redis.zadd(self.pq_key, -task.score, self._pack(task))
 
     async def pop(self):
-        """Pop a task from priority queue. Blocking if empty.
+        """Pop a task from the local buffer, refill it from redis if empty.
+        Blocking if empty.
         """
-        await self.transfer_waiting()
-        while True:
-            tr = self.redis.multi_exec()
-            tr.zrange(self.pq_key, 0, 0)
-            tr.zremrangebyrank(self.pq_key, 0, 0)
-            eles, _ = await tr.execute()
-
-            if eles:
-                return self.deserialize(eles[0])
-            else:
-                await asyncio.sleep(0.5)
-                await self.transfer_waiting()
+        while not self._buffer:
+            async with self._fetch_lock:
+                if not self._buffer:
+                    await self._fetch()
+        return self._buffer.popleft()
+
+    async def try_pop(self):
+        """Pop a task without blocking, None if no task is ready."""
+        if not self._buffer:
+            async with self._fetch_lock:
+                if not self._buffer:
+                    self.next_time = await self._fetch_nowait()
+        if self._buffer:
+            return self._buffer.popleft()
+        return None
+
+    async def _fetch_nowait(self):
+        # returns the exetime of the earliest task left in waiting queue or None
+        next_time = await self.transfer_waiting()
+        eles = await self.redis.zpopmin(self.pq_key, self.prefetch)
+        self._buffer.extend(self._unpack(ele) for ele in eles[::2])
+        return next_time
+
+    async def _fetch(self):
+        next_time = await self._fetch_nowait()
+        if self._buffer:
+            return
+
+        if next_time is not None and next_time - time.time() < 1:
+            await asyncio.sleep(max(0, next_time - time.time()))
+        else:
+            res = await self.redis.bzpopmin(self.pq_key, timeout=1)
+            if res:
+                self._buffer.append(self._unpack(res[1]))
 
     async def transfer_waiting(self):
         """Transfer the tasks that are permitted by exetime from waiting queue
-        to priority queue
+        to priority queue.
+
+        Returns:
+            the exetime of the earliest task left in waiting queue or None.
         """
-        now = time.time()
-        tr = self.redis.multi_exec()
-        tr.zrangebyscore(self.waiting_key, max=now)
-        tr.zremrangebyscore(self.waiting_key, max=now)
-        eles, _ = await tr.execute()
-        if eles:
-            for ele in eles:
-                task = self.deserialize(ele)
-                await self.push_to_pq(task)
-        else:
-            # waiting queue is empty
-            pass
+        _, head = await _eval_script(
+            self.redis,
+            _TRANSFER_SCRIPT,
+            keys=[self.waiting_key, self.pq_key],
+            args=[time.time(), self.transfer_limit],
+        )
+        return float(head) if head is not None else None
+
+    def drain_nowait(self):
+        tasks = list(self._buffer)
+        self._buffer.clear()
+        return tasks
 
     async def clear(self):
+        self._buffer.clear()
         await self.redis.delete(self.pq_key)
         await self.redis.delete(self.waiting_key)
 
@@ -241,12 +1831,12 @@ class RedisPQ(BaseQueue):
         tr.zcard(self.pq_key)
         tr.zcard(self.waiting_key)
         l1, l2 = await tr.execute()
-        return l1 + l2
+        return l1 + l2 + len(self._buffer)
 
     async def get_length_of_pq(self):
         await self.transfer_waiting()
         l = await self.redis.zcard(self.pq_key)
-        return l
+        return l + len(self._buffer)
 
     async def get_length_of_waiting(self):
         await self.transfer_waiting()
@@ -254,6 +1844,391 @@ class RedisPQ(BaseQueue):
         return l
 
     async def close(self):
+        # give prefetched but unconsumed tasks back to other nodes
+        for task in self.drain_nowait():
+            await self.push_to_pq(task)
+        self.redis.close()
+        return await self.redis.wait_closed()
+
+
+class ShardedRedisPQ(BaseQueue):
+    """A distributed Priority Queue split into `shards` :class:`RedisPQ` by the
+    hash of the task's host.
+
+    Requests of one host always go to the same shard. A crawler pops from the
+    shards it owns first and steals from the others when they are empty. Tasks
+    without url are spread over shards in turn. Priorities are respected within
+    a shard, not across shards.
+
+    :param shards: number of shards.
+    :param owned: indexes of the shards this crawler prefers. Defaults to all.
+    :param prefetch: max number of tasks popped from one shard at once.
+    :param codec: codec to serialize tasks. Defaults to :class:`PickleCodec`.
+    """
+
+    def __init__(
+        self,
+        address="redis://localhost",
+        q_key="acrawler:queue",
+        shards: int = 4,
+        owned: list = None,
+        prefetch: int = 8,
+        codec: PickleCodec = None,
+    ):
+        super().__init__(codec)
+        self.address = address
+        self.shards = [
+            RedisPQ(address, f"{q_key}:s{i}", prefetch=prefetch, codec=self.codec)
+            for i in range(shards)
+        ]
+        if owned is None:
+            owned = range(shards)
+        self.owned = [self.shards[i] for i in owned]
+        self.others = [shard for shard in self.shards if shard not in self.owned]
+        self.redis: "aioredis.Redis" = None
+        self._turn = itertools.count()
+
+    async def start(self):
+        aioredis = check_import("aioredis")
+        self.redis = await aioredis.create_redis_pool(self.address)
+        for shard in self.shards:
+            shard.redis = self.redis
+
+    def shard_of(self, task: _Task) -> RedisPQ:
+        url = getattr(task, "url", None)
+        host = getattr(url, "host", None)
+        if host:
+            digest = blake2b(host.encode(), digest_size=8).digest()
+            index = int.from_bytes(digest, "big") % len(self.shards)
+        else:
+            index = next(self._turn) % len(self.shards)
+        return self.shards[index]
+
+    async def push(self, task: _Task):
+        return await self.shard_of(task).push(task)
+
+    async def push_many(self, tasks: list):
+        groups = {}
+        for task in tasks:
+            groups.setdefault(self.shard_of(task), []).append(task)
+        for shard, group in groups.items():
+            await shard.push_many(group)
+
+    async def pop(self):
+        """Pop a task from owned shards, steal from other shards if all owned
+        ones are empty. Blocking if empty.
+        """
+        while True:
+            # rotate owned shards so that none of them is starved
+            i = next(self._turn) % max(len(self.owned), 1)
+            owned = self.owned[i:] + self.owned[:i]
+            others = random.sample(self.others, len(self.others))
+            for shard in owned + others:
+                task = await shard.try_pop()
+                if task is not None:
+                    return task
+
+            times = [s.next_time for s in self.shards if s.next_time is not None]
+            next_time = min(times) if times else None
+            if next_time is not None and next_time - time.time() < 1:
+                await asyncio.sleep(max(0, next_time - time.time()))
+                continue
+            # owned keys come first so that they are preferred
+            keys = [shard.pq_key for shard in owned + others]
+            res = await self.redis.bzpopmin(*keys, timeout=1)
+            if res:
+                key = res[0].decode()
+                for shard in self.shards:
+                    if shard.pq_key == key:
+                        return shard._unpack(res[1])
+
+    async def transfer_waiting(self):
+        for shard in self.shards:
+            await shard.transfer_waiting()
+
+    def drain_nowait(self):
+        tasks = []
+        for shard in self.shards:
+            tasks.extend(shard.drain_nowait())
+        return tasks
+
+    async def clear(self):
+        for shard in self.shards:
+            await shard.clear()
+
+    async def get_length(self):
+        return sum([await shard.get_length() for shard in self.shards])
+
+    async def get_length_of_pq(self):
+        return sum([await shard.get_length_of_pq() for shard in self.shards])
+
+    async def get_length_of_waiting(self):
+        return sum([await shard.get_length_of_waiting() for shard in self.shards])
+
+    async def close(self):
+        # give prefetched but unconsumed tasks back to other nodes
+        for shard in self.shards:
+            for task in shard.drain_nowait():
+                await shard.push_to_pq(task)
+        self.redis.close()
+        return await self.redis.wait_closed()
+
+
+_STREAM_TRANSFER_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local eles = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for i = 1, #eles do
+    local member = eles[i]
+    local sep = string.find(member, '|', 1, true)
+    local level = string.sub(member, 1, sep - 1)
+    redis.call('XADD', ARGV[3] .. level, '*', 't', string.sub(member, sep + 1))
+    redis.call('ZADD', KEYS[2], tonumber(level), level)
+    redis.call('ZREM', KEYS[1], member)
+end
+local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return {#eles, head[2] or false}
+"""
+
+
+class RedisStreamQueue(BaseQueue):
+    """A Priority Queue that stores tasks in redis streams read by a consumer group.
+
+    Each priority has its own stream and higher priorities are read first. A
+    popped task stays pending in the group until :meth:`task_done` acknowledges
+    it, so tasks popped by a node that dies are claimed by other consumers once
+    they have been idle for `claim_idle` seconds. Deferred tasks wait in a sorted
+    set and are moved to the streams by a Lua script. Requires redis >= 6.2.
+
+    :param group: name of the consumer group shared by all nodes.
+    :param consumer: name of this consumer. Defaults to `hostname-pid`.
+    :param prefetch: max number of tasks read from redis at once.
+    :param claim_idle: seconds after which a pending task is claimed from its
+        consumer.
+    :param claim_interval: seconds between two scans for idle pending tasks.
+    :param transfer_limit: max number of deferred tasks moved by one transfer.
+    :param codec: codec to serialize tasks. Defaults to :class:`PickleCodec`.
+    """
+
+    def __init__(
+        self,
+        address="redis://localhost",
+        q_key="acrawler:queue",
+        group: str = "acrawler",
+        consumer: str = None,
+        prefetch: int = 8,
+        claim_idle: float = 300,
+        claim_interval: float = 30,
+        transfer_limit: int = 1000,
+        codec: PickleCodec = None,
+    ):
+        super().__init__(codec)
+        self.address = address
+        self.stream_prefix = q_key + ":stream:"
+        self.levels_key = q_key + ":levels"
+        self.waiting_key = q_key + ":waiting"
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.prefetch = prefetch
+        self.claim_idle = claim_idle
+        self.claim_interval = claim_interval
+        self.transfer_limit = transfer_limit
+        self.redis: "aioredis.Redis" = None
+        self._buffer = deque()
+        self._fetch_lock = asyncio.Lock()
+        self._groups = set()
+        self._last_claim = 0
+        # entries popped by this consumer and not acknowledged yet
+        self._inflight = set()
+        self._recovered = False
+
+    async def start(self):
+        aioredis = check_import("aioredis")
+        self.redis = await aioredis.create_redis_pool(self.address)
+
+    def _stream_key(self, level) -> str:
+        return f"{self.stream_prefix}{level}"
+
+    async def push(self, task: _Task):
+        await self.push_many([task])
+
+    async def push_many(self, tasks: list):
+        if not tasks:
+            return
+        now = time.time()
+        tr = self.redis.multi_exec()
+        for task in tasks:
+            data = self.serialize(task)
+            if task.exetime <= now:
+                tr.xadd(self._stream_key(task.priority), {b"t": data})
+                tr.zadd(self.levels_key, task.priority, str(task.priority))
+            else:
+                member = f"{task.priority}|".encode() + data
+                tr.zadd(self.waiting_key, task.exetime, member)
+        await tr.execute()
+
+    async def pop(self):
+        """Pop a task from the local buffer, refill it from redis if empty.
+        Blocking if empty.
+        """
+        while not self._buffer:
+            async with self._fetch_lock:
+                if not self._buffer:
+                    await self._fetch()
+        return self._buffer.popleft()
+
+    async def _fetch(self):
+        if not self._recovered:
+            # entries left pending by a former run under the same consumer name
+            self._recovered = True
+            keys = await self._level_keys()
+            if keys:
+                await self._read(*keys, latest_id="0", count=None)
+                if self._buffer:
+                    return
+
+        if time.time() - self._last_claim >= self.claim_interval:
+            self._last_claim = time.time()
+            await self.claim_stale()
+            if self._buffer:
+                return
+
+        next_time = await self.transfer_waiting()
+        keys = await self._level_keys()
+        for key in keys:
+            if await self._read(key):
+                return
+
+        if next_time is not None and next_time - time.time() < 1:
+            await asyncio.sleep(max(0, next_time - time.time()))
+        elif keys:
+            await self._read(*keys, timeout=1000)
+        else:
+            await asyncio.sleep(1)
+
+    async def _level_keys(self) -> list:
+        # stream keys from the highest priority to the lowest
+        levels = await self.redis.zrevrange(self.levels_key, 0, -1)
+        keys = [self._stream_key(level.decode()) for level in levels]
+        for key in keys:
+            if key not in self._groups:
+                await self._create_group(key)
+        return keys
+
+    async def _create_group(self, key):
+        try:
+            await self.redis.xgroup_create(key, self.group, "0", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise e
+        self._groups.add(key)
+
+    async def _read(self, *keys, timeout=None, latest_id=">", count=-1) -> int:
+        messages = await self.redis.xread_group(
+            self.group,
+            self.consumer,
+            list(keys),
+            timeout=timeout,
+            count=self.prefetch if count == -1 else count,
+            latest_ids=[latest_id] * len(keys),
+        )
+        for key, entry_id, fields in messages:
+            self._add_entry(key, entry_id, fields)
+        return len(messages)
+
+    def _add_entry(self, key, entry_id, fields):
+        if not fields or (key, entry_id) in self._inflight:
+            # deleted while pending, or held by ourselves
+            return
+        task = self.deserialize(fields[b"t"])
+        task._stream_entry = (key, entry_id)
+        self._inflight.add(task._stream_entry)
+        self._buffer.append(task)
+
+    async def claim_stale(self):
+        """Claim tasks that have been pending in other consumers for longer than
+        `claim_idle`, up to `prefetch` tasks.
+        """
+        idle = int(self.claim_idle * 1000)
+        for key in await self._level_keys():
+            res = await self.redis.execute(
+                b"XAUTOCLAIM",
+                key,
+                self.group,
+                self.consumer,
+                idle,
+                b"0-0",
+                b"COUNT",
+                self.prefetch - len(self._buffer),
+            )
+            for entry in res[1]:
+                if entry:
+                    entry_id, fields = entry
+                    fields = dict(zip(fields[::2], fields[1::2])) if fields else None
+                    self._add_entry(key.encode(), entry_id, fields)
+            if len(self._buffer) >= self.prefetch:
+                break
+
+    async def task_done(self, task: _Task):
+        """Acknowledge the task and delete it from its stream."""
+        entry = task.__dict__.pop("_stream_entry", None)
+        if entry:
+            self._inflight.discard(entry)
+            key, entry_id = entry
+            tr = self.redis.multi_exec()
+            tr.xack(key, self.group, entry_id)
+            tr.xdel(key, entry_id)
+            await tr.execute()
+
+    async def transfer_waiting(self):
+        """Transfer the tasks that are permitted by exetime from waiting set
+        to streams.
+
+        Returns:
+            the exetime of the earliest task left in waiting set or None.
+        """
+        _, head = await _eval_script(
+            self.redis,
+            _STREAM_TRANSFER_SCRIPT,
+            keys=[self.waiting_key, self.levels_key],
+            args=[time.time(), self.transfer_limit, self.stream_prefix],
+        )
+        return float(head) if head is not None else None
+
+    def drain_nowait(self):
+        tasks = list(self._buffer)
+        self._buffer.clear()
+        return tasks
+
+    async def clear(self):
+        self._buffer.clear()
+        keys = await self._level_keys()
+        await self.redis.delete(self.levels_key, self.waiting_key, *keys)
+        self._groups.clear()
+
+    async def get_length(self):
+        return await self.get_length_of_pq() + await self.redis.zcard(self.waiting_key)
+
+    async def get_length_of_pq(self):
+        # entries neither delivered nor acknowledged, plus the local buffer
+        length = len(self._buffer)
+        for key in await self._level_keys():
+            tr = self.redis.multi_exec()
+            tr.xlen(key)
+            tr.xpending(key, self.group)
+            total, pending = await tr.execute()
+            length += total - pending[0]
+        return length
+
+    async def get_length_of_waiting(self):
+        await self.transfer_waiting()
+        return await self.redis.zcard(self.waiting_key)
+
+    async def close(self):
+        # give prefetched but unconsumed tasks back to other nodes
+        tasks = self.drain_nowait()
+        await self.push_many(tasks)
+        for task in tasks:
+            await self.task_done(task)
         self.redis.close()
         return await self.redis.wait_closed()
 
@@ -262,10 +2237,20 @@ class Scheduler:
     """Scheduler produces & consumes tasks with its priority queue.
 
     :param df: instance of the dupefilter. Defaults to :class:`SetDupefilter`.
-    :param q: instance of the priority queue. Defaults to :class:`AsyncPQ`.
+    :param q: instance of the priority queue. Defaults to :class:`HeapPQ`.
+    :param high_watermark: producers calling :meth:`wait_for_room` are blocked once
+        the queue holds this many tasks. 0 disables backpressure.
+    :param low_watermark: blocked producers resume when the queue drains to this
+        length. Defaults to half of `high_watermark`.
     """
 
-    def __init__(self, df: BaseDupefilter = None, q: BaseQueue = None):
+    def __init__(
+        self,
+        df: BaseDupefilter = None,
+        q: BaseQueue = None,
+        high_watermark: int = 0,
+        low_watermark: int = None,
+    ):
         if df:
             self.df = df
         else:
@@ -273,7 +2258,13 @@ class Scheduler:
         if q:
             self.q = q
         else:
-            self.q = AsyncPQ()
+            self.q = HeapPQ()
+        self.high_watermark = high_watermark
+        if low_watermark is None:
+            low_watermark = high_watermark // 2
+        self.low_watermark = low_watermark
+        self._room = asyncio.Event()
+        self._room.set()
 
     async def start(self):
         await self.df.start()
@@ -290,10 +2281,53 @@ class Scheduler:
                 await self.q.push(task)
                 return True
 
+    async def produce_many(self, tasks: list, dont_filter=False) -> list:
+        """Produce tasks in a batch: the dupefilter checks them with
+        :meth:`~BaseDupefilter.seen_many` and the accepted tasks are pushed to the
+        queue at once.
+
+        Returns:
+            the list of tasks that were added.
+        """
+        filtered = [t for t in tasks if not (t.dont_filter or dont_filter)]
+        seens = await self.df.seen_many(filtered) if filtered else []
+        seen_ids = {id(t) for t, seen in zip(filtered, seens) if seen}
+        added = [t for t in tasks if id(t) not in seen_ids]
+        if added:
+            await self.q.push_many(added)
+        return added
+
     async def consume(self) -> _Task:
         task = await self.q.pop()
+        if not self._room.is_set():
+            if await self.q.get_length() <= self.low_watermark:
+                self._room.set()
         return task
 
+    async def wait_for_room(self):
+        """Blocks while the queue is above its high watermark, until it drains to
+        its low watermark.
+        """
+        if not self.high_watermark:
+            return
+        if await self.q.get_length() < self.high_watermark:
+            return
+        while await self.q.get_length() > self.low_watermark:
+            self._room.clear()
+            try:
+                # other crawlers may drain a shared queue without notifying us
+                await asyncio.wait_for(self._room.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, task):
+        """Tells the queue that a consumed task has finished its execution."""
+        self.q.release(task)
+
+    async def task_done(self, task):
+        """Tells the queue that the outcome of a consumed task has been recorded."""
+        await self.q.task_done(task)
+
     async def clear(self, df=True, q=True):
         if df:
             await self.df.clear()
@@ -13,6 +13,9 @@ REQUEST_CONFIG = {
 MIDDLEWARE_CONFIG = {
     "acrawler.handlers.RequestPrepareSession": 1800,
     "acrawler.handlers.RequestMergeConfig": 1700,
+    "acrawler.handlers.RequestRedirectFilter": 1750,
+    "acrawler.handlers.RequestAutoThrottle": 1750,
+    "acrawler.handlers.ResponseRedirectFilter": 1950,
     "acrawler.handlers.ResponseAddCallback": 1900,
     "acrawler.handlers.ResponseCheckStatus": 1800,
     "acrawler.handlers.CrawlerStartAddon": 2000,
@@ -21,10 +24,12 @@ MIDDLEWARE_CONFIG = {
 
 
 DOWNLOAD_DELAY = 0
-"""Every Request worker will delay some seconds before sending a new Request"""
+"""Seconds between two Requests to the same host. It is enforced like a
+`DOWNLOAD_RATE` of `1 / DOWNLOAD_DELAY` with a burst of 1, so workers don't sleep."""
 
 DOWNLOAD_DELAY_SPECIAL_HOST: dict = {}
-"""Every Request worker for specific host will delay some seconds before sending a new Request"""
+"""`DOWNLOAD_DELAY` for specific hosts. A key applies to the domain and its
+subdomains, see `HOST_RULES`."""
 
 DISABLE_COOKIES = False
 
@@ -50,7 +55,72 @@ MAX_REQUESTS_PER_HOST: int = 0
 """Limit simultaneous connections to the same host."""
 
 MAX_REQUESTS_SPECIAL_HOST: dict = {}
-"""Limit simultaneous connections with a host-limit dictionary."""
+"""Limit simultaneous connections with a host-limit dictionary. A key applies to the
+domain and its subdomains, which share the limit."""
+
+DOWNLOAD_RATE: float = 0
+"""Max requests per second to each host, enforced with a token bucket of
+`DOWNLOAD_BURST` tokens. Workers don't sleep: with `HOST_PARTITION` the queue
+only hands out requests of hosts that have a token, otherwise a request that comes
+too early reserves the next token of its host and is rescheduled for then. With a
+delay as well, the lower of the two rates applies. 0 means no limit."""
+
+DOWNLOAD_BURST: int = 1
+"""Requests that may be sent at once to a host that was idle, see `DOWNLOAD_RATE`."""
+
+DOWNLOAD_RATE_SPECIAL_HOST: dict = {}
+"""Rates for specific hosts, e.g. ``{"example.com": 0.5, "api.com": (10, 20)}``
+where a tuple is `(rate, burst)`."""
+
+HOST_RULES: dict = {}
+"""Per-host settings as `{domain: rule}`, e.g.
+``{"example.com": {"max_requests": 2, "delay": 1, "rate": (5, 10),
+"headers": {"Referer": "https://example.com"}, "proxy": "http://proxy:8080"}}``.
+
+A rule applies to the domain and its subdomains and the most specific domain wins
+for each setting. `MAX_REQUESTS_SPECIAL_HOST`, `DOWNLOAD_DELAY_SPECIAL_HOST` and
+`DOWNLOAD_RATE_SPECIAL_HOST` are merged as `max_requests`, `delay` and `rate`.
+`headers` are merged below the request's own headers, `proxy` is used unless the
+request sets one. With `HOST_PARTITION`, subdomains sharing a `max_requests`
+rule also share the `delay` and `rate` of that rule's domain. See
+:class:`~acrawler.hostrules.HostRules`."""
+
+ADD_TASKS_BATCH_SIZE = 100
+"""Tasks yielded by one execution are added in batches of this size, so that
+dupefilter checks, queue pushes and counter updates take fewer round-trips."""
+
+REQUEST_QUEUE_WATERMARK: tuple = (0, 0)
+"""(high, low) watermarks of the request queue. Once it holds `high` requests,
+`start_requests`, the redis start key feeder and workers yielding requests wait
+until it drains to `low`. `(0, 0)` disables backpressure."""
+
+TASK_QUEUE_WATERMARK: tuple = (0, 0)
+"""(high, low) watermarks of the queue of other tasks. Only `start_requests` and the
+redis start key feeder wait for it, since its own workers must keep draining it."""
+
+AUTOTHROTTLE = False
+"""Set to True to adapt the concurrency limit and the delay of each host to its
+latency and errors (429, 503, timeouts) instead of static limits. Needs
+`HOST_PARTITION`. See :class:`~acrawler.handlers.RequestAutoThrottle`."""
+
+AUTOTHROTTLE_START_CONCURRENCY: int = 2
+"""Concurrency limit of a host before its first response. Its delay starts at its
+configured delay (`DOWNLOAD_DELAY` or its `delay` rule), which stays the shortest
+delay of the host."""
+
+AUTOTHROTTLE_MAX_CONCURRENCY: int = 8
+"""Max concurrency limit of a host under `AUTOTHROTTLE`. A lower configured limit
+(`MAX_REQUESTS_PER_HOST` or the host's `max_requests` rule) stays the cap."""
+
+AUTOTHROTTLE_MAX_DELAY: float = 60
+"""Max delay of a host under `AUTOTHROTTLE`."""
+
+HOST_PARTITION = False
+"""Set to True to keep one request queue per host. Only requests that can start
+immediately (under host limits and past `DOWNLOAD_DELAY` or `DOWNLOAD_RATE` for
+their host) are given to workers instead of being rescheduled. Delays become per
+host in this mode.
+Ignored if you enable distributed support."""
 
 REDIS_ENABLE = False
 """Set to True if you want distributed crawling support.
@@ -65,6 +135,48 @@ its callback function)"""
 REDIS_QUEUE_KEY = None
 """"""
 
+REDIS_QUEUE_PREFETCH = 8
+"""How many tasks a crawler pops from the redis queue at once and buffers locally.
+Requires redis >= 5.0."""
+
+REDIS_QUEUE_ENGINE = "zset"
+"""Engine of the redis queues.
+
+- ``"zset"``: sorted sets. A task popped by a crawler that dies is lost.
+- ``"stream"``: streams read by a consumer group. Tasks are acknowledged after
+  they are done and tasks left pending by a dead crawler are claimed by others
+  after `REDIS_STREAM_CLAIM_IDLE` seconds. Requires redis >= 6.2.
+"""
+
+REDIS_QUEUE_SHARDS = 1
+"""Split each redis queue into this many sorted sets by the hash of the task's
+host. Requests of one host stay in one shard. Needs `REDIS_QUEUE_ENGINE` "zset".
+"""
+
+REDIS_QUEUE_OWNED_SHARDS: list = None
+"""Indexes of the shards this crawler pops from first, e.g. `[0, 1]`. It pops from
+other shards only when the owned ones are empty. Defaults to all shards."""
+
+REDIS_STREAM_GROUP = None
+"""Consumer group shared by crawlers. Defaults to `acrawler:<name>`."""
+
+REDIS_STREAM_CONSUMER = None
+"""Consumer name of this crawler. Defaults to `hostname-pid`. Set a stable name to
+take back this crawler's pending tasks as soon as it restarts."""
+
+REDIS_STREAM_CLAIM_IDLE = 300
+"""Seconds after which a task pending in another crawler is claimed. It should be
+longer than any task takes to execute."""
+
+REDIS_COUNTER_FLUSH_INTERVAL: float = 0
+"""Seconds the redis counter may keep changes locally before writing them in one
+round-trip, see :class:`~acrawler.counter.BufferedRedisCounter`. 0 writes every
+change at once."""
+
+REDIS_COUNTER_FLUSH_SIZE: int = 1000
+"""Number of buffered changes that makes the redis counter write them before
+`REDIS_COUNTER_FLUSH_INTERVAL`."""
+
 REDIS_DF_KEY = None
 """"""
 
@@ -89,3 +201,98 @@ PERSISTENT = False
 
 PERSISTENT_NAME = None
 """A name tag for file-storage of persistent support"""
+
+QUEUE_ENGINE = "heap"
+"""Engine of the local task queues if distributed support is disabled.
+
+- ``"heap"``: keep all tasks in memory.
+- ``"bucket"``: keep all tasks in memory, in one FIFO per priority. Faster when
+  only a few integer priorities are used.
+- ``"disk"``: keep at most `QUEUE_MEMORY_LIMIT` tasks in memory per queue and spill
+  the others to SQLite files in `QUEUE_DISK_DIR`. With `PERSISTENT`, the files
+  are reused on the next run.
+"""
+
+REDIRECT_FILTER = True
+"""Deduplicate requests by the url they are redirected to, and remember permanent
+redirects to send later requests to their targets directly. See
+:class:`~acrawler.handlers.RequestRedirectFilter`."""
+
+URL_NORMALIZATION: dict = {}
+"""Rules to normalize urls before requests are fingerprinted, so that variants
+of one url are crawled once, e.g.::
+
+    {"lowercase_host": True, "default_port": True, "path": True,
+     "trailing_slash": True, "percent_encoding": True,
+     "strip_params": ["utm_*", "sessionid"]}
+
+See :class:`~acrawler.normalizer.URLNormalizer` for all rules. Changing them
+changes fingerprints of requests already recorded by a persistent or distributed
+dupefilter."""
+
+URL_NORMALIZATION_SPECIAL_HOST: dict = {}
+"""Rules for specific domains and their subdomains, merged over
+`URL_NORMALIZATION`, e.g. ``{"example.com": {"strip_params": ["ref"]}}``."""
+
+URL_NORMALIZATION_FAMILY: dict = {}
+"""A dictionary of `family: function`. Requests of the family are deduplicated by
+`str(function(request))` instead of their url. The function must not return
+None."""
+
+DUPEFILTER_ENGINE = "set"
+"""Engine of the request dupefilter.
+
+- ``"set"``: keep fingerprints in a python set, or a redis set if distributed
+  support is enabled.
+- ``"compact"``: keep 64-bit digests of fingerprints in an array-backed hash table,
+  exact up to 64-bit collisions. Not available with distributed support.
+- ``"log"``: like ``"compact"``, and new fingerprints are appended to a log file
+  in batches, compacted into a snapshot from time to time. With `PERSISTENT`, the
+  next run loads them back, even after a crash, otherwise the files are deleted
+  on close. Not available with distributed support.
+- ``"bloom"``: keep them in a bloom filter, a few bytes per request. A request may
+  be taken as seen by mistake at `DUPEFILTER_ERROR_RATE`. Locally the filter is
+  scalable and, with `PERSISTENT`, made of memory-mapped files reused on the next
+  run. In redis it is a bitmap sized for `REDIS_DUPEFILTER_CAPACITY` requests.
+- ``"expiring"``: forget fingerprints after `DUPEFILTER_TTL` seconds, so that
+  requests are crawled again once per period. Fingerprints are kept in sets of
+  time buckets that are dropped as they get old.
+"""
+
+DUPEFILTER_TTL: float = 86400
+"""Seconds the ``"expiring"`` dupefilter remembers a request for."""
+
+DUPEFILTER_CAPACITY: int = 1000000
+"""Requests held by the first layer of the ``"bloom"`` dupefilter. It grows beyond
+that at the cost of extra layers."""
+
+DUPEFILTER_ERROR_RATE: float = 0.001
+"""Max false positive rate of the ``"bloom"`` dupefilter."""
+
+DUPEFILTER_CACHE_SIZE: int = 0
+"""With distributed support, keep up to this many fingerprints already recorded in
+redis in a local LRU cache, so that links seen again (e.g. navigation links on
+every page) don't query redis. 0 disables the cache. Ignored by the ``"expiring"``
+engine, whose fingerprints must be forgotten after `DUPEFILTER_TTL`."""
+
+REDIS_DUPEFILTER_CAPACITY: int = 100000000
+"""Requests the redis ``"bloom"`` dupefilter is sized for. Its bitmap takes about
+`1.8 bytes * capacity` at the default error rate, and its false positive rate
+rises beyond that."""
+
+QUEUE_CODEC = "pickle"
+"""How tasks are serialized by redis queues, the ``"disk"`` engine and persistent mode.
+
+- ``"pickle"``: pickle the whole task with `dill`.
+- ``"compact"``: store the task's state with `marshal`. Callbacks are stored by name,
+  see :func:`acrawler.codec.register_callback`.
+"""
+
+QUEUE_COMPRESS: str = None
+"""Compress serialized tasks with ``"zlib"`` or ``"lz4"`` (requires `lz4`)."""
+
+QUEUE_MEMORY_LIMIT: int = 10000
+"""Max tasks kept in memory by each queue of the ``"disk"`` engine."""
+
+QUEUE_DISK_DIR: str = None
+"""Directory for the files of the ``"disk"`` engine. Defaults to current directory."""
@@ -2,7 +2,7 @@ import time
 import logging
 from inspect import iscoroutinefunction, isabstract
 from acrawler.middleware import middleware
-from acrawler.utils import to_asyncgen
+from acrawler.utils import compact_fingerprint, to_asyncgen
 import asyncio
 
 
@@ -97,6 +97,11 @@ class Task:
         """returns value of :meth:`_fingerprint`."""
         return self._fingerprint()
 
+    @property
+    def compact_fingerprint(self) -> int:
+        """64-bit integer digest of :attr:`fingerprint`."""
+        return compact_fingerprint(self.fingerprint)
+
     @property
     def ancestor(self):
         return self._ancestor
@@ -10,6 +10,7 @@ import asyncio
 import logging
 import webbrowser
 from functools import partial
+from hashlib import blake2b
 from urllib.parse import urljoin
 from importlib import import_module
 from pathlib import Path
@@ -111,6 +112,13 @@ def check_import(name: str, allow_import_error=False):
     return mod
 
 
+def compact_fingerprint(fp) -> int:
+    """Returns a non-zero 64-bit integer digest of a task's fingerprint."""
+    if not isinstance(fp, bytes):
+        fp = str(fp).encode()
+    return int.from_bytes(blake2b(fp, digest_size=8).digest(), "little") or 1
+
+
 def open_html(html, path=None):
     """A helper function to debug your response. Usually called with `open_html(response.text)`.
     """
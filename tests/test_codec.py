@@ -0,0 +1,90 @@
+from multidict import CIMultiDict, CIMultiDictProxy, istr
+
+from acrawler.codec import CompactCodec, PickleCodec, decode, register_callback
+from acrawler.http import Request, Response
+from acrawler.task import DummyTask
+
+
+def parse_page(response):
+    yield None
+
+
+def test_compact():
+    local = []
+
+    @register_callback(name="local_cb")
+    def cb(response):
+        local.append(response)
+
+    rq = Request(
+        "https://httpbin.org/get?a=1&b=2",
+        callback=[parse_page, cb],
+        meta={"page": 1},
+        priority=3,
+        family="Page",
+    )
+    rq.ancestor = "web@1"
+    codec = CompactCodec()
+    message = codec.encode(rq)
+    assert len(message) < len(PickleCodec().encode(rq))
+
+    rq2 = codec.decode(message)
+    assert isinstance(rq2, Request)
+    assert rq2.url == rq.url
+    assert rq2.callbacks == [parse_page, cb]
+    assert rq2.meta == {"page": 1}
+    assert rq2.priority == 3
+    assert rq2.exetime == rq.exetime
+    assert rq2.ancestor == "web@1"
+    assert rq2.families == rq.families
+    assert rq2.fingerprint == rq.fingerprint
+
+
+def test_compress():
+    task = DummyTask("x" * 1000)
+    for codec in (PickleCodec("zlib"), CompactCodec("zlib")):
+        message = codec.encode(task)
+        assert len(message) < 500
+        assert decode(message).val == task.val
+
+
+def test_response():
+    rq = Request("https://httpbin.org/get", callback=parse_page)
+    resp = Response(
+        url=rq.url,
+        status=200,
+        cookies=None,
+        headers=CIMultiDict({"Content-Type": "text/html"}),
+        body=b"<html><a href='/x'>x</a></html>",
+        encoding="utf-8",
+        callbacks=rq.callbacks.copy(),
+        request=rq,
+    )
+    rq.response = resp
+    resp2 = CompactCodec().decode(CompactCodec().encode(resp))
+    assert resp2.body == resp.body
+    assert resp2.headers["content-type"] == "text/html"
+    assert resp2.request.url == rq.url
+    assert resp2.request.response is resp2
+    assert resp2.callbacks == [parse_page]
+
+
+def test_response_istr_headers():
+    # aiohttp builds response headers with `istr` keys
+    rq = Request("https://httpbin.org/get", callback=parse_page)
+    headers = CIMultiDictProxy(
+        CIMultiDict([(istr("Content-Type"), "text/html"), (istr("Set-Cookie"), "a=1")])
+    )
+    resp = Response(
+        url=rq.url,
+        status=200,
+        cookies=None,
+        headers=headers,
+        body=b"<html></html>",
+        encoding="utf-8",
+        callbacks=rq.callbacks.copy(),
+        request=rq,
+    )
+    resp2 = CompactCodec().decode(CompactCodec().encode(resp))
+    assert resp2.headers["content-type"] == "text/html"
+    assert resp2.headers["set-cookie"] == "a=1"
@@ -0,0 +1,132 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from acrawler.counter import BufferedRedisCounter, Counter, RedisCounter
+from acrawler.exceptions import ReScheduleError
+from acrawler.hostrules import HostRules
+from acrawler.http import Request
+from acrawler.task import DummyTask
+
+
+def fake_crawler(name="test_counter", config=None):
+    return SimpleNamespace(
+        name=name,
+        loop=asyncio.get_event_loop(),
+        config=config or {},
+        host_rules=HostRules(),
+        redis_enable=False,
+    )
+
+
+def tasks_of(ancestor, n):
+    tasks = [DummyTask(i) for i in range(n)]
+    for task in tasks:
+        task.ancestor = ancestor
+    return tasks
+
+
+async def join_when_done(counter, ancestor, tasks):
+    waiter = asyncio.ensure_future(counter.join_by_ancestor_unfinished(ancestor))
+    for task in tasks[:-1]:
+        await counter.task_done(task)
+    await asyncio.sleep(0.05)
+    assert not waiter.done()
+    await counter.task_done(tasks[-1])
+    await asyncio.wait_for(waiter, 0.2)
+
+
+@pytest.mark.asyncio
+async def test_counter_join_by_ancestor():
+    counter = Counter(fake_crawler())
+    tasks = tasks_of("web@1", 3)
+    await counter.task_add_many(tasks)
+    await counter.task_add(DummyTask(3))
+    await join_when_done(counter, "web@1", tasks)
+    assert "web@1" not in counter.ancestor_unfinished
+    assert counter.unfinished == 1
+    # an ancestor without unfinished tasks returns at once
+    await asyncio.wait_for(counter.join_by_ancestor_unfinished("web@2"), 0.1)
+
+
+@pytest.mark.asyncio
+async def test_rediscounter_join_by_ancestor():
+    aioredis = pytest.importorskip("aioredis")
+    counter = RedisCounter(fake_crawler())
+    counter.redis = await aioredis.create_redis_pool("redis://localhost")
+    await counter.redis.delete(counter.unfinished_key, counter.ancestor_unfinished_key)
+    tasks = tasks_of("web@1", 3)
+    await counter.task_add_many(tasks)
+    await join_when_done(counter, "web@1", tasks)
+    assert await counter.redis.zscore(counter.ancestor_unfinished_key, "web@1") is None
+    assert await counter.get_unfinished() == 0
+    await asyncio.wait_for(counter.join_by_ancestor_unfinished("web@2"), 0.1)
+    await counter.close()
+    counter.redis.close()
+    await counter.redis.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_bufferedrediscounter():
+    aioredis = pytest.importorskip("aioredis")
+    counter = BufferedRedisCounter(fake_crawler(), flush_interval=60, flush_size=100)
+    counter.redis = await aioredis.create_redis_pool("redis://localhost")
+    await counter.redis.delete(
+        counter.unfinished_key,
+        counter.required_key,
+        counter.ancestor_unfinished_key,
+        counter.counts_key_suc,
+        counter.counts_key_fail,
+    )
+    tasks = tasks_of("web@1", 3)
+    # increments are written at once
+    await counter.task_add_many(tasks)
+    assert int(await counter.redis.get(counter.unfinished_key)) == 3
+    await counter.required_inc()
+    await counter.task_done(tasks[0])
+    await counter.task_done(tasks[1], 0)
+    assert int(await counter.redis.get(counter.unfinished_key)) == 3
+    assert await counter.get_counts_dict() == {"DummyTask": [1, 1]}
+    assert await counter.get_unfinished() == 1
+    await join_when_done(counter, "web@1", tasks[2:])
+    assert await counter.redis.zscore(counter.ancestor_unfinished_key, "web@1") is None
+    assert counter._finished.is_set()
+    await counter.required_dec()
+    await counter.close()
+    assert int(await counter.redis.get(counter.required_key)) == 0
+    counter.redis.close()
+    await counter.redis.wait_closed()
+
+
+async def defer_of(counter, req):
+    try:
+        await counter.require_req(req)
+    except ReScheduleError as e:
+        await counter.release_req(req)
+        return e.defer
+    return None
+
+
+@pytest.mark.asyncio
+async def test_counter_rate():
+    counter = Counter(fake_crawler(config={"DOWNLOAD_RATE": 10}))
+    reqs = [Request(f"http://a.com/{i}") for i in range(3)]
+    assert await defer_of(counter, reqs[0]) is None
+    # each deferred request reserves its own token
+    assert 0.05 < await defer_of(counter, reqs[1]) <= 0.1
+    assert 0.15 < await defer_of(counter, reqs[2]) <= 0.2
+    # a reserved request doesn't take another token when it comes back
+    assert await defer_of(counter, reqs[1]) is None
+    assert await defer_of(counter, Request("http://b.com/")) is None
+
+
+@pytest.mark.asyncio
+async def test_counter_rate_with_limit():
+    config = {"DOWNLOAD_DELAY": 0.1, "MAX_REQUESTS_PER_HOST": 1}
+    counter = Counter(fake_crawler(config=config))
+    req = Request("http://a.com/0")
+    assert await defer_of(counter, req) is None
+    # a request rescheduled for a full host keeps the token for others
+    assert await defer_of(counter, Request("http://a.com/1")) == 0
+    await counter.release_req(req)
+    assert 0.05 < await defer_of(counter, Request("http://a.com/2")) <= 0.1
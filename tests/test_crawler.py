@@ -0,0 +1,31 @@
+from acrawler import Crawler
+from acrawler.task import Task
+
+
+class CountTask(Task):
+    def __init__(self, val, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.val = val
+
+    def _fingerprint(self):
+        return self.val
+
+    async def _execute(self):
+        self.crawler.count += 1
+        yield None
+
+
+class WatermarkCrawler(Crawler):
+    config = {"LOG_LEVEL": "ERROR", "TASK_QUEUE_WATERMARK": (5, 2)}
+    count = 0
+
+    async def start_requests(self):
+        # more start tasks than the high watermark
+        for i in range(20):
+            yield CountTask(str(i))
+
+
+def test_start_above_watermark():
+    crawler = WatermarkCrawler()
+    crawler.run()
+    assert crawler.count == 20
@@ -1,6 +1,20 @@
+import asyncio
+import pickle
+
 import pytest
 from acrawler.task import DummyTask
-from acrawler.scheduler import SetDupefilter
+from acrawler.http import Request
+from acrawler.scheduler import (
+    BloomDupefilter,
+    CachedDupefilter,
+    CompactDupefilter,
+    ExpiringDupefilter,
+    LogDupefilter,
+    RedisBloomDupefilter,
+    RedisDupefilter,
+    RedisExpiringDupefilter,
+    SetDupefilter,
+)
 
 
 @pytest.mark.asyncio
@@ -17,3 +31,228 @@ async def test_setdf():
     assert await df.get_length() == 0
     await df.close()
 
+
+@pytest.mark.asyncio
+async def test_seen_many():
+    df = SetDupefilter()
+    await df.seen(DummyTask(1))
+    tasks = [DummyTask(i) for i in (1, 2, 3, 2)]
+    assert await df.seen_many(tasks) == [True, False, False, True]
+    assert await df.get_length() == 3
+
+
+@pytest.mark.asyncio
+async def test_redisdf_seen_many():
+    df = RedisDupefilter(df_key="acrawler:test_seen_many")
+    await df.start()
+    await df.clear()
+    await df.seen(DummyTask(1))
+    tasks = [DummyTask(i) for i in (1, 2, 3, 2)]
+    assert await df.seen_many(tasks) == [True, False, False, True]
+    assert await df.get_length() == 3
+    await df.clear()
+    await df.close()
+
+
+@pytest.mark.asyncio
+async def test_cacheddf():
+    inner = SetDupefilter()
+    df = CachedDupefilter(inner, size=2)
+    await df.start()
+    assert await df.seen(DummyTask(1)) is False
+    assert await df.seen(DummyTask(1)) is True
+    assert df.get_stats()["hits"] == 1
+    assert await df.seen_many([DummyTask(i) for i in (1, 2, 3, 3)]) == [
+        True,
+        False,
+        False,
+        True,
+    ]
+    # 1 was evicted but is still known by the wrapped dupefilter
+    assert len(df._cache) == 2
+    assert await df.seen(DummyTask(1)) is True
+    await inner.add_fp(4)
+    assert await df.has_fp(4) is True
+    assert await df.get_length() == 4
+    stats = df.get_stats()
+    assert stats["hits"] + stats["misses"] == 8
+    await df.clear()
+    assert await df.seen(DummyTask(1)) is False
+
+
+@pytest.mark.asyncio
+async def test_has_fp_nowait():
+    dfs = [
+        SetDupefilter(),
+        CompactDupefilter(),
+        BloomDupefilter(capacity=100),
+        ExpiringDupefilter(ttl=100),
+        CachedDupefilter(SetDupefilter()),
+    ]
+    for df in dfs:
+        assert df.has_fp_nowait("fp") is False
+        await df.add_fp("fp")
+        assert df.has_fp_nowait("fp") is True
+    assert RedisDupefilter().has_fp_nowait("fp") is False
+
+
+@pytest.mark.asyncio
+async def test_expiringdf(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("time.time", lambda: now[0])
+    df = ExpiringDupefilter(ttl=100, buckets=4)
+    assert await df.seen(DummyTask(1)) is False
+    now[0] += 60
+    assert await df.seen(DummyTask(2)) is False
+    assert await df.seen(DummyTask(1)) is True
+    now[0] += 40
+    assert await df.seen(DummyTask(1)) is True
+    assert await df.get_length() == 2
+    now[0] += 25
+    assert await df.seen(DummyTask(1)) is False
+    assert await df.seen(DummyTask(2)) is True
+    now[0] += 200
+    assert await df.get_length() == 0
+    await df.add_fp(3)
+    assert await df.has_fp(3) is True
+    df = pickle.loads(pickle.dumps(df))
+    assert await df.has_fp(3) is True
+    await df.clear()
+    assert await df.get_length() == 0
+
+
+@pytest.mark.asyncio
+async def test_compactdf():
+    df = CompactDupefilter(capacity=10)
+    for i in range(1000):
+        assert await df.seen(DummyTask(i)) is False
+    assert await df.get_length() == 1000
+    assert await df.seen(DummyTask(999)) is True
+    assert await df.has_fp(500) is True
+    assert await df.has_fp(1000) is False
+    rq = Request("https://www.baidu.com/?b=1&a=2")
+    assert await df.seen(rq) is False
+    assert await df.seen(Request("https://www.baidu.com/?a=2&b=1")) is True
+    assert await df.has_fp(rq.fingerprint) is True
+    df = pickle.loads(pickle.dumps(df))
+    assert await df.seen(DummyTask(999)) is True
+    await df.clear()
+    assert await df.get_length() == 0
+
+
+@pytest.mark.asyncio
+async def test_logdf(tmp_path):
+    path = tmp_path / "df.log"
+    df = LogDupefilter(path, flush_size=100, compact_size=300)
+    for i in range(1050):
+        await df.seen(DummyTask(i))
+    # compacted at 300, 600 and 900 fingerprints; 100 logged, 50 pending
+    assert (tmp_path / "df.log.snap").exists()
+    assert path.stat().st_size == 100 * 8
+    assert len(df._pending) == 50
+    await df.close()
+    assert path.stat().st_size == 150 * 8
+
+    # a crash may leave half a record
+    with open(path, "ab") as f:
+        f.write(b"\x01\x02")
+    df = LogDupefilter(path, resume=True)
+    assert await df.get_length() == 1050
+    assert await df.seen(DummyTask(1049)) is True
+    assert await df.seen(DummyTask(1050)) is False
+    await df.close()
+
+    df = LogDupefilter(path, persistent=False)
+    assert await df.get_length() == 0
+    await df.seen(DummyTask(0))
+    await df.close()
+    assert not path.exists()
+    assert not (tmp_path / "df.log.snap").exists()
+
+
+@pytest.mark.asyncio
+async def test_logdf_flush_interval(tmp_path):
+    path = tmp_path / "df.log"
+    df = LogDupefilter(path, flush_size=100, flush_interval=0.05)
+    for i in range(3):
+        await df.seen(DummyTask(i))
+    assert path.stat().st_size == 0
+    # flushed by the timer although no fingerprint is added anymore
+    await asyncio.sleep(0.1)
+    assert path.stat().st_size == 3 * 8
+    await df.close()
+
+
+@pytest.mark.asyncio
+async def test_bloomdf(tmp_path):
+    path = str(tmp_path / "df.bloom")
+    df = BloomDupefilter(capacity=500, error_rate=0.001, path=path)
+    await df.start()
+    for i in range(2000):
+        await df.seen(DummyTask(i))
+    assert len(df._layers) == 3
+    assert 1990 <= await df.get_length() <= 2000
+    assert await df.seen(DummyTask(999)) is True
+    false_positives = 0
+    for i in range(2000, 12000):
+        false_positives += await df.has_fp(i)
+    assert false_positives < 30
+    await df.close()
+
+    df = BloomDupefilter(capacity=500, path=path, resume=True)
+    assert 1990 <= await df.get_length() <= 2000
+    assert await df.seen(DummyTask(1999)) is True
+    await df.clear()
+    assert await df.get_length() == 0
+    assert await df.seen(DummyTask(1999)) is False
+    await df.close()
+
+
+@pytest.mark.asyncio
+async def test_bloomdf_pickle():
+    df = BloomDupefilter(capacity=100)
+    for i in range(300):
+        await df.seen(DummyTask(i))
+    df = pickle.loads(pickle.dumps(df))
+    assert await df.get_length() == 300
+    assert await df.seen(DummyTask(42)) is True
+    assert await df.seen(DummyTask(300)) is False
+
+
+@pytest.mark.asyncio
+async def test_redisbloomdf():
+    df = RedisBloomDupefilter(df_key="acrawler:test_bloom", capacity=10000)
+    await df.start()
+    await df.clear()
+    for i in range(1000):
+        await df.seen(DummyTask(i))
+    assert 995 <= await df.get_length() <= 1000
+    assert await df.seen(DummyTask(999)) is True
+    assert await df.has_fp(1000) is False
+    assert await df.add_fp(1000) is True
+    assert await df.has_fp(1000) is True
+    tasks = [DummyTask(i) for i in (999, 1001, 1002, 1001)]
+    assert await df.seen_many(tasks) == [True, False, False, True]
+    await df.clear()
+    assert await df.get_length() == 0
+    await df.close()
+
+
+@pytest.mark.asyncio
+async def test_redisexpiringdf():
+    df = RedisExpiringDupefilter(df_key="acrawler:test_expiring", ttl=3600)
+    await df.start()
+    await df.clear()
+    for i in range(100):
+        assert await df.seen(DummyTask(i)) is False
+    assert await df.get_length() == 100
+    assert await df.seen(DummyTask(99)) is True
+    assert await df.has_fp(100) is False
+    assert await df.add_fp(100) is True
+    assert await df.has_fp(100) is True
+    tasks = [DummyTask(i) for i in (99, 101, 102, 101)]
+    assert await df.seen_many(tasks) == [True, False, False, True]
+    assert 0 < await df.redis.ttl(df._call(None, add=False)[0][0]) <= 3600 + 450
+    await df.clear()
+    assert await df.get_length() == 0
+    await df.close()
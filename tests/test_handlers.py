@@ -0,0 +1,224 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from multidict import CIMultiDict
+from yarl import URL
+
+from acrawler.exceptions import SkipTaskImmediatelyError
+from acrawler.handlers import (
+    RequestAutoThrottle,
+    RequestRedirectFilter,
+    ResponseRedirectFilter,
+)
+from acrawler.hostrules import HostRules
+from acrawler.http import Request, Response
+from acrawler.middleware import middleware
+from acrawler.scheduler import HostPQ, SetDupefilter
+
+
+@pytest.fixture
+def crawler():
+    old = middleware.crawler
+    middleware.crawler = SimpleNamespace(
+        name="test_handlers",
+        config={},
+        redis_enable=False,
+        persistent=False,
+        sdl_req=SimpleNamespace(df=SetDupefilter()),
+    )
+    yield middleware.crawler
+    middleware.crawler = old
+
+
+def fetched(request, url, history):
+    # a request answered with `url` after the `(status, url)` redirects of history
+    request.response = Response(
+        url=URL(url),
+        status=200,
+        cookies=None,
+        headers=CIMultiDict(),
+        request=request,
+        body=b"",
+        encoding="utf-8",
+        history=[(status, URL(u)) for status, u in history],
+    )
+    return request.response
+
+
+async def redirect_filter(history, url):
+    rf = RequestRedirectFilter()
+    await rf.on_start()
+    await rf.handle_after(fetched(Request(history[0][1]), url, history).request)
+    return rf
+
+
+@pytest.mark.asyncio
+async def test_request_redirect_filter_rewrites(crawler):
+    rf = await redirect_filter(
+        [(301, "http://a.com/old"), (308, "http://a.com/older")], "http://a.com/new"
+    )
+    assert len(rf.redirects) == 2
+    request = Request("http://a.com/old")
+    await rf.handle_before(request)
+    assert request.url == URL("http://a.com/new")
+    # the target is now recorded, another url redirecting to it is skipped
+    with pytest.raises(SkipTaskImmediatelyError):
+        await rf.handle_before(Request("http://a.com/older"))
+
+
+@pytest.mark.asyncio
+async def test_request_redirect_filter_skips_seen(crawler):
+    rf = await redirect_filter([(301, "http://a.com/old")], "http://a.com/new")
+    await crawler.sdl_req.df.seen(Request("http://a.com/new"))
+    request = Request("http://a.com/old")
+    with pytest.raises(SkipTaskImmediatelyError):
+        await rf.handle_before(request)
+    assert request.url == URL("http://a.com/old")
+    # dont_filter bypasses the filter
+    request = Request("http://a.com/old", dont_filter=True)
+    await rf.handle_before(request)
+    assert request.url == URL("http://a.com/old")
+
+
+@pytest.mark.asyncio
+async def test_request_redirect_filter_cross_host(crawler):
+    rf = await redirect_filter([(301, "http://a.com/old")], "http://b.com/new")
+    request = Request("http://a.com/old")
+    # not rewritten, so that limits of a.com are released correctly
+    await rf.handle_before(request)
+    assert request.url == URL("http://a.com/old")
+    assert not await crawler.sdl_req.df.has_fp(Request("http://b.com/new").fingerprint)
+    await crawler.sdl_req.df.seen(Request("http://b.com/new"))
+    with pytest.raises(SkipTaskImmediatelyError):
+        await rf.handle_before(Request("http://a.com/old"))
+
+
+@pytest.mark.asyncio
+async def test_request_redirect_filter_temporary(crawler):
+    rf = await redirect_filter(
+        [(302, "http://a.com/1"), (307, "http://a.com/2"), (301, "http://a.com/3")],
+        "http://a.com/4",
+    )
+    assert rf.redirects == {Request("http://a.com/3").fingerprint: "http://a.com/4"}
+    request = Request("http://a.com/1")
+    await rf.handle_before(request)
+    assert request.url == URL("http://a.com/1")
+
+
+@pytest.mark.asyncio
+async def test_request_redirect_filter_persistent(crawler, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    crawler.persistent = True
+    rf = await redirect_filter([(308, "http://a.com/old")], "http://a.com/new")
+    await rf.on_close()
+    assert (tmp_path / ".acrawler.test_handlers.redirects").exists()
+
+    rf = RequestRedirectFilter()
+    await rf.on_start()
+    request = Request("http://a.com/old")
+    await rf.handle_before(request)
+    assert request.url == URL("http://a.com/new")
+
+
+@pytest.mark.asyncio
+async def test_response_redirect_filter(crawler):
+    rf = ResponseRedirectFilter()
+    await rf.on_start()
+    x = "http://a.com/x"
+    history = [(301, "http://a.com/1")]
+    await rf.handle_before(fetched(Request("http://a.com/1"), x, history))
+    with pytest.raises(SkipTaskImmediatelyError):
+        await rf.handle_before(
+            fetched(Request("http://a.com/2"), x, [(302, "http://a.com/2")])
+        )
+    # dont_filter bypasses the filter
+    request = Request("http://a.com/3", dont_filter=True)
+    await rf.handle_before(fetched(request, x, [(302, "http://a.com/3")]))
+    # a response without redirects is left to the request dupefilter
+    await rf.handle_before(fetched(Request(x), x, []))
+
+
+def throttled(url, status=200, latency=0.1, exception=None, headers=None):
+    request = Request(url)
+    request.exceptions = [exception] if exception else []
+    request.latency = latency
+    request.response = Response(
+        url=request.url,
+        status=status,
+        cookies=None,
+        headers=CIMultiDict(headers or {}),
+        request=request,
+        body=b"",
+        encoding="utf-8",
+    )
+    return request
+
+
+async def throttle_of(crawler):
+    crawler.config = {
+        "AUTOTHROTTLE": True,
+        "AUTOTHROTTLE_START_CONCURRENCY": 2,
+        "AUTOTHROTTLE_MAX_CONCURRENCY": 8,
+        "AUTOTHROTTLE_MAX_DELAY": 30,
+    }
+    rules = HostRules({"slow.com": {"max_requests": 3, "delay": 0.5}})
+    crawler.sdl_req.q = HostPQ(max_per_host=6, delay=0.1, rules=rules)
+    handler = RequestAutoThrottle()
+    await handler.on_start()
+    return handler
+
+
+def limit_of(handler, host):
+    slot = handler.q._hosts[handler.q.get_host_key(host)]
+    return slot.limit, slot.delay
+
+
+@pytest.mark.asyncio
+async def test_autothrottle_grow(crawler):
+    throttle = await throttle_of(crawler)
+    assert throttle.q.max_per_host == 2
+    for _ in range(30):
+        await throttle.handle_after(throttled("http://a.com/"))
+    # capped by MAX_REQUESTS_PER_HOST, the delay doesn't go below DOWNLOAD_DELAY
+    assert limit_of(throttle, "a.com") == (6, 0.1)
+    for _ in range(30):
+        await throttle.handle_after(throttled("http://x.slow.com/"))
+    assert limit_of(throttle, "x.slow.com") == (3, 0.5)
+    # a latency far above the baseline shrinks the window
+    for _ in range(5):
+        await throttle.handle_after(throttled("http://a.com/", latency=5))
+    assert limit_of(throttle, "a.com")[0] < 6
+
+
+@pytest.mark.asyncio
+async def test_autothrottle_backoff(crawler):
+    throttle = await throttle_of(crawler)
+    for _ in range(10):
+        await throttle.handle_after(throttled("http://a.com/"))
+    window = throttle.hosts["a.com"].window
+    await throttle.handle_after(throttled("http://a.com/", status=503))
+    assert throttle.hosts["a.com"].window == max(1.0, window / 2)
+    assert throttle.hosts["a.com"].delay == 0.5
+    timeout = asyncio.TimeoutError()
+    await throttle.handle_after(throttled("http://a.com/", exception=timeout))
+    assert limit_of(throttle, "a.com") == (int(max(1.0, window / 4)), 1.0)
+    headers = {"Retry-After": "10"}
+    await throttle.handle_after(throttled("http://a.com/", status=429, headers=headers))
+    assert limit_of(throttle, "a.com") == (1, 10)
+    headers = {"Retry-After": "100"}
+    await throttle.handle_after(throttled("http://a.com/", status=429, headers=headers))
+    assert limit_of(throttle, "a.com") == (1, 30)
+
+
+@pytest.mark.asyncio
+async def test_autothrottle_shared_slot(crawler):
+    throttle = await throttle_of(crawler)
+    for _ in range(30):
+        await throttle.handle_after(throttled("http://x.slow.com/"))
+    await throttle.handle_after(throttled("http://y.slow.com/", status=503))
+    # subdomains sharing a limit share one controller
+    assert list(throttle.hosts) == ["slow.com"]
+    assert limit_of(throttle, "x.slow.com") == (1, 1.0)
+    await throttle.handle_after(throttled("http://x.slow.com/"))
+    assert limit_of(throttle, "y.slow.com")[1] == 0.8
@@ -0,0 +1,54 @@
+from acrawler.hostrules import HostRules
+from acrawler.http import Request
+from acrawler.scheduler import HostPQ
+
+
+def test_match_domain_and_subdomains():
+    rules = HostRules.from_settings(
+        max_requests={"example.com": 2},
+        delay={"api.example.com": 1},
+        rules={"example.com": {"headers": {"a": "1"}}, "other.org": {"proxy": "p"}},
+    )
+    assert len(rules) == 3
+    assert rules.find("example.com", "max_requests") == ("example.com", 2)
+    assert rules.find("www.Example.com", "max_requests") == ("example.com", 2)
+    assert rules.find("api.example.com", "max_requests") == ("example.com", 2)
+    assert rules.get("api.example.com", "delay") == 1
+    assert rules.get("www.example.com", "delay", 0) == 0
+    assert rules.get("api.example.com", "headers") == {"a": "1"}
+    # not a substring match anymore
+    assert rules.find("notexample.com", "max_requests") == (None, None)
+    assert rules.find("example.com.cn", "max_requests") == (None, None)
+    assert [p for p, _ in rules.match("x.api.example.com")] == [
+        "api.example.com",
+        "example.com",
+    ]
+    assert rules.match("") == []
+
+
+def test_hostpq_with_rules():
+    rules = HostRules({"a.com": {"max_requests": 1, "delay": 0.5}})
+    q = HostPQ(max_per_host=3, rules=rules)
+    assert q.get_host_key("x.a.com") == "a.com"
+    assert q.get_host_key("b.com") == "b.com"
+    slot = q._new_slot("a.com")
+    assert (slot.limit, slot.delay) == (1, 0.5)
+    slot = q._new_slot("b.com")
+    assert (slot.limit, slot.delay) == (3, 0)
+
+
+def test_hostpq_shared_slot_rules():
+    rules = HostRules(
+        {
+            "a.com": {"max_requests": 2, "delay": 0.5},
+            "x.a.com": {"delay": 1},
+            "y.a.com": {"delay": 3, "rate": 1},
+        }
+    )
+    for first, second in (("x.a.com", "y.a.com"), ("y.a.com", "x.a.com")):
+        q = HostPQ(rules=rules)
+        q.push_nowait(Request(f"http://{first}/"))
+        q.push_nowait(Request(f"http://{second}/"))
+        assert list(q._hosts) == ["a.com"]
+        slot = q._hosts["a.com"]
+        assert (slot.limit, slot.delay, slot.bucket) == (2, 0.5, None)
@@ -0,0 +1,91 @@
+import pytest
+from yarl import URL
+
+from acrawler.http import Request
+from acrawler.normalizer import URLNormalizer, url_normalizer
+
+
+RULES = {
+    "lowercase_host": True,
+    "strip_www": True,
+    "default_port": True,
+    "path": True,
+    "trailing_slash": True,
+    "percent_encoding": True,
+    "strip_params": ["utm_*", "sid"],
+}
+
+
+@pytest.fixture
+def normalizer():
+    url_normalizer.configure(RULES)
+    yield url_normalizer
+    url_normalizer.configure()
+
+
+def test_normalize():
+    n = URLNormalizer(RULES)
+    expected = "http://ex.com/a/c/d?a=~&b=1"
+    url = URL("HTTP://WWW.Ex.com:80/a/./b/../c//d/?b=1&a=%7e&sid=3#f")
+    assert n.normalize(url) == expected
+    assert n.normalize(URL("http://ex.com/a/c/d?a=~&b=1&utm_source=x")) == expected
+    assert n.normalize(URL("http://a.com/q?x=a+b")) == n.normalize(
+        URL("http://a.com/q?x=a%20b")
+    )
+    assert n.normalize(URL("http://a.com/%7Efoo%2fbar/")) == "http://a.com/~foo%2Fbar"
+    assert n.normalize(URL("http://a.com:8080/")) == "http://a.com:8080/"
+
+
+def test_special_hosts_and_families():
+    n = URLNormalizer(
+        {"trailing_slash": True},
+        special_hosts={"shop.com": {"strip_params": ["ref"]}},
+        family_keys={"Item": lambda rq: rq.url.query.get("id")},
+    )
+    assert n.canonicalize(Request("http://shop.com/a/?ref=1&q=2")) == (
+        "http://shop.com/a?q=2",
+        True,
+    )
+    rq = Request("http://b.com/a?ref=1")
+    assert n.canonicalize(rq) == ("http://b.com/a?ref=1", False)
+    key, _ = n.canonicalize(Request("http://b.com/item?id=7&x=1", family="Item"))
+    assert key == "7"
+
+
+def test_special_hosts_merged():
+    n = URLNormalizer(
+        {"lowercase_path": True},
+        special_hosts={
+            "example.com": {"strip_params": ["ref"], "trailing_slash": True},
+            "api.example.com": {"lowercase_path": False},
+        },
+    )
+    url = URL("http://api.example.com/A/?ref=1&q=2")
+    assert n.canonicalize_link(url) == ("http://api.example.com/A?q=2", True)
+    url = URL("http://www.example.com/A/?ref=1")
+    assert n.canonicalize_link(url) == ("http://www.example.com/a", True)
+
+
+def test_family_key_types():
+    n = URLNormalizer(family_keys={"Item": lambda rq: rq.meta.get("id")})
+    rq = Request("http://b.com/item", family="Item", meta={"id": 7})
+    assert n.canonicalize(rq) == ("7", True)
+    with pytest.raises(TypeError, match="'Item'"):
+        n.canonicalize(Request("http://b.com/item", family="Item"))
+
+
+def test_default_fingerprint_unchanged():
+    rq = Request("https://httpbin.org/cookies/set?name=crawler&age=18")
+    assert rq.url_str_normalized == rq.url_str_canonicalized
+    assert rq.url_normalized is False
+
+
+def test_fingerprint_normalized(normalizer):
+    rq1 = Request("http://WWW.example.com/a/?utm_source=x")
+    rq2 = Request("http://example.com/a")
+    assert rq1.fingerprint == rq2.fingerprint
+    assert rq1.url_normalized is True
+    assert rq2.url_normalized is False
+    fp = rq1.fingerprint
+    url_normalizer.configure()
+    assert rq1.fingerprint != fp
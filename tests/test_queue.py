@@ -1,7 +1,20 @@
+import asyncio
+import time
+
 import pytest
 
 from acrawler.http import Request
-from acrawler.scheduler import AsyncPQ, RedisPQ
+from acrawler.scheduler import (
+    AsyncPQ,
+    BucketPQ,
+    DiskPQ,
+    HeapPQ,
+    HostPQ,
+    RedisPQ,
+    RedisStreamQueue,
+    ShardedRedisPQ,
+    TokenBucket,
+)
 from acrawler.task import DummyTask
 
 
@@ -48,3 +61,228 @@ async def test_AsyncPQ():
 async def test_RedisPQ():
     q = RedisPQ()
     await pq_push_pop(q)
+
+
+@pytest.mark.asyncio
+async def test_RedisPQ_legacy_members():
+    q = RedisPQ(q_key="acrawler:test_legacy")
+    await q.start()
+    await q.clear()
+    # members without priority prefix, as pushed by former versions
+    await q.redis.zadd(q.waiting_key, time.time(), q.serialize(DummyTask("waiting")))
+    await q.redis.zadd(q.pq_key, 0, q.serialize(DummyTask("ready")))
+    await q.push(DummyTask("new", priority=-1))
+    vals = [(await q.pop()).val for _ in range(3)]
+    assert vals == ["ready", "waiting", "new"]
+    await q.close()
+
+
+@pytest.mark.asyncio
+async def test_RedisStreamQueue():
+    q = RedisStreamQueue()
+    await pq_push_pop(q)
+
+
+@pytest.mark.asyncio
+async def test_RedisStreamQueue_claim():
+    q1 = RedisStreamQueue(q_key="acrawler:test_claim", consumer="c1")
+    q2 = RedisStreamQueue(q_key="acrawler:test_claim", consumer="c2", claim_idle=0.1)
+    await q1.start()
+    await q2.start()
+    await q1.clear()
+
+    await q1.push(DummyTask("lost"))
+    await q1.push(DummyTask("done"))
+    lost = await q1.pop()
+    done = await q1.pop()
+    await q1.task_done(done)
+    assert lost.val == "lost"
+    await asyncio.sleep(0.2)
+    await q2.claim_stale()
+    claimed = await q2.pop()
+    assert claimed.val == "lost"
+    await q2.task_done(claimed)
+    assert await q2.get_length() == 0
+    await q1.close()
+    await q2.close()
+
+
+@pytest.mark.asyncio
+async def test_ShardedRedisPQ():
+    q = ShardedRedisPQ(shards=4, owned=[1], prefetch=1)
+    await q.start()
+    await q.clear()
+    reqs = [Request(f"http://host{i}.com/") for i in range(8)]
+    await q.push_many(reqs)
+    assert await q.get_length() == 8
+    assert await q.shards[1].get_length() > 0
+    assert q.shard_of(reqs[0]) is q.shard_of(Request("http://host0.com/a"))
+
+    owned = [r for r in reqs if q.shard_of(r) is q.shards[1]]
+    popped = [await q.pop() for _ in range(8)]
+    assert [r.url for r in popped[: len(owned)]] == [r.url for r in owned]
+    assert await q.get_length() == 0
+    await q.close()
+
+
+@pytest.mark.asyncio
+async def test_HeapPQ():
+    q = HeapPQ()
+    await pq_push_pop(q)
+
+
+@pytest.mark.asyncio
+async def test_wakeup_HeapPQ():
+    q = HeapPQ()
+    getter = asyncio.ensure_future(q.pop())
+    await asyncio.sleep(0.01)
+    assert not getter.done()
+    task = DummyTask("now")
+    await q.push(task)
+    assert await asyncio.wait_for(getter, 0.1) is task
+
+    deferred = DummyTask("later", exetime=time.time() + 0.2)
+    await q.push(deferred)
+    assert await q.get_length_of_waiting() == 1
+    start = time.time()
+    assert await asyncio.wait_for(q.pop(), 1) is deferred
+    assert 0.15 <= time.time() - start < 0.5
+    assert await q.get_length() == 0
+    await q.close()
+
+
+@pytest.mark.asyncio
+async def test_BucketPQ():
+    q = BucketPQ()
+    tasks = [DummyTask(i, priority=p) for i, p in enumerate([0, 2, 0, 1, 2])]
+    for task in tasks:
+        await q.push(task)
+    deferred = DummyTask("later", exetime=time.time() + 0.1, priority=5)
+    await q.push(deferred)
+    assert await q.get_length() == 6
+    popped = [(await q.pop()).val for _ in range(5)]
+    assert popped == [1, 4, 3, 0, 2]
+    assert await asyncio.wait_for(q.pop(), 1) is deferred
+    assert await q.get_length() == 0
+    await q.close()
+
+
+@pytest.mark.asyncio
+async def test_HostPQ_limit():
+    q = HostPQ(max_per_host=1)
+    a1 = Request("http://a.com/1", priority=2)
+    a2 = Request("http://a.com/2", priority=2)
+    b1 = Request("http://b.com/1", priority=1)
+    for req in (a1, a2, b1):
+        await q.push(req)
+    assert await q.pop() is a1
+    assert await q.pop() is b1
+    getter = asyncio.ensure_future(q.pop())
+    await asyncio.sleep(0.01)
+    assert not getter.done()
+    q.release(a1)
+    assert await asyncio.wait_for(getter, 0.1) is a2
+    assert await q.get_length() == 0
+    await q.close()
+
+
+@pytest.mark.asyncio
+async def test_HostPQ_delay():
+    q = HostPQ(special_delay={"a.com": 0.2})
+    a1 = Request("http://a.com/1", priority=1)
+    a2 = Request("http://a.com/2", priority=1)
+    b1 = Request("http://b.com/1")
+    for req in (a1, a2, b1):
+        await q.push(req)
+    start = time.time()
+    assert await q.pop() is a1
+    assert await q.pop() is b1
+    assert await asyncio.wait_for(q.pop(), 1) is a2
+    assert time.time() - start >= 0.15
+    await q.close()
+
+
+@pytest.mark.asyncio
+async def test_HostPQ_set_host_limit():
+    q = HostPQ(max_per_host=1)
+    a = [Request(f"http://a.com/{i}") for i in range(3)]
+    for req in a:
+        await q.push(req)
+    assert await q.pop() is a[0]
+    getter = asyncio.ensure_future(q.pop())
+    await asyncio.sleep(0.01)
+    assert not getter.done()
+    q.set_host_limit("a.com", limit=2)
+    assert await asyncio.wait_for(getter, 0.1) is a[1]
+    assert q.get_host_stats() == {"a.com": (1, 2, 2, 0)}
+    q.release(a[0])
+    q.set_host_limit("a.com", delay=0.2)
+    start = time.time()
+    assert await asyncio.wait_for(q.pop(), 1) is a[2]
+    assert time.time() - start >= 0.15
+    await q.close()
+
+
+@pytest.mark.asyncio
+async def test_HostPQ_rate():
+    q = HostPQ(rate=1, special_rate={"b.com": (10, 2)})
+    a = [Request(f"http://a.com/{i}", priority=1) for i in range(2)]
+    b = [Request(f"http://b.com/{i}") for i in range(3)]
+    for req in a + b:
+        await q.push(req)
+    start = time.time()
+    assert await q.pop() is a[0]
+    # a.com waits for a token while b.com bursts
+    assert await q.pop() is b[0]
+    assert await q.pop() is b[1]
+    assert await asyncio.wait_for(q.pop(), 1) is b[2]
+    assert 0.05 <= time.time() - start < 0.5
+    assert await asyncio.wait_for(q.pop(), 2) is a[1]
+    assert time.time() - start >= 0.9
+    await q.close()
+
+
+def test_TokenBucket():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert 0.05 < bucket.take() <= 0.1
+    bucket.consume()
+    assert bucket.ready_time() - time.time() > 0.1
+
+
+@pytest.mark.asyncio
+async def test_DiskPQ(tmp_path):
+    q = DiskPQ(tmp_path / "q.sqlite", max_in_memory=3, refill_size=2, persistent=True)
+    for i in range(10):
+        await q.push(DummyTask(i, priority=i % 3))
+    deferred = DummyTask("later", priority=9, exetime=time.time() + 0.2)
+    await q.push(deferred)
+    assert await q.get_length() == 11
+    assert await q.get_length_of_waiting() == 1
+
+    vals = [(await q.pop()).val for _ in range(10)]
+    assert vals == [2, 5, 8, 1, 4, 7, 0, 3, 6, 9]
+    assert await asyncio.wait_for(q.pop(), 1) is not None
+    assert await q.get_length() == 0
+
+    await q.push(DummyTask("kept"))
+    await q.close()
+    q = DiskPQ(tmp_path / "q.sqlite", resume=True)
+    assert not q.persists_itself
+    assert (await q.pop()).val == "kept"
+    await q.close()
+    assert not (tmp_path / "q.sqlite").exists()
+
+
+@pytest.mark.asyncio
+async def test_DiskPQ_spill_batches(tmp_path):
+    q = DiskPQ(tmp_path / "q.sqlite", max_in_memory=2, spill_size=5)
+    for i in range(6):
+        await q.push(DummyTask(i, priority=i))
+    # spilled tasks wait for a batch before being written
+    assert len(q._spilled) == 4
+    assert q.db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] == 0
+    assert await q.get_length() == 6
+    assert [(await q.pop()).val for _ in range(6)] == [5, 4, 3, 2, 1, 0]
+    await q.close()
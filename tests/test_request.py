@@ -1,8 +1,11 @@
 import pickle
+from types import SimpleNamespace
 
 import pytest
+from yarl import URL
 
-from acrawler.http import Request
+from acrawler.http import Request, Response, link_fingerprint
+from acrawler.scheduler import SetDupefilter
 
 
 def test_fp():
@@ -22,6 +25,36 @@ def test_same_fp():
     assert rq3.fingerprint == rq5.fingerprint
 
 
+def test_cached_fp():
+    rq = Request("https://www.google.com")
+    fp = rq.fingerprint
+    assert rq.fingerprint is fp
+    same = Request("https://www.google.com")
+    assert rq.compact_fingerprint == same.compact_fingerprint
+    rq.url = rq.url.with_path("/search")
+    assert rq.fingerprint != fp
+    assert rq.fingerprint == Request("https://www.google.com/search").fingerprint
+    rq = pickle.loads(pickle.dumps(rq))
+    assert rq.fingerprint == Request("https://www.google.com/search").fingerprint
+
+
+def test_link_fp():
+    url = "https://httpbin.org/cookies/set?name=crawler&age=18#top"
+    assert link_fingerprint(url) == Request(url).fingerprint
+    assert link_fingerprint(url, "POST") == Request(url, method="POST").fingerprint
+
+
+def test_unseen_links():
+    df = SetDupefilter()
+    rq = Request("http://a.com/")
+    resp = Response(URL("http://a.com/"), 200, None, {}, rq, b"", "utf-8")
+    resp.crawler = SimpleNamespace(sdl_req=SimpleNamespace(df=df))
+    df.fingerprints.add(Request("http://a.com/1").fingerprint)
+    urls = ["http://a.com/1", "http://a.com/2", "", "http://a.com/2#x"]
+    assert list(resp.unseen_links(urls)) == ["http://a.com/2"]
+    assert list(resp.unseen_links(urls, dont_filter=True)) == urls[:2] + urls[3:]
+
+
 def test_diff_fp():
     rq1 = Request("https://www.google.com")
     rq2 = Request("https://httpbin.org/cookies/set?name=crawler&age=18")
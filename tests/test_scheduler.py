@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 
 from acrawler.http import Request
@@ -33,3 +35,33 @@ async def test_consume():
     assert await sdl.produce(rq1)
     assert await sdl.produce(rq2)
     assert await sdl.consume() is rq1
+
+
+@pytest.mark.asyncio
+async def test_watermark():
+    sdl = Scheduler(high_watermark=3, low_watermark=1)
+    for i in range(3):
+        assert await sdl.produce(Request(f"https://www.{i}.com"))
+
+    waiter = asyncio.ensure_future(sdl.wait_for_room())
+    await asyncio.sleep(0.05)
+    assert not waiter.done()
+    await sdl.consume()
+    await asyncio.sleep(0.05)
+    assert not waiter.done()
+    await sdl.consume()
+    await asyncio.wait_for(waiter, 0.5)
+    await sdl.wait_for_room()
+
+
+@pytest.mark.asyncio
+async def test_produce_many():
+    sdl = Scheduler()
+    rq1 = Request("https://www.baidu.com")
+    rq2 = Request("https://www.bing.com")
+    rq3 = Request("https://www.baidu.com")
+    rq4 = Request("https://www.baidu.com", dont_filter=True)
+    added = await sdl.produce_many([rq1, rq2, rq3, rq4])
+    assert added == [rq1, rq2, rq4]
+    assert await sdl.produce_many([rq1]) == []
+    assert await sdl.q.get_length() == 3